@@ -7,41 +7,46 @@
 # license agreement from NVIDIA CORPORATION is strictly prohibited.
 
 
-import os, sys, time,torch,pickle,trimesh,itertools,pdb,zipfile,datetime,imageio,gzip,logging,joblib,importlib,uuid,signal,multiprocessing,psutil,subprocess,tarfile,scipy,argparse
-from pytorch3d.transforms import so3_log_map,so3_exp_map,se3_exp_map,se3_log_map,matrix_to_axis_angle,matrix_to_euler_angles,euler_angles_to_matrix, rotation_6d_to_matrix
-from pytorch3d.renderer import FoVPerspectiveCameras, PerspectiveCameras, look_at_view_transform, look_at_rotation, RasterizationSettings, MeshRenderer, MeshRasterizer, BlendParams, SoftSilhouetteShader, HardPhongShader, PointLights, TexturesVertex
-from pytorch3d.renderer.mesh.rasterize_meshes import barycentric_coordinates
-from pytorch3d.renderer.mesh.shader import SoftDepthShader, HardFlatShader
-from pytorch3d.renderer.mesh.textures import Textures
-from pytorch3d.structures import Meshes
-from scipy.interpolate import griddata
-import nvdiffrast.torch as dr
+import os, sys, time,torch,pickle,trimesh,itertools,pdb,zipfile,datetime,gzip,logging,importlib,uuid,signal,multiprocessing,psutil,subprocess,tarfile,scipy,argparse,threading
 import torch.nn.functional as F
-import torchvision
 import torch.nn as nn
-from functools import partial
-import pandas as pd
-import open3d as o3d
+from functools import partial, wraps
 from uuid import uuid4
 import cv2
 from PIL import Image
 import numpy as np
 from collections import defaultdict
 import multiprocessing as mp
-import matplotlib.pyplot as plt
 import math,glob,re,copy
 from transformations import *
-from scipy.spatial import cKDTree
 from collections import OrderedDict
 import ruamel.yaml
 yaml = ruamel.yaml.YAML()
 code_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(code_dir)
+from render_backend import *
+from lazy_import import *
+from tracing import *
+# Not needed by the estimation and tracking path, imported on first use
+o3d = LazyModule('open3d')
+pd = LazyModule('pandas')
+plt = LazyModule('matplotlib.pyplot')
+imageio = LazyModule('imageio')
+joblib = LazyModule('joblib')
+torchvision = LazyModule('torchvision')
+kornia = LazyModule('kornia')
+griddata = lazy_callable('scipy.interpolate', 'griddata')
+cKDTree = lazy_callable('scipy.spatial', 'cKDTree')
+# Imported on first use, so that importing Utils/estimater on a CPU-only node needs neither nvdiffrast (dr, from render_backend) nor pytorch3d
+so3_log_map = lazy_callable('pytorch3d.transforms', 'so3_log_map')
+so3_exp_map = lazy_callable('pytorch3d.transforms', 'so3_exp_map')
+se3_exp_map = lazy_callable('pytorch3d.transforms', 'se3_exp_map')
+se3_log_map = lazy_callable('pytorch3d.transforms', 'se3_log_map')
+matrix_to_axis_angle = lazy_callable('pytorch3d.transforms', 'matrix_to_axis_angle')
+matrix_to_euler_angles = lazy_callable('pytorch3d.transforms', 'matrix_to_euler_angles')
+euler_angles_to_matrix = lazy_callable('pytorch3d.transforms', 'euler_angles_to_matrix')
+rotation_6d_to_matrix = lazy_callable('pytorch3d.transforms', 'rotation_6d_to_matrix')
 # sys.path.append(f"{code_dir}/mycpp/build")
-try:
-  import kornia
-except:
-  kornia = None
 try:
   import mycpp.build.mycpp as mycpp
 except:
@@ -52,7 +57,6 @@ except:
   common = None
 try:
   import warp as wp
-  wp.init()
 except:
   wp = None
 enable_timer = 0
@@ -130,6 +134,101 @@ def make_mesh_tensors(mesh, device='cuda', max_tex_size=None):
   return mesh_tensors
 
 
+def lod_face_budget(render_size, pixels_per_face=1):
+  '''Faces of a mesh whose visible half fills a crop of @render_size with @pixels_per_face pixels per face. Smaller faces are not resolved at that size
+  '''
+  return int(2*render_size[0]*render_size[1]/pixels_per_face)
+
+
+def make_texture_mipmaps(img):
+  '''Area filtered pyramid down to 1 pixel, level 0 is @img
+  '''
+  mips = [img]
+  while max(mips[-1].shape[:2])>1:
+    H, W = mips[-1].shape[:2]
+    mips.append(cv2.resize(mips[-1], dsize=(max(W//2,1), max(H//2,1)), interpolation=cv2.INTER_AREA).reshape(max(H//2,1), max(W//2,1), -1))
+  return mips
+
+
+def transfer_uv(mesh, vertices, faces):
+  '''UVs of the corners of @faces from the closest point on @mesh. Each corner is queried slightly inside its face, so that faces on both sides of a uv seam get their own side
+  Return: (F*3,2) uv, uv_idx (F,3)
+  '''
+  corners = vertices[faces]   #(F,3,3)
+  query = corners+1e-3*(corners.mean(axis=1, keepdims=True)-corners)
+  scene = o3d.t.geometry.RaycastingScene()
+  scene.add_triangles(o3d.core.Tensor(mesh.vertices.astype(np.float32)), o3d.core.Tensor(mesh.faces.astype(np.uint32)))
+  closest = scene.compute_closest_points(o3d.core.Tensor(query.reshape(-1,3).astype(np.float32)))
+  ids = closest['primitive_ids'].numpy().astype(np.int64)
+  bary = trimesh.triangles.points_to_barycentric(mesh.triangles[ids], closest['points'].numpy().astype(np.float64))
+  uv = (np.asarray(mesh.visual.uv)[mesh.faces[ids]]*bary[...,None]).sum(axis=1)
+  return uv, np.arange(len(uv)).reshape(-1,3)
+
+
+def make_lod_mesh_tensors(mesh, max_faces=None, max_tex_size=None, tex_mips=None, device='cuda'):
+  '''mesh_tensors of a level of detail: @mesh quadric decimated to at most @max_faces and a uint8 texture of at most @max_tex_size
+  @tex_mips: make_texture_mipmaps of the texture, to share it between levels
+  '''
+  has_tex = isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals)
+  vertex_colors = None
+  if not has_tex:
+    vertex_colors = np.tile(np.array([0.5,0.5,0.5]).reshape(1,3), (len(mesh.vertices), 1))
+    if mesh.visual.vertex_colors is not None:
+      vertex_colors = mesh.visual.vertex_colors[...,:3]/255.0
+  decimated = max_faces is not None and len(mesh.faces)>max_faces
+  if not decimated:
+    lod = trimesh.Trimesh(mesh.vertices, mesh.faces, process=False)
+  else:
+    o3d_mesh = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(mesh.vertices), o3d.utility.Vector3iVector(mesh.faces))
+    if not has_tex:
+      o3d_mesh.vertex_colors = o3d.utility.Vector3dVector(vertex_colors)
+    o3d_mesh = o3d_mesh.simplify_quadric_decimation(target_number_of_triangles=max_faces)
+    lod = trimesh.Trimesh(np.asarray(o3d_mesh.vertices), np.asarray(o3d_mesh.triangles), process=False)
+    if not has_tex:
+      vertex_colors = np.asarray(o3d_mesh.vertex_colors)   # Averaged by the decimation
+  logging.info(f'lod faces:{len(lod.faces)}, ori faces:{len(mesh.faces)}')
+
+  mesh_tensors = {}
+  if has_tex:
+    if tex_mips is None:
+      tex_mips = make_texture_mipmaps(np.array(mesh.visual.material.image.convert('RGB'))[...,:3])
+    img = tex_mips[-1]
+    for mip in tex_mips:
+      if max_tex_size is None or max(mip.shape[:2])<=max_tex_size:
+        img = mip
+        break
+    mesh_tensors['tex'] = torch.as_tensor(img, device=device, dtype=torch.uint8)[None]
+    if decimated:
+      uv, uv_idx = transfer_uv(mesh, lod.vertices, lod.faces)
+    else:
+      uv, uv_idx = np.asarray(mesh.visual.uv), mesh.faces
+    uv = torch.as_tensor(uv, device=device, dtype=torch.float)
+    uv[:,1] = 1 - uv[:,1]
+    mesh_tensors['uv'] = uv
+    mesh_tensors['uv_idx'] = torch.as_tensor(uv_idx, device=device, dtype=torch.int)
+  else:
+    mesh_tensors['vertex_color'] = torch.as_tensor(vertex_colors, device=device, dtype=torch.float)
+
+  mesh_tensors.update({
+    'pos': torch.tensor(lod.vertices, device=device, dtype=torch.float),
+    'faces': torch.tensor(lod.faces, device=device, dtype=torch.int),
+    'vnormals': torch.tensor(lod.vertex_normals, device=device, dtype=torch.float),
+  })
+  return mesh_tensors
+
+
+def make_mesh_lods(mesh, render_size, pixels_per_face=[4,1], max_tex_sizes=[256,512], device='cuda'):
+  '''Levels of detail from coarse to fine, sharing one texture mip pyramid
+  @pixels_per_face: per level, the face budget is lod_face_budget(@render_size, pixels_per_face)
+  @max_tex_sizes: per level
+  Return: list of mesh_tensors
+  '''
+  tex_mips = None
+  if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals):
+    tex_mips = make_texture_mipmaps(np.array(mesh.visual.material.image.convert('RGB'))[...,:3])
+  return [make_lod_mesh_tensors(mesh, max_faces=lod_face_budget(render_size, ppf), max_tex_size=tex_size, tex_mips=tex_mips, device=device) for ppf, tex_size in zip(pixels_per_face, max_tex_sizes)]
+
+
 def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, context='cuda', get_normal=False, mesh_tensors=None, mesh=None, projection_mat=None, bbox2d=None, output_size=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}):
   '''Just plain rendering, not support any gradient
   @K: (3,3) np array
@@ -139,27 +238,26 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
   @bbox2d: (N,4) (umin,vmin,umax,vmax) if only roi need to render.
   @light_dir: in cam space
   @light_pos: in cam space
+  @glctx: nvdiffrast context or RenderBackend, see render_backend.make_render_backend
+  @context: cuda/gl/torch, used when @glctx is None. Off cuda the TorchRasterizer is used
+  Runs on the device of @ob_in_cams
   '''
+  device = ob_in_cams.device
+  backend = make_render_backend(glctx, context=context, device=device)
   if glctx is None:
-    if context == 'gl':
-      glctx = dr.RasterizeGLContext()
-    elif context=='cuda':
-      glctx = dr.RasterizeCudaContext()
-    else:
-      raise NotImplementedError
     logging.info("created context")
 
   if mesh_tensors is None:
-    mesh_tensors = make_mesh_tensors(mesh)
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
   pos = mesh_tensors['pos']
   vnormals = mesh_tensors['vnormals']
   pos_idx = mesh_tensors['faces']
   has_tex = 'tex' in mesh_tensors
 
-  ob_in_glcams = torch.tensor(glcam_in_cvcam, device='cuda', dtype=torch.float)[None]@ob_in_cams
+  ob_in_glcams = torch.tensor(glcam_in_cvcam, device=device, dtype=torch.float)[None]@ob_in_cams
   if projection_mat is None:
     projection_mat = projection_matrix_from_intrinsics(K, height=H, width=W, znear=0.001, zfar=100)
-  projection_mat = torch.as_tensor(projection_mat.reshape(-1,4,4), device='cuda', dtype=torch.float)
+  projection_mat = torch.as_tensor(projection_mat.reshape(-1,4,4), device=device, dtype=torch.float)
   mtx = projection_mat@ob_in_glcams
 
   if output_size is None:
@@ -173,26 +271,29 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
     t = H-bbox2d[:,1]
     r = bbox2d[:,2]
     b = H-bbox2d[:,3]
-    tf = torch.eye(4, dtype=torch.float, device='cuda').reshape(1,4,4).expand(len(ob_in_cams),4,4).contiguous()
+    tf = torch.eye(4, dtype=torch.float, device=device).reshape(1,4,4).expand(len(ob_in_cams),4,4).contiguous()
     tf[:,0,0] = W/(r-l)
     tf[:,1,1] = H/(t-b)
     tf[:,3,0] = (W-r-l)/(r-l)
     tf[:,3,1] = (H-t-b)/(t-b)
     pos_clip = pos_clip@tf
-  rast_out, _ = dr.rasterize(glctx, pos_clip, pos_idx, resolution=np.asarray(output_size))
-  xyz_map, _ = dr.interpolate(pts_cam, rast_out, pos_idx)
+  rast_out = backend.rasterize(pos_clip, pos_idx, resolution=np.asarray(output_size))
+  xyz_map = backend.interpolate(pts_cam, rast_out, pos_idx)
   depth = xyz_map[...,2]
   if has_tex:
-    texc, _ = dr.interpolate(mesh_tensors['uv'], rast_out, mesh_tensors['uv_idx'])
-    color = dr.texture(mesh_tensors['tex'], texc, filter_mode='linear')
+    texc = backend.interpolate(mesh_tensors['uv'], rast_out, mesh_tensors['uv_idx'])
+    tex = mesh_tensors['tex']
+    if tex.dtype==torch.uint8:   # Level of detail textures, see make_lod_mesh_tensors
+      tex = tex.float()/255.0
+    color = backend.texture(tex, texc, filter_mode='linear')
   else:
-    color, _ = dr.interpolate(mesh_tensors['vertex_color'], rast_out, pos_idx)
+    color = backend.interpolate(mesh_tensors['vertex_color'], rast_out, pos_idx)
 
   if use_light:
     get_normal = True
   if get_normal:
     vnormals_cam = transform_dirs(vnormals, ob_in_cams)
-    normal_map, _ = dr.interpolate(vnormals_cam, rast_out, pos_idx)
+    normal_map = backend.interpolate(vnormals_cam, rast_out, pos_idx)
     normal_map = F.normalize(normal_map, dim=-1)
     normal_map = torch.flip(normal_map, dims=[1])
   else:
@@ -200,15 +301,15 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
 
   if use_light:
     if light_dir is not None:
-      light_dir_neg = -torch.as_tensor(light_dir, dtype=torch.float, device='cuda')
+      light_dir_neg = -torch.as_tensor(light_dir, dtype=torch.float, device=device)
     else:
-      light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device='cuda').reshape(1,1,3) - pts_cam
+      light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device=device).reshape(1,1,3) - pts_cam
     diffuse_intensity = (F.normalize(vnormals_cam, dim=-1) * F.normalize(light_dir_neg, dim=-1)).sum(dim=-1).clip(0, 1)[...,None]
-    diffuse_intensity_map, _ = dr.interpolate(diffuse_intensity, rast_out, pos_idx)  # (N_pose, H, W, 1)
+    diffuse_intensity_map = backend.interpolate(diffuse_intensity, rast_out, pos_idx)  # (N_pose, H, W, 1)
     if light_color is None:
       light_color = color
     else:
-      light_color = torch.as_tensor(light_color, device='cuda', dtype=torch.float)
+      light_color = torch.as_tensor(light_color, device=device, dtype=torch.float)
     color = color*w_ambient + diffuse_intensity_map*light_color*w_diffuse
 
   color = color.clip(0,1)
@@ -216,9 +317,219 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
   color = torch.flip(color, dims=[1])   # Flip Y coordinates
   depth = torch.flip(depth, dims=[1])
   extra['xyz_map'] = torch.flip(xyz_map, dims=[1])
+  backend.release()
   return color, depth, normal_map
 
 
+def make_render_groups(B, mesh_tensors, mesh_ids=None, device='cuda'):
+  '''Group the hypotheses that share a mesh, so that each group is rasterized with its own mesh_tensors
+  @mesh_tensors: dict, or list of dict indexed by @mesh_ids
+  @mesh_ids: (B,) mesh index of each hypothesis, None if all hypotheses use the same mesh
+  Return: list of (ids, mesh_tensors), ids is (N,) long tensor into the hypotheses
+  '''
+  if mesh_ids is None:
+    if isinstance(mesh_tensors, (list, tuple)):
+      assert len(mesh_tensors)==1
+      mesh_tensors = mesh_tensors[0]
+    return [(torch.arange(B, device=device, dtype=torch.long), mesh_tensors)]
+  mesh_ids = torch.as_tensor(mesh_ids, device=device, dtype=torch.long).reshape(-1)
+  groups = []
+  for i in range(len(mesh_tensors)):
+    ids = torch.where(mesh_ids==i)[0]
+    if len(ids)==0:
+      continue
+    groups.append((ids, mesh_tensors[i]))
+  return groups
+
+
+def record_stream_tensors(data, stream):
+  '''Mark the tensors of @data (tensor, list/tuple/dict of them, or an object such as BatchPoseData) as used on @stream, so the caching allocator does not reuse their memory before @stream is done with them
+  '''
+  if torch.is_tensor(data):
+    if data.is_cuda:
+      data.record_stream(stream)
+  elif isinstance(data, (list, tuple)):
+    for v in data:
+      record_stream_tensors(v, stream)
+  elif isinstance(data, dict):
+    for v in data.values():
+      record_stream_tensors(v, stream)
+  elif hasattr(data, '__dict__'):
+    for v in vars(data).values():
+      record_stream_tensors(v, stream)
+
+
+def iter_chunks_overlapped(n, chunk_size, prepare_fn, device='cuda'):
+  '''Yield (start, end, data) for the chunks of range(n), data = prepare_fn(start, end). The next chunk is prepared while the caller consumes the current one, so at most two chunks are alive.
+  On cuda, prepare_fn runs on a side stream and the current stream waits for it before data is yielded. Otherwise prepare_fn runs in a worker thread
+  '''
+  starts = list(range(0, n, chunk_size))
+  if len(starts)==0:
+    return
+  if torch.device(device).type=='cuda':
+    current = torch.cuda.current_stream()
+    side = torch.cuda.Stream()
+    def launch(start):
+      side.wait_stream(current)   # Inputs are produced on the current stream
+      with torch.cuda.stream(side):
+        return prepare_fn(start, min(start+chunk_size, n))
+    pending = launch(starts[0])
+    for i, start in enumerate(starts):
+      data = pending
+      current.wait_stream(side)
+      record_stream_tensors(data, current)
+      if i+1<len(starts):
+        pending = launch(starts[i+1])
+      yield start, min(start+chunk_size, n), data
+  else:
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      pending = executor.submit(prepare_fn, starts[0], min(starts[0]+chunk_size, n))
+      for i, start in enumerate(starts):
+        data = pending.result()
+        if i+1<len(starts):
+          pending = executor.submit(prepare_fn, starts[i+1], min(starts[i+1]+chunk_size, n))
+        yield start, min(start+chunk_size, n), data
+
+
+class BatchPlanner:
+  '''Picks the chunk sizes of the render and network stages from a memory budget, with per hypothesis estimates from the crop resolution, the mesh size and the dtypes.
+  The estimates are deliberately rough (activations are counted at their peak), they only need to scale correctly across machines
+  '''
+  RENDER_VERTEX_FLOATS = 22   # Per vertex: camera points, clip positions and their matmul temporary, camera normals, lighting
+  RENDER_PIXEL_CHANNELS = 25   # Rasterizer output, interpolated xyz/uv/color/normal, normalization and lighting temporaries
+  WARP_PIXEL_CHANNELS = 12   # rgb and xyz of A and B after cropping, +6 with normals
+
+  def __init__(self, mem_budget=None, mem_fraction=0.5, max_chunk_size=1024, device='cuda'):
+    '''
+    @mem_budget: bytes, None to use @mem_fraction of the free device memory at planning time
+    '''
+    self.mem_budget = mem_budget
+    self.mem_fraction = mem_fraction
+    self.max_chunk_size = max_chunk_size
+    self.device = device
+    self.plans = {}
+
+
+  def get_mem_budget(self):
+    if self.mem_budget is not None:
+      return self.mem_budget
+    if torch.device(self.device).type=='cuda':
+      return torch.cuda.mem_get_info()[0]*self.mem_fraction
+    return psutil.virtual_memory().available*self.mem_fraction
+
+
+  def estimate(self, input_resize, n_vertices=0, use_normal=False, net_activation_channels=48, amp=True):
+    '''Bytes per hypothesis of each stage
+    @net_activation_channels: peak network activations, in channels of the input resolution
+    '''
+    H,W = input_resize
+    n_pixels = H*W
+    warp_channels = self.WARP_PIXEL_CHANNELS+(6 if use_normal else 0)
+    return {
+      'render': n_vertices*self.RENDER_VERTEX_FLOATS*4 + n_pixels*self.RENDER_PIXEL_CHANNELS*4,
+      'warp': n_pixels*warp_channels*4,
+      'network': n_pixels*(warp_channels*4 + net_activation_channels*(2 if amp else 4)),   # Concatenated inputs, activations
+    }
+
+
+  def plan(self, name, n, input_resize, n_vertices=0, use_normal=False, net_activation_channels=48, amp=True, n_alive=1, min_chunk_size=1):
+    '''
+    @name: key of the plan in self.plans, e.g. refiner/scorer
+    @n: number of hypotheses
+    @n_alive: chunks alive at the same time, e.g. 2 when rendering overlaps with the network
+    Return: dict with the chunk size of the render and network stages
+    '''
+    budget = self.get_mem_budget()
+    bytes_per_hypo = self.estimate(input_resize, n_vertices=n_vertices, use_normal=use_normal, net_activation_channels=net_activation_channels, amp=amp)
+    max_chunk_size = max(min(n, self.max_chunk_size), min_chunk_size)
+    network = int(budget//(n_alive*(bytes_per_hypo['warp']+bytes_per_hypo['network'])))
+    network = int(np.clip(network, min_chunk_size, max_chunk_size))
+    render = int(budget//(n_alive*bytes_per_hypo['render']))
+    render = int(np.clip(render, min_chunk_size, network))
+    plan = {'n': n, 'budget': int(budget), 'bytes_per_hypo': bytes_per_hypo, 'render': render, 'network': network}
+    self.plans[name] = plan
+    return plan
+
+
+  def __str__(self):
+    return self.report()
+
+
+  def report(self):
+    lines = []
+    for name, plan in self.plans.items():
+      bytes_str = ', '.join([f'{k} {v/1e6:.2f}MB' for k,v in plan['bytes_per_hypo'].items()])
+      lines.append(f"{name}: n={plan['n']}, budget {plan['budget']/1e9:.2f}GB, per hypothesis {bytes_str}, render chunk {plan['render']}, network chunk {plan['network']}")
+    return '\n'.join(lines)
+
+
+class WorkspaceArena:
+  '''Named device buffers reused across calls for the fixed shape per-call tensors (the crops of the real image and the network inputs of N hypotheses), instead of allocating them each call.
+  A buffer is allocated on first use, grows when a larger shape is requested and is only freed by release(). A view returned by get() is only valid until the next get() of the same name
+  '''
+  def __init__(self, growth=1.25):
+    self.growth = growth
+    self.buffers = {}
+    self.lock = threading.Lock()   # The crops of the next chunk are made in a worker thread off cuda, see iter_chunks_overlapped
+    self.stats = {'n_alloc': 0, 'n_grow': 0, 'n_reuse': 0, 'n_release': 0, 'bytes': 0}
+
+
+  def get(self, name, shape, dtype=torch.float, device='cuda'):
+    numel = int(np.prod(shape))
+    key = (name, dtype, str(device))
+    with self.lock:
+      buffer = self.buffers.get(key)
+      if buffer is not None and buffer.numel()>=numel:
+        self.stats['n_reuse'] += 1
+      else:
+        if buffer is None:
+          self.stats['n_alloc'] += 1
+          capacity = numel
+        else:
+          self.stats['n_grow'] += 1
+          self.stats['bytes'] -= buffer.numel()*buffer.element_size()
+          capacity = max(numel, int(buffer.numel()*self.growth))
+        self.buffers[key] = buffer = None   # Drop the old buffer before allocating the larger one
+        buffer = torch.empty(capacity, dtype=dtype, device=device)
+        self.buffers[key] = buffer
+        self.stats['bytes'] += buffer.numel()*buffer.element_size()
+    return buffer[:numel].view(shape)
+
+
+  def release(self):
+    with self.lock:
+      self.buffers = {}
+      self.stats['n_release'] += 1
+      self.stats['bytes'] = 0
+
+
+  def get_stats(self):
+    '''Arena counters, plus the caching allocator counters on cuda
+    '''
+    stats = dict(self.stats)
+    if torch.cuda.is_available():
+      allocator = torch.cuda.memory_stats()
+      for k in ['num_device_alloc', 'num_device_free', 'num_alloc_retries']:
+        stats[f'cuda_{k}'] = allocator.get(k, 0)
+    return stats
+
+
+def cat_into(arena, name, tensors, dim=1):
+  '''torch.cat into an arena buffer
+  '''
+  shape = list(tensors[0].shape)
+  shape[dim] = sum([t.shape[dim] for t in tensors])
+  out = arena.get(name, shape, dtype=tensors[0].dtype, device=tensors[0].device)
+  return torch.cat(tensors, dim=dim, out=out)
+
+
+def get_mesh_tensors_n_vertices(mesh_tensors):
+  if isinstance(mesh_tensors, (list, tuple)):
+    return max([get_mesh_tensors_n_vertices(m) for m in mesh_tensors])
+  return len(mesh_tensors['pos'])
+
+
 def set_seed(random_seed):
   import torch,random
   np.random.seed(random_seed)
@@ -300,6 +611,17 @@ def make_grid_image(imgs, nrow, padding=5, pad_value=255):
   return grid
 
 
+WARP_INITIALIZED = False
+
+def init_warp():
+  '''wp.init() on the first kernel launch instead of at import, it initializes the devices and the kernel cache
+  '''
+  global WARP_INITIALIZED
+  if not WARP_INITIALIZED:
+    wp.init()
+    WARP_INITIALIZED = True
+
+
 if wp is not None:
   @wp.kernel(enable_backward=False)
   def bilateral_filter_depth_kernel(depth:wp.array(dtype=float, ndim=2), out:wp.array(dtype=float, ndim=2), radius:int, zfar:float, sigmaD:float, sigmaR:float):
@@ -343,6 +665,7 @@ if wp is not None:
       out[h,w] = sum/sum_weight
 
   def bilateral_filter_depth(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda'):
+    init_warp()
     if isinstance(depth, np.ndarray):
       depth_wp = wp.array(depth, dtype=float, device=device)
     else:
@@ -385,6 +708,7 @@ if wp is not None:
 
 
   def erode_depth(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda'):
+    init_warp()
     depth_wp = wp.from_torch(torch.as_tensor(depth, dtype=torch.float, device=device))
     out_wp = wp.zeros(depth.shape, dtype=float, device=device)
     wp.launch(kernel=erode_depth_kernel, device=device, dim=[depth.shape[0], depth.shape[1]], inputs=[depth_wp, out_wp, radius, depth_diff_thres, ratio_thres, zfar],)
@@ -396,6 +720,50 @@ if wp is not None:
 
 
 
+class DeviceTransferCounter:
+  '''Counts the host<->device copies and the host syncs issued inside the with block, using the torch profiler. For debugging only, profiling slows everything down
+  '''
+  def __init__(self):
+    self.counts = {'h2d': 0, 'd2h': 0, 'sync': 0}
+
+  def __enter__(self):
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+      activities.append(torch.profiler.ProfilerActivity.CUDA)
+    self.prof = torch.profiler.profile(activities=activities)
+    self.prof.__enter__()
+    return self
+
+  def __exit__(self, *args):
+    self.prof.__exit__(*args)
+    for event in self.prof.events():
+      if 'HtoD' in event.name:
+        self.counts['h2d'] += 1
+      elif 'DtoH' in event.name:
+        self.counts['d2h'] += 1
+      if 'Synchronize' in event.name:
+        self.counts['sync'] += 1
+    return False
+
+
+def count_device_transfers(func):
+  '''Method decorator. When self.count_transfers is set, the counts of the last call are saved to self.transfer_stats[method name]
+  '''
+  @wraps(func)
+  def wrapper(self, *args, **kwargs):
+    if not getattr(self, 'count_transfers', False):
+      return func(self, *args, **kwargs)
+    with DeviceTransferCounter() as counter:
+      out = func(self, *args, **kwargs)
+    if getattr(self, 'transfer_stats', None) is None:
+      self.transfer_stats = {}
+    self.transfer_stats[func.__name__] = counter.counts
+    logging.info(f'{func.__name__} transfers:{counter.counts}')
+    return out
+  return wrapper
+
+
+
 def depth2xyzmap(depth, K, uvs=None):
   invalid_mask = (depth<0.001)
   H,W = depth.shape[:2]
@@ -425,9 +793,9 @@ def depth2xyzmap_batch(depths, Ks, zfar):
   bs = depths.shape[0]
   invalid_mask = (depths<0.001) | (depths>zfar)
   H,W = depths.shape[-2:]
-  vs,us = torch.meshgrid(torch.arange(0,H),torch.arange(0,W), indexing='ij')
-  vs = vs.reshape(-1).float().cuda()[None].expand(bs,-1)
-  us = us.reshape(-1).float().cuda()[None].expand(bs,-1)
+  vs,us = torch.meshgrid(torch.arange(0,H,device=depths.device),torch.arange(0,W,device=depths.device), indexing='ij')
+  vs = vs.reshape(-1).float()[None].expand(bs,-1)
+  us = us.reshape(-1).float()[None].expand(bs,-1)
   zs = depths.reshape(bs,-1)
   Ks = Ks[:,None].expand(bs,zs.shape[-1],3,3)
   xs = (us-Ks[...,0,2])*zs/Ks[...,0,0]  #(B,N)
@@ -438,6 +806,98 @@ def depth2xyzmap_batch(depths, Ks, zfar):
   return xyz_maps
 
 
+def depth2xyzmap_crop_batch(depths, Ks, tf_to_crops, zfar):
+  '''Back-project cropped depths directly in crop space, using the per-crop intrinsics tf_to_crop@K
+  @depths: torch tensor (B,H,W), crops of the original depth
+  @Ks: torch tensor (B,3,3) or (1,3,3), intrinsics of the original image
+  @tf_to_crops: torch tensor (B,3,3), original pixel to crop pixel
+  '''
+  bs = depths.shape[0]
+  invalid_mask = (depths<0.001) | (depths>zfar)
+  H,W = depths.shape[-2:]
+  K_crops_inv = (tf_to_crops.float()@Ks.float()).inverse()  #(B,3,3)
+  vs,us = torch.meshgrid(torch.arange(0,H,device=depths.device),torch.arange(0,W,device=depths.device), indexing='ij')
+  uvs = torch.stack([us.reshape(-1), vs.reshape(-1), torch.ones_like(us).reshape(-1)], dim=0).float()  #(3,N)
+  rays = K_crops_inv@uvs[None]  #(B,3,N)
+  rays = rays/rays[:,2:3]   # Unit depth, also valid for non affine crops
+  pts = rays.permute(0,2,1)*depths.reshape(bs,-1,1)  #(B,N,3)
+  xyz_maps = pts.reshape(bs,H,W,3)
+  xyz_maps[invalid_mask] = 0
+  return xyz_maps
+
+
+def clip_roi(left, top, right, bottom, H, W):
+  '''Round to the pixel grid and clip, one host sync
+  Return: (umin,vmin,umax,vmax) ints with umax/vmax exclusive, None when the window is empty
+  '''
+  umin, vmin, umax, vmax = torch.stack([left.floor(), top.floor(), right.ceil()+1, bottom.ceil()+1]).reshape(-1).tolist()
+  umin = int(max(umin, 0))
+  vmin = int(max(vmin, 0))
+  umax = int(min(umax, W))
+  vmax = int(min(vmax, H))
+  if umax<=umin or vmax<=vmin:
+    return None
+  return umin, vmin, umax, vmax
+
+
+def compute_crop_roi(K, centers, radius, H, W, margin=0.5):
+  '''Image window covering the box_3d crop windows of compute_crop_window_tf_batch around all @centers
+  @centers: (N,3) tensor, camera frame
+  @radius: meter, mesh_diameter*crop_ratio/2, a float or (N,) tensor per center
+  @margin: ratio of the crop half size added on each side, room for the pose to move during refinement
+  '''
+  centers = centers.reshape(-1,3)
+  K = torch.as_tensor(K, device=centers.device, dtype=torch.float)
+  z = centers[:,2].clip(min=0.001)
+  uc = K[0,0]*centers[:,0]/z+K[0,2]
+  vc = K[1,1]*centers[:,1]/z+K[1,2]
+  half = torch.maximum(K[0,0], K[1,1])*radius/z*(1+margin)
+  return clip_roi((uc-half).min(), (vc-half).min(), (uc+half).max(), (vc+half).max(), H, W)
+
+
+def icp_point_to_plane(pts, normals, pose, depth, K, max_dist, n_iter=10, damping=1e-4):
+  '''Point-to-plane ICP of model points against a depth image with projective data association: each model point is matched to the back-projected depth at the pixel it projects to. A fixed number of Gauss-Newton steps, without syncs
+  @pts: (N,3) tensor, model points, @normals their (N,3) normals
+  @pose: (4,4) tensor, initial model in camera pose
+  @depth: (H,W) tensor, meter
+  @max_dist: meter, matches farther apart are outliers, e.g. points on an occluder
+  @damping: ratio of the mean diagonal of the normal equations, keeps degenerate fits from jumping
+  Return: pose (4,4), inlier_ratio over the model points facing the camera inside the image, rms point-to-plane distance of the inliers. Both 0-dim tensors, at the returned pose
+  '''
+  device = depth.device
+  H,W = depth.shape[-2:]
+  K = torch.as_tensor(K, dtype=torch.float, device=device)
+  pose = torch.as_tensor(pose, dtype=torch.float, device=device).reshape(4,4)
+  eye = torch.eye(6, dtype=torch.float, device=device)
+  for i in range(n_iter+1):
+    p = pts@pose[:3,:3].T+pose[:3,3]
+    n = normals@pose[:3,:3].T
+    z = p[:,2].clip(min=1e-6)
+    u = (p[:,0]*K[0,0]/z+K[0,2]).round().long()
+    v = (p[:,1]*K[1,1]/z+K[1,2]).round().long()
+    visible = (p[:,2]>0.001) & (u>=0) & (u<W) & (v>=0) & (v<H) & ((n*p).sum(dim=-1)<0)
+    zq = depth[v.clip(0,H-1), u.clip(0,W-1)]
+    q = torch.stack([(u-K[0,2])*zq/K[0,0], (v-K[1,2])*zq/K[1,1], zq], dim=-1)
+    inlier = visible & (zq>=0.001) & ((p-q).norm(dim=-1)<max_dist)
+    w = inlier.float()
+    r = ((p-q)*n).sum(dim=-1)*w
+    if i==n_iter:
+      break
+    J = torch.cat([torch.cross(p, n, dim=-1), n], dim=-1)*w[:,None]   # d r / d (rotation, translation), small motion in the camera frame
+    A = J.T@J
+    A = A+eye*(A.diagonal().mean()*damping+1e-12)
+    x = torch.linalg.solve(A, -J.T@r)
+    twist = torch.zeros((4,4), dtype=torch.float, device=device)
+    twist[0,1], twist[0,2], twist[1,2] = -x[2], x[1], -x[0]
+    twist[:3,:3] = twist[:3,:3]-twist[:3,:3].T
+    twist[:3,3] = x[3:]
+    pose = torch.linalg.matrix_exp(twist)@pose
+  n_inlier = inlier.sum()
+  inlier_ratio = n_inlier/visible.sum().clip(min=1)
+  rms = ((r**2).sum()/n_inlier.clip(min=1)).sqrt()
+  return pose, inlier_ratio, rms
+
+
 
 def rle_to_mask(rle: dict) -> np.ndarray:
   """Compute a binary mask from an uncompressed RLE."""
@@ -508,6 +968,18 @@ def sample_views_icosphere(n_views, subdivisions=None, radius=1):
 
 
 
+def make_rotation_grid_candidates(min_n_views=40, inplane_step=60):
+  '''Viewpoints on the icosphere times the in-plane rotations, as ob_in_cam. Ordered view by view, which cluster_poses depends on
+  Return: (N,4,4) np array
+  '''
+  cam_in_obs = sample_views_icosphere(n_views=min_n_views)
+  inplane_rots = np.deg2rad(np.arange(0, 360, inplane_step))
+  R_inplanes = np.stack([euler_matrix(0,0,inplane_rot) for inplane_rot in inplane_rots], axis=0)
+  cam_in_obs = (cam_in_obs[:,None]@R_inplanes[None]).reshape(-1,4,4)
+  return np.linalg.inv(cam_in_obs)
+
+
+
 def to_homo(pts):
   '''
   @pts: (N,3 or 2) will homogeneliaze the last dimension
@@ -556,7 +1028,9 @@ def random_direction():
 
 
 
-def compute_mesh_diameter(model_pts=None, mesh=None, n_sample=1000):
+def compute_mesh_diameter(model_pts=None, mesh=None, n_sample=1000, max_elems=2**24):
+  '''Largest pairwise distance among @n_sample random points, compared in row chunks so that at most @max_elems floats are alive at once
+  '''
   from sklearn.decomposition import TruncatedSVD
   if mesh is not None:
     u, s, vh = scipy.linalg.svd(mesh.vertices, full_matrices=False)
@@ -569,18 +1043,42 @@ def compute_mesh_diameter(model_pts=None, mesh=None, n_sample=1000):
   else:
     ids = np.random.choice(len(model_pts), size=min(n_sample, len(model_pts)), replace=False)
     pts = model_pts[ids]
-  dists = np.linalg.norm(pts[None]-pts[:,None], axis=-1)
-  diameter = dists.max()
+  chunk_size = max(1, max_elems//(3*len(pts)))
+  diameter = max(np.linalg.norm(pts[None]-pts[i:i+chunk_size,None], axis=-1).max() for i in range(0, len(pts), chunk_size))
   return diameter
 
 
+def compute_mesh_diameter_exact(model_pts=None, mesh=None, max_elems=2**24):
+  '''Exact diameter (largest pairwise distance). The farthest pair always lies on the convex hull, so only the hull vertices are compared, in row chunks so that at most @max_elems floats are alive at once
+  @model_pts: (N,3) np array
+  '''
+  from scipy.spatial import ConvexHull, QhullError
+  if mesh is not None:
+    model_pts = mesh.vertices
+  pts = np.asarray(model_pts, dtype=np.float64).reshape(-1,3)
+  if len(pts)<2:
+    return 0.0
+  try:
+    pts = pts[ConvexHull(pts).vertices]
+  except (QhullError, ValueError):   # Degenerate (e.g. planar) input, compare all unique points
+    pts = np.unique(pts, axis=0)
+  chunk_size = max(1, max_elems//(3*len(pts)))
+  diameter_sq = 0.0
+  for i in range(0, len(pts), chunk_size):
+    dists_sq = ((pts[i:i+chunk_size,None]-pts[None])**2).sum(axis=-1)
+    diameter_sq = max(diameter_sq, float(dists_sq.max()))
+  return float(np.sqrt(diameter_sq))
+
+
 def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, crop_ratio=1.2, out_size=None, rgb=None, uvs=None, method='min_box', mesh_diameter=None):
   '''Project the points and find the cropping transform
   @pts: (N,3)
   @poses: (B,4,4) tensor
   @min_box: min_box/min_circle
   @scale: scale to apply to the tightly enclosing roi
+  The transforms are on the device of @poses
   '''
+  device = poses.device
   def compute_tf_batch(left, right, top, bottom):
     B = len(left)
     left = left.round()
@@ -588,26 +1086,25 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
     top = top.round()
     bottom = bottom.round()
 
-    tf = torch.eye(3)[None].expand(B,-1,-1).contiguous()
+    tf = torch.eye(3, device=device)[None].expand(B,-1,-1).contiguous()
     tf[:,0,2] = -left
     tf[:,1,2] = -top
-    new_tf = torch.eye(3)[None].expand(B,-1,-1).contiguous()
+    new_tf = torch.eye(3, device=device)[None].expand(B,-1,-1).contiguous()
     new_tf[:,0,0] = out_size[0]/(right-left)
     new_tf[:,1,1] = out_size[1]/(bottom-top)
     tf = new_tf@tf
     return tf
 
   B = len(poses)
-  torch.set_default_tensor_type('torch.cuda.FloatTensor')
   if method=='box_3d':
-    radius = mesh_diameter*crop_ratio/2
+    radius = torch.as_tensor(mesh_diameter*crop_ratio/2, dtype=torch.float, device=device).reshape(-1,1,1)  # scalar or per-pose (B,)
     offsets = torch.tensor([0,0,0,
-                        radius,0,0,
-                        -radius,0,0,
-                        0,radius,0,
-                        0,-radius,0]).reshape(-1,3)
-    pts = poses[:,:3,3].reshape(-1,1,3)+offsets.reshape(1,-1,3)
-    K = torch.as_tensor(K)
+                        1,0,0,
+                        -1,0,0,
+                        0,1,0,
+                        0,-1,0], dtype=torch.float, device=device).reshape(1,-1,3)*radius
+    pts = poses[:,:3,3].reshape(-1,1,3)+offsets
+    K = torch.as_tensor(K, dtype=torch.float, device=device)
     projected = (K@pts.reshape(-1,3).T).T
     uvs = projected[:,:2]/projected[:,2:3]
     uvs = uvs.reshape(B, -1, 2)
@@ -626,6 +1123,53 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
   return tf
 
 
+def is_axis_aligned_tf(tfs):
+  '''Whether the (B,3,3) pixel transforms are scale plus translation only. One host sync
+  '''
+  return bool(((tfs[:,0,1]==0) & (tfs[:,1,0]==0) & (tfs[:,2,0]==0) & (tfs[:,2,1]==0) & (tfs[:,2,2]==1)).all().item())
+
+
+def crop_shared_images(images, tf_to_crops, dsize, mode='bilinear', axis_aligned=None, out=None):
+  '''Crop the same source images with B transforms, same output as kornia warp_perspective(align_corners=False) on the source expanded to B copies.
+  Axis aligned transforms (e.g. box_3d crops) are sampled with one grid_sample over the shared source, the B crop grids stacked along the height, so the source is never copied per crop. Other transforms fall back to kornia
+  @images: list of (C_i,H,W) tensors of the same H,W, fused into one sampling call
+  @tf_to_crops: (B,3,3) tensor, source pixel to crop pixel
+  @dsize: (h_out,w_out)
+  @axis_aligned: skip the check (and its sync) when the caller knows
+  @out: optional (B,sum C_i,h_out,w_out) float tensor the crops are written to, e.g. a WorkspaceArena buffer
+  Return: list of (B,C_i,h_out,w_out) tensors, views of @out if given
+  '''
+  channels = [image.shape[0] for image in images]
+  src = images[0][None] if len(images)==1 else torch.cat(images, dim=0)[None]
+  _,C,H,W = src.shape
+  B = len(tf_to_crops)
+  h_out, w_out = dsize
+  if axis_aligned is None:
+    axis_aligned = is_axis_aligned_tf(tf_to_crops)
+  if not axis_aligned:
+    crops = kornia.geometry.transform.warp_perspective(src.expand(B,-1,-1,-1), tf_to_crops, dsize=dsize, mode=mode, align_corners=False)
+    if out is None:
+      return list(torch.split(crops, channels, dim=1))
+    out.copy_(crops)
+    return list(torch.split(out, channels, dim=1))
+
+  # kornia normalizes pixels with 2/(size-1) before grid_sample(align_corners=False), replicated here for identical sampling
+  tfs = tf_to_crops.float()
+  xs = torch.arange(w_out, device=src.device, dtype=torch.float)[None]
+  ys = torch.arange(h_out, device=src.device, dtype=torch.float)[None]
+  src_xs = (xs-tfs[:,0,2:3])/tfs[:,0,0:1]   #(B,w_out)
+  src_ys = (ys-tfs[:,1,2:3])/tfs[:,1,1:2]   #(B,h_out)
+  grid_xs = src_xs*2/(W-1 if W>1 else 1e-14)-1
+  grid_ys = src_ys*2/(H-1 if H>1 else 1e-14)-1
+  grid = torch.stack([grid_xs[:,None,:].expand(-1,h_out,-1), grid_ys[:,:,None].expand(-1,-1,w_out)], dim=-1).reshape(1,B*h_out,w_out,2)
+  crops = F.grid_sample(src.float(), grid, mode=mode, padding_mode='zeros', align_corners=False).reshape(C,B,h_out,w_out).permute(1,0,2,3)   #(B,C,h_out,w_out) view
+  if out is None:
+    out = crops.contiguous()
+  else:
+    out.copy_(crops)
+  return list(torch.split(out, channels, dim=1))
+
+
 
 def cv_draw_text(img,text,uv_top_left,color=(255, 255, 255),fontScale=0.5,thickness=1,fontFace=cv2.FONT_HERSHEY_SIMPLEX,outline_color=None,line_spacing=1.5):
   H,W = img.shape[:2]
@@ -803,6 +1347,107 @@ def projection_matrix_from_intrinsics(K, height, width, znear, zfar, window_coor
 
 
 
+def acosf(x):
+  '''float32 acos of the C math library, as std::acos(float) in mycpp, np.arccos if that library can not be loaded
+  '''
+  global _acosf
+  if '_acosf' not in globals():
+    try:
+      import ctypes,ctypes.util
+      _acosf = ctypes.CDLL(ctypes.util.find_library('m')).acosf
+      _acosf.restype = ctypes.c_float
+      _acosf.argtypes = [ctypes.c_float]
+    except Exception:
+      _acosf = None
+  if _acosf is None:
+    return np.arccos(np.float32(x))
+  return np.float32(_acosf(float(x)))
+
+
+def acosf_cos_thres(radian_thres):
+  '''Largest float32 c with acosf(c)>=@radian_thres. acosf is non increasing, so for a float32 x, acosf(x)<radian_thres iff x>c
+  @radian_thres: np.float32
+  '''
+  one = np.float32(1)
+  if acosf(-one)<radian_thres:
+    return np.float32(-np.inf)
+  if acosf(one)>=radian_thres:
+    return np.float32(np.inf)
+  c = np.float32(np.cos(radian_thres))
+  while acosf(c)<radian_thres:
+    c = np.nextafter(c, -one)
+  while acosf(np.nextafter(c, one))>=radian_thres:
+    c = np.nextafter(c, one)
+  return c
+
+
+def cluster_poses_torch(angle_diff, dist_diff, poses_in, symmetry_tfs, device='cpu', chunk_size=4096):
+  '''Vectorized version of mycpp.cluster_poses, gives the same greedy result.
+  A pose is kept if no earlier kept pose is within @dist_diff translation and @angle_diff rotation under any symmetry.
+  The pairwise closeness is computed as batched matrix ops, only the greedy pass over the boolean matrix is sequential.
+  Grids with 30 deg in-plane steps have pairs exactly at the 30 deg threshold, so the pairs near it are redone as Utils::rotationGeodesicDistance computes them in float32:
+  the sums in the order of Eigen 3.4 without FMA, and acosf(cos)<thres as cos>acosf_cos_thres(thres).
+  A mycpp built with FMA (-march flags) or another Eigen summation order may still flip such ties
+  @angle_diff: degree
+  @dist_diff: meter
+  @poses_in: (N,4,4) np array
+  @symmetry_tfs: (S,4,4) np array
+  '''
+  poses = torch.as_tensor(np.asarray(poses_in), dtype=torch.float, device=device)
+  tfs = torch.as_tensor(np.asarray(symmetry_tfs), dtype=torch.float, device=device)
+  N = len(poses)
+  S = len(tfs)
+  radian_thres = np.float32(float(np.float32(angle_diff))/180.0*np.pi)
+  cos_thres = float(acosf_cos_thres(radian_thres))
+  dist_thres = float(np.float32(dist_diff))
+  R = poses[:,:3,:3]
+  t = poses[:,:3,3]
+  R_flat = R.reshape(N,9)
+  tf = tfs[:,:3,:3]
+  close = torch.zeros((N,N), dtype=torch.bool, device=device)   # close[i,j]: pose i is within the thresholds of pose j
+  rows_per_chunk = max(1, chunk_size//S)
+  for b in range(0, N, rows_per_chunk):
+    Ri = R[b:b+rows_per_chunk,None]   #(n,1,3,3)
+    R_sym = (Ri[...,:,0:1]*tf[None,:,0:1,:] + Ri[...,:,1:2]*tf[None,:,1:2,:]) + Ri[...,:,2:3]*tf[None,:,2:3,:]   #(n,S,3,3) R_i R_tf, the 4th term of the 4x4 product is 0
+    cos = ((R_sym.reshape(-1,9)@R_flat.T).reshape(-1,S,N)-1)/2   # trace(R_i R_tf R_j^T), off by a few ulp
+    near = (cos-cos_thres).abs()<1e-4
+    if near.any():   # Redo the pairs near the threshold in the C++ order
+      i_row, i_sym, j = near.nonzero(as_tuple=True)
+      p = R_sym[i_row,i_sym]*R[j]   #(M,3,3)
+      diag = p[:,:,0] + (p[:,:,1] + p[:,:,2])
+      cos[i_row,i_sym,j] = ((diag[:,0] + (diag[:,1] + diag[:,2]))-1)/2
+    rot_close = (cos>cos_thres).any(dim=1)   #(n,N)
+    dt = t[b:b+rows_per_chunk,None]-t[None]
+    sq = dt*dt
+    trans_close = torch.sqrt(sq[...,0] + (sq[...,1] + sq[...,2]))<dist_thres
+    close[b:b+rows_per_chunk] = rot_close & trans_close
+
+  close = close.data.cpu().numpy()
+  kept = np.zeros((N), dtype=bool)
+  kept[0] = True
+  for i in range(1,N):
+    if not (close[i] & kept).any():
+      kept[i] = True
+  logging.info(f"num original candidates = {N}, num of pose after clustering: {kept.sum()}")
+  return np.asarray(poses_in)[kept]
+
+
+def cluster_poses(angle_diff, dist_diff, poses_in, symmetry_tfs, backend='auto'):
+  '''
+  @backend: cpp uses the mycpp extension, torch uses cluster_poses_torch, auto picks cpp if it is built
+  '''
+  if backend=='auto':
+    backend = 'cpp' if mycpp is not None else 'torch'
+  if backend=='cpp':
+    if mycpp is None:
+      raise RuntimeError("mycpp is not built, use backend='torch'")
+    return np.asarray(mycpp.cluster_poses(angle_diff, dist_diff, poses_in, symmetry_tfs))
+  elif backend=='torch':
+    return cluster_poses_torch(angle_diff, dist_diff, poses_in, symmetry_tfs)
+  else:
+    raise NotImplementedError(backend)
+
+
 def symmetry_tfs_from_info(info, rot_angle_discrete=5):
   symmetry_tfs = [np.eye(4)]
   if 'symmetries_discrete' in info:
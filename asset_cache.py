@@ -0,0 +1,213 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,json,hashlib,uuid,shutil,logging
+import numpy as np
+import trimesh
+from PIL import Image
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(code_dir)
+from Utils import compute_mesh_diameter, compute_mesh_diameter_exact, toOpen3dCloud, make_rotation_grid_candidates, cluster_poses
+
+
+ASSET_BUNDLE_VERSION = 3
+
+
+def mesh_content_hash(mesh, model_normals=None, extra=None):
+  '''Key of the object asset bundle, changes whenever the geometry, appearance or the given normals change
+  @extra: optional str/dict of settings that affect the bundle
+  '''
+  h = hashlib.sha1()
+  h.update(f'v{ASSET_BUNDLE_VERSION}'.encode())
+  h.update(np.ascontiguousarray(mesh.vertices, dtype=np.float64).tobytes())
+  h.update(np.ascontiguousarray(mesh.faces, dtype=np.int64).tobytes())
+  if model_normals is not None:
+    h.update(np.ascontiguousarray(model_normals, dtype=np.float64).tobytes())
+  if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals):
+    h.update(np.ascontiguousarray(mesh.visual.uv, dtype=np.float64).tobytes())
+    h.update(np.asarray(mesh.visual.material.image.convert('RGB')).tobytes())
+  elif mesh.visual.vertex_colors is not None:
+    h.update(np.ascontiguousarray(mesh.visual.vertex_colors).tobytes())
+  if extra is not None:
+    h.update(json.dumps(extra, sort_keys=True).encode())
+  return h.hexdigest()
+
+
+def make_object_assets(mesh, model_normals, diameter_method='sampled'):
+  '''Everything FoundationPose.reset_object derives from a mesh, as plain arrays
+  @mesh: trimesh, not centered
+  @model_normals: (N,3) np array, per vertex normals used for the downsampled model cloud
+  @diameter_method: sampled, compute_mesh_diameter of 10000 random vertices as the networks were run with, or exact, see compute_mesh_diameter_exact
+  '''
+  max_xyz = mesh.vertices.max(axis=0)
+  min_xyz = mesh.vertices.min(axis=0)
+  model_center = (min_xyz+max_xyz)/2
+  vertices = mesh.vertices - model_center.reshape(1,3)
+  if diameter_method=='sampled':
+    diameter = compute_mesh_diameter(model_pts=mesh.vertices, n_sample=10000)
+  elif diameter_method=='exact':
+    diameter = compute_mesh_diameter_exact(model_pts=vertices)
+  else:
+    raise RuntimeError(f'unknown diameter_method {diameter_method}')
+  vox_size = max(diameter/20.0, 0.003)
+  pcd = toOpen3dCloud(vertices, normals=model_normals)
+  pcd = pcd.voxel_down_sample(vox_size)
+  pts = np.asarray(pcd.points)
+  normals = np.asarray(pcd.normals)
+
+  assets = {
+    'model_center': model_center,
+    'vertices': np.ascontiguousarray(vertices),
+    'faces': np.ascontiguousarray(mesh.faces),
+    'vertex_normals': np.ascontiguousarray(mesh.vertex_normals),
+    'pts': pts,
+    'normals': normals,
+    'bounds': np.stack([pts.min(axis=0), pts.max(axis=0)], axis=0),
+    'diameter': float(diameter),
+    'vox_size': float(vox_size),
+  }
+  if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals):
+    assets['uv'] = np.ascontiguousarray(mesh.visual.uv)
+    assets['tex'] = np.array(mesh.visual.material.image.convert('RGB'), dtype=np.uint8)
+  elif mesh.visual.vertex_colors is not None:
+    assets['vertex_colors'] = np.ascontiguousarray(mesh.visual.vertex_colors)
+  return assets
+
+
+def mesh_from_assets(assets):
+  '''Rebuild the centered trimesh. The arrays are copied since trimesh may modify them
+  '''
+  mesh = trimesh.Trimesh(vertices=np.array(assets['vertices']), faces=np.array(assets['faces']), vertex_normals=np.array(assets['vertex_normals']), process=False)
+  if 'tex' in assets:
+    mesh.visual = trimesh.visual.texture.TextureVisuals(uv=np.array(assets['uv']), image=Image.fromarray(np.array(assets['tex'])))
+  elif 'vertex_colors' in assets:
+    mesh.visual.vertex_colors = np.array(assets['vertex_colors'])
+  return mesh
+
+
+class ObjectAssetCache:
+  '''On-disk object asset bundles keyed by mesh content, one directory of .npy per object so that the arrays are memory mapped on load
+  '''
+  def __init__(self, cache_dir):
+    self.cache_dir = cache_dir
+    os.makedirs(self.cache_dir, exist_ok=True)
+    self.n_hit = 0
+    self.n_miss = 0
+
+
+  def get_bundle_dir(self, key):
+    return f'{self.cache_dir}/{key}'
+
+
+  def load(self, key):
+    bundle_dir = self.get_bundle_dir(key)
+    meta_file = f'{bundle_dir}/meta.json'
+    if not os.path.exists(meta_file):
+      return None
+    with open(meta_file,'r') as ff:
+      meta = json.load(ff)
+    if meta.get('version')!=ASSET_BUNDLE_VERSION:
+      return None
+    assets = {}
+    for name in meta['arrays']:
+      assets[name] = np.load(f'{bundle_dir}/{name}.npy', mmap_mode='r')
+    assets.update(meta['scalars'])
+    mesh_file = f'{bundle_dir}/mesh.obj'
+    assets['mesh_path'] = mesh_file if os.path.exists(mesh_file) else None
+    return assets
+
+
+  def save(self, key, assets, mesh=None):
+    '''Write to a temporary dir first and rename, so that concurrent workers never see a partial bundle
+    @mesh: optional centered trimesh, exported along the bundle
+    '''
+    bundle_dir = self.get_bundle_dir(key)
+    tmp_dir = f'{bundle_dir}.tmp-{uuid.uuid4()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    meta = {'version': ASSET_BUNDLE_VERSION, 'arrays': [], 'scalars': {}}
+    for name, value in assets.items():
+      if isinstance(value, np.ndarray):
+        np.save(f'{tmp_dir}/{name}.npy', value)
+        meta['arrays'].append(name)
+      else:
+        meta['scalars'][name] = value
+    if mesh is not None:
+      mesh.export(f'{tmp_dir}/mesh.obj')
+    with open(f'{tmp_dir}/meta.json','w') as ff:
+      json.dump(meta, ff)
+    try:
+      os.rename(tmp_dir, bundle_dir)
+    except OSError:   # Another worker finished first
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+    return self.load(key)
+
+
+  def get_or_create(self, mesh, model_normals, diameter_method='sampled'):
+    key = mesh_content_hash(mesh, model_normals, extra={'diameter_method': diameter_method})
+    assets = self.load(key)
+    if assets is not None:
+      self.n_hit += 1
+      logging.info(f'asset bundle hit {key}')
+      return assets
+    self.n_miss += 1
+    logging.info(f'asset bundle miss {key}, building')
+    assets = make_object_assets(mesh, model_normals, diameter_method=diameter_method)
+    return self.save(key, assets, mesh=mesh_from_assets(assets))
+
+
+
+def rotation_grid_key(min_n_views, inplane_step, angle_diff, dist_diff, symmetry_tfs):
+  symmetry_tfs = np.round(np.asarray(symmetry_tfs, dtype=np.float64).reshape(-1,4,4), decimals=6)
+  h = hashlib.sha1()
+  h.update(f'{min_n_views}_{inplane_step}_{angle_diff}_{dist_diff}'.encode())
+  h.update(np.ascontiguousarray(symmetry_tfs).tobytes())
+  return h.hexdigest()
+
+
+class RotationGridCache:
+  '''Clustered rotation grids keyed by the grid settings and the symmetry set. Kept in memory, and on disk if @cache_dir is given
+  '''
+  def __init__(self, cache_dir=None):
+    self.cache_dir = cache_dir
+    if self.cache_dir is not None:
+      os.makedirs(self.cache_dir, exist_ok=True)
+    self.grids = {}
+    self.n_hit = 0
+    self.n_miss = 0
+
+
+  def get_or_create(self, min_n_views, inplane_step, symmetry_tfs, angle_diff=30, dist_diff=99999, cluster_backend='auto'):
+    '''
+    @symmetry_tfs: (S,4,4) np array
+    Return: (N,4,4) np array, ob_in_cam rotations
+    '''
+    key = rotation_grid_key(min_n_views, inplane_step, angle_diff, dist_diff, symmetry_tfs)
+    if key in self.grids:
+      self.n_hit += 1
+      return self.grids[key]
+    grid_file = None
+    if self.cache_dir is not None:
+      grid_file = f'{self.cache_dir}/{key}.npy'
+      if os.path.exists(grid_file):
+        self.n_hit += 1
+        self.grids[key] = np.load(grid_file)
+        logging.info(f'rot_grid loaded from {grid_file}')
+        return self.grids[key]
+
+    self.n_miss += 1
+    rot_grid = make_rotation_grid_candidates(min_n_views=min_n_views, inplane_step=inplane_step)
+    logging.info(f"rot_grid:{rot_grid.shape}")
+    rot_grid = cluster_poses(angle_diff, dist_diff, rot_grid, symmetry_tfs, backend=cluster_backend)
+    logging.info(f"after cluster, rot_grid:{rot_grid.shape}")
+    self.grids[key] = rot_grid
+    if grid_file is not None:
+      tmp_file = f'{grid_file}.tmp-{uuid.uuid4()}.npy'
+      np.save(tmp_file, rot_grid)
+      os.replace(tmp_file, grid_file)
+    return rot_grid
@@ -0,0 +1,82 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,time,argparse
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from Utils import *
+
+
+def make_box_3d_tfs(B, H, W, out_size, device):
+  '''Random scale plus translation crops like compute_crop_window_tf_batch(method='box_3d')
+  '''
+  radius = torch.rand(B, device=device)*min(H,W)/4+20
+  uc = torch.rand(B, device=device)*W
+  vc = torch.rand(B, device=device)*H
+  tfs = torch.eye(3, device=device)[None].repeat(B,1,1)
+  left = (uc-radius).round()
+  top = (vc-radius).round()
+  right = (uc+radius).round()
+  bottom = (vc+radius).round()
+  tfs[:,0,0] = out_size/(right-left)
+  tfs[:,1,1] = out_size/(bottom-top)
+  tfs[:,0,2] = -left*tfs[:,0,0]
+  tfs[:,1,2] = -top*tfs[:,1,1]
+  return tfs
+
+
+def run_timed(fn, n_repeat, device):
+  fn()
+  if device=='cuda':
+    torch.cuda.synchronize()
+  begin = time.perf_counter()
+  for _ in range(n_repeat):
+    out = fn()
+  if device=='cuda':
+    torch.cuda.synchronize()
+  return out, (time.perf_counter()-begin)/n_repeat
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--H', type=int, default=720)
+  parser.add_argument('--W', type=int, default=1280)
+  parser.add_argument('--out_size', type=int, default=160)
+  parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 64, 252])
+  parser.add_argument('--n_repeat', type=int, default=10)
+  parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+  args = parser.parse_args()
+
+  H, W, device = args.H, args.W, args.device
+  rgb = torch.rand(3,H,W, device=device)*255
+  xyz_map = torch.rand(3,H,W, device=device)
+  normal_map = torch.rand(3,H,W, device=device)
+  dsize = (args.out_size, args.out_size)
+
+  print(f"{'B':>5} | {'kornia(ms)':>10} | {'roi(ms)':>8} | {'speedup':>7} | {'max diff rgb':>12} {'xyz mismatch':>12}")
+  # Nearest sampling may pick the other neighbor on exact half pixel ties because of float rounding, hence the mismatch ratio for xyz/normal
+  for B in args.batch_sizes:
+    tfs = make_box_3d_tfs(B, H, W, args.out_size, device)
+
+    def run_kornia():
+      rgbBs = kornia.geometry.transform.warp_perspective(rgb[None].expand(B,-1,-1,-1), tfs, dsize=dsize, mode='bilinear', align_corners=False)
+      xyz_mapBs = kornia.geometry.transform.warp_perspective(xyz_map[None].expand(B,-1,-1,-1), tfs, dsize=dsize, mode='nearest', align_corners=False)
+      normalBs = kornia.geometry.transform.warp_perspective(normal_map[None].expand(B,-1,-1,-1), tfs, dsize=dsize, mode='nearest', align_corners=False)
+      return rgbBs, xyz_mapBs, normalBs
+
+    def run_roi():
+      rgbBs = crop_shared_images([rgb], tfs, dsize=dsize, mode='bilinear', axis_aligned=True)[0]
+      xyz_mapBs, normalBs = crop_shared_images([xyz_map, normal_map], tfs, dsize=dsize, mode='nearest', axis_aligned=True)
+      return rgbBs, xyz_mapBs, normalBs
+
+    ref, t_kornia = run_timed(run_kornia, args.n_repeat, device)
+    out, t_roi = run_timed(run_roi, args.n_repeat, device)
+    diff_rgb = (ref[0]-out[0]).abs().max().item()
+    diff_xyz = max((ref[1]!=out[1]).float().mean().item(), (ref[2]!=out[2]).float().mean().item())
+    print(f"{B:>5} | {t_kornia*1000:>10.2f} | {t_roi*1000:>8.2f} | {t_kornia/t_roi:>7.2f} | {diff_rgb:>12.2e} {diff_xyz:>12.2e}")
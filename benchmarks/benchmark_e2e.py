@@ -0,0 +1,278 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''End to end latency on synthetic scenes, no dataset needed: reset_object, register for each rotation grid size and iteration count, and track_one sequences.
+Per stage: p50/p95/p99 latency, throughput, peak memory above the stage start, pose errors against the rendered poses and the tracing spans inside. Written as JSON, --compare prints the p50 change against an earlier result
+'''
+
+import os,sys,time,argparse,json,datetime,subprocess,threading,tempfile
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from estimater import *
+from synthetic_scene import *
+
+
+def sync(device):
+  if torch.device(device).type=='cuda':
+    torch.cuda.synchronize()
+
+
+class StageMemory:
+  '''Peak memory of a stage above its level at start(): allocated device memory on cuda, off cuda the process RSS polled by a background thread, since ru_maxrss is a process lifetime high-water mark that cannot be reset
+  '''
+  def __init__(self, device, interval=0.002):
+    self.cuda = torch.device(device).type=='cuda'
+    self.interval = interval
+    self.page_size = os.sysconf('SC_PAGE_SIZE')
+    self.thread = None
+
+
+  def get_rss(self):
+    try:
+      with open('/proc/self/statm','r') as ff:
+        return int(ff.read().split()[1])*self.page_size
+    except OSError:
+      return psutil.Process().memory_info().rss
+
+
+  def poll(self):
+    while not self.stop_event.wait(self.interval):
+      self.peak = max(self.peak, self.get_rss())
+
+
+  def start(self):
+    if self.cuda:
+      self.baseline = torch.cuda.memory_allocated()
+      torch.cuda.reset_peak_memory_stats()
+      return
+    self.stop()
+    self.baseline = self.get_rss()
+    self.peak = self.baseline
+    self.stop_event = threading.Event()
+    self.thread = threading.Thread(target=self.poll, daemon=True)
+    self.thread.start()
+
+
+  def stop(self):
+    '''
+    Return: MB above the level at start()
+    '''
+    if self.cuda:
+      return (torch.cuda.max_memory_allocated()-self.baseline)/1e6
+    if self.thread is None:
+      return 0.0
+    self.stop_event.set()
+    self.thread.join()
+    self.thread = None
+    self.peak = max(self.peak, self.get_rss())
+    return (self.peak-self.baseline)/1e6
+
+
+def summarize(times, memory, n_items=1, errors=None):
+  '''
+  @times: seconds per call
+  @memory: StageMemory started at the beginning of the stage
+  @n_items: work items per call, e.g. hypotheses, for the item throughput
+  '''
+  times = np.asarray(times)
+  out = {
+    'n': len(times),
+    'mean': float(times.mean()),
+    'p50': float(np.percentile(times, 50)),
+    'p95': float(np.percentile(times, 95)),
+    'p99': float(np.percentile(times, 99)),
+    'max': float(times.max()),
+    'calls_per_s': float(len(times)/times.sum()),
+    'items_per_s': float(len(times)*n_items/times.sum()),
+    'peak_memory_mb': memory.stop(),
+  }
+  if errors is not None and len(errors)>0:
+    errors = np.asarray(errors)
+    out['rot_err_deg_median'] = float(np.median(errors[:,0]))
+    out['trans_err_mm_median'] = float(np.median(errors[:,1])*1000)
+    out['rot_err_deg_max'] = float(errors[:,0].max())
+    out['trans_err_mm_max'] = float(errors[:,1].max()*1000)
+  spans = get_tracer().get_stats()
+  out['spans'] = {name: {k: stat[k] for k in ['n', 'total', 'mean', 'p50', 'p90', 'p99', 'max']} for name, stat in spans.items()}
+  return out
+
+
+def timed(fn, device):
+  sync(device)
+  begin = time.perf_counter()
+  out = fn()
+  sync(device)
+  return out, time.perf_counter()-begin
+
+
+def bench_reset_object(est, mesh, args):
+  times = []
+  memory = StageMemory(args.device)
+  for i in range(args.n_warmup+args.n_reset):
+    if i==args.n_warmup:
+      memory.start()
+      get_tracer().reset()
+    _, t = timed(lambda: est.reset_object(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh), args.device)
+    if i>=args.n_warmup:
+      times.append(t)
+  return summarize(times, memory)
+
+
+def bench_register(est, scene, poses_gt, frames, iteration, args):
+  times = []
+  errors = []
+  memory = StageMemory(args.device)
+  for i in range(args.n_warmup+len(frames)):
+    if i==args.n_warmup:
+      memory.start()
+      get_tracer().reset()
+    rgb, depth, mask = frames[i%len(frames)]
+    pose, t = timed(lambda: est.register(K=scene.K, rgb=rgb, depth=depth, ob_mask=mask, iteration=iteration), args.device)
+    if i>=args.n_warmup:
+      times.append(t)
+      errors.append(pose_errors(pose, poses_gt[i%len(frames)]))
+  return summarize(times, memory, n_items=len(est.rot_grid), errors=errors)
+
+
+def bench_track(est, scene, poses_gt, frames, args):
+  '''Registers the first frame, then tracks the others
+  '''
+  rgb, depth, mask = frames[0]
+  est.register(K=scene.K, rgb=rgb, depth=depth, ob_mask=mask, iteration=args.register_iters[-1])
+  memory = StageMemory(args.device)
+  memory.start()
+  get_tracer().reset()
+  times = []
+  errors = []
+  modes = {}
+  for i in range(1, len(frames)):
+    rgb, depth, _ = frames[i]
+    pose, t = timed(lambda: est.track_one(rgb=rgb, depth=depth, K=scene.K, iteration=args.track_iter), args.device)
+    if i>args.n_warmup:
+      times.append(t)
+    errors.append(pose_errors(pose, poses_gt[i]))
+    mode = est.track_stats['mode']
+    if est.track_stats.get('relocalized', False):
+      mode = f'{mode}+relocalize'
+    modes[mode] = modes.get(mode, 0)+1
+  out = summarize(times, memory, errors=errors)
+  out['modes'] = modes
+  return out
+
+
+def get_git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=code_dir, capture_output=True, text=True, check=True).stdout.strip()
+  except Exception:
+    return None
+
+
+def compare(results, old_file):
+  with open(old_file,'r') as ff:
+    old = json.load(ff)
+  print(f"{'stage':<40} | {'p50 old ms':>10} | {'p50 new ms':>10} | {'change':>8} | {'peak old MB':>11} | {'peak new MB':>11}")
+  for name, stat in results['stages'].items():
+    if name not in old['stages']:
+      continue
+    p50_old = old['stages'][name]['p50']
+    print(f"{name:<40} | {p50_old*1000:>10.2f} | {stat['p50']*1000:>10.2f} | {(stat['p50']/p50_old-1)*100:>7.1f}% | {old['stages'][name]['peak_memory_mb']:>11.1f} | {stat['peak_memory_mb']:>11.1f}")
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--mesh_file', type=str, default=None, help="default the synthetic mesh of synthetic_scene.py")
+  parser.add_argument('--H', type=int, default=480)
+  parser.add_argument('--W', type=int, default=640)
+  parser.add_argument('--rot_grids', type=str, nargs='+', default=['40,60', '20,90'], help="min_n_views,inplane_step of the rotation grids to register with")
+  parser.add_argument('--register_iters', type=int, nargs='+', default=[1, 5])
+  parser.add_argument('--n_register', type=int, default=5, help="frames registered per setting")
+  parser.add_argument('--n_reset', type=int, default=5)
+  parser.add_argument('--n_track', type=int, default=100, help="frames of the tracking sequence")
+  parser.add_argument('--track_iter', type=int, default=2)
+  parser.add_argument('--n_warmup', type=int, default=1, help="calls per stage excluded from the stats")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--device', type=str, default='cuda')
+  parser.add_argument('--weights_dir', type=str, default=None)
+  parser.add_argument('--weight_store_dir', type=str, default=None)
+  parser.add_argument('--lod', type=int, default=0)
+  parser.add_argument('--template_bank', type=int, default=0)
+  parser.add_argument('--depth_roi', type=int, default=0)
+  parser.add_argument('--motion_prior', type=int, default=0)
+  parser.add_argument('--icp', type=int, default=0)
+  parser.add_argument('--track_check', type=int, default=0, help="check every tracked pose and relocalize when lost")
+  parser.add_argument('--n_track_jumps', type=int, default=0, help="sudden jumps of the object in the tracking sequence, to lose the track")
+  parser.add_argument('--trace_sync', type=int, default=0, help="synchronize the device at the span boundaries")
+  parser.add_argument('--out_file', type=str, default=f'{code_dir}/results/e2e_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
+  parser.add_argument('--compare', type=str, default=None, help="earlier result json")
+  args = parser.parse_args()
+
+  set_logging_format(logging.WARNING)
+  set_seed(args.seed)
+  device = args.device
+  rng = np.random.default_rng(args.seed)
+  if args.mesh_file is not None:
+    mesh = trimesh.load(args.mesh_file)
+  else:
+    mesh = make_synthetic_mesh()
+  diameter = float(np.linalg.norm(np.ptp(mesh.vertices, axis=0)))
+  scene = SyntheticScene(mesh, H=args.H, W=args.W, seed=args.seed, device=device)
+  begin = time.perf_counter()
+  register_poses = make_random_poses(args.n_register, distance=(diameter*4, diameter*6), K=scene.K, H=args.H, W=args.W, rng=rng)
+  register_frames = scene.render_sequence(register_poses)
+  jump_frames = np.linspace(0, args.n_track, args.n_track_jumps+2).round().astype(int)[1:-1].tolist()
+  track_poses = make_trajectory(register_poses[0], args.n_track+1, rng, jump_frames=jump_frames, jump_trans=diameter*0.3)
+  track_frames = scene.render_sequence(track_poses)
+  print(f'{len(register_frames)+len(track_frames)} frames rendered in {time.perf_counter()-begin:.2f}s')
+
+  scorer = ScorePredictor(device=device, weights_dir=args.weights_dir, weight_store_dir=args.weight_store_dir)
+  refiner = PoseRefinePredictor(device=device, weights_dir=args.weights_dir, weight_store_dir=args.weight_store_dir)
+  debug_dir = tempfile.mkdtemp()
+  est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, debug_dir=debug_dir, debug=0, glctx=scene.glctx, device=device)
+  est.set_mem_budget()
+  est.set_depth_roi_mode(enabled=args.depth_roi)
+  est.set_lod_mode(enabled=args.lod)
+  est.set_template_bank_mode(enabled=args.template_bank)
+  est.set_tracker_mode(motion_prior=args.motion_prior)
+  est.set_icp_mode(enabled=args.icp)
+  est.set_track_check_mode(enabled=args.track_check)
+  get_tracer().enable(sync_cuda=args.trace_sync)
+
+  results = {
+    'meta': {
+      'time': datetime.datetime.now().isoformat(),
+      'git_commit': get_git_commit(),
+      'torch': torch.__version__,
+      'device': torch.cuda.get_device_name() if torch.device(device).type=='cuda' else f'cpu, {torch.get_num_threads()} threads',
+      'args': vars(args),
+    },
+    'stages': {},
+  }
+  stages = results['stages']
+  stages['reset_object'] = bench_reset_object(est, mesh, args)
+  for rot_grid in args.rot_grids:
+    min_n_views, inplane_step = map(int, rot_grid.split(','))
+    est.make_rotation_grid(min_n_views=min_n_views, inplane_step=inplane_step)
+    for iteration in args.register_iters:
+      name = f'register_views{min_n_views}_inplane{inplane_step}_iter{iteration}'
+      stages[name] = bench_register(est, scene, register_poses, register_frames, iteration, args)
+      stages[name]['n_hypotheses'] = len(est.rot_grid)
+  stages[f'track_one_iter{args.track_iter}'] = bench_track(est, scene, track_poses, track_frames, args)
+
+  print(f"{'stage':<40} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8} | {'calls/s':>8} | {'peak MB':>8} | {'rot err':>7} | {'trans mm':>8}")
+  for name, stat in stages.items():
+    rot_err = f"{stat['rot_err_deg_median']:.2f}" if 'rot_err_deg_median' in stat else '-'
+    trans_err = f"{stat['trans_err_mm_median']:.2f}" if 'trans_err_mm_median' in stat else '-'
+    print(f"{name:<40} | {stat['p50']*1000:>8.2f} | {stat['p95']*1000:>8.2f} | {stat['p99']*1000:>8.2f} | {stat['calls_per_s']:>8.2f} | {stat['peak_memory_mb']:>8.1f} | {rot_err:>7} | {trans_err:>8}")
+
+  os.makedirs(os.path.dirname(os.path.realpath(args.out_file)), exist_ok=True)
+  with open(args.out_file,'w') as ff:
+    json.dump(results, ff, indent=2)
+  print(f'results written to {args.out_file}')
+  if args.compare is not None:
+    compare(results, args.compare)
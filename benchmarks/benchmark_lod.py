@@ -0,0 +1,70 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Size, crop render time and render error of each level of detail of make_mesh_lods against the full mesh
+'''
+
+import os,sys,time,argparse
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from Utils import *
+from benchmark_render_backend import run_timed
+
+
+def mesh_tensors_bytes(mesh_tensors):
+  return sum(v.numel()*v.element_size() for v in mesh_tensors.values())
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--mesh_file', type=str, default=f'{code_dir}/../demo_data/mustard0/mesh/textured_simple.obj')
+  parser.add_argument('--H', type=int, default=480)
+  parser.add_argument('--W', type=int, default=640)
+  parser.add_argument('--out_size', type=int, default=160)
+  parser.add_argument('--B', type=int, default=252, help="hypotheses per render call")
+  parser.add_argument('--pixels_per_face', type=float, nargs='+', default=[4, 1])
+  parser.add_argument('--max_tex_sizes', type=int, nargs='+', default=[256, 512])
+  parser.add_argument('--n_repeat', type=int, default=5)
+  parser.add_argument('--device', type=str, default='cuda')
+  args = parser.parse_args()
+
+  device = args.device
+  H, W = args.H, args.W
+  K = np.array([[600,0,W/2],[0,600,H/2],[0,0,1]])
+  mesh = trimesh.load(args.mesh_file)
+  mesh.vertices = mesh.vertices-mesh.vertices.mean(axis=0).reshape(1,3)
+  diameter = float(np.linalg.norm(np.ptp(mesh.vertices, axis=0)))
+  glctx = make_render_backend(device=device)
+
+  begin = time.perf_counter()
+  lods = make_mesh_lods(mesh, render_size=(args.out_size, args.out_size), pixels_per_face=args.pixels_per_face, max_tex_sizes=args.max_tex_sizes, device=device)
+  print(f'lods built in {time.perf_counter()-begin:.2f}s')
+  full = make_mesh_tensors(mesh, device=device)
+
+  poses = torch.eye(4, device=device)[None].repeat(args.B,1,1)
+  poses[:,:3,:3] = so3_exp_map((torch.rand(args.B,3, device=device)-0.5)*2*np.pi)
+  poses[:,:3,3] = torch.tensor([0,0,diameter*3], device=device)
+  tf_to_crops = compute_crop_window_tf_batch(H=H, W=W, poses=poses, K=K, crop_ratio=1.2, out_size=(args.out_size, args.out_size), method='box_3d', mesh_diameter=diameter)
+  bbox2d_crop = torch.as_tensor(np.array([0, 0, args.out_size-1, args.out_size-1]).reshape(2,2), device=device, dtype=torch.float)
+  bbox2d = transform_pts(bbox2d_crop, tf_to_crops.inverse()[:,None]).reshape(-1,4)
+
+  def render(mesh_tensors):
+    return nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses, glctx=glctx, mesh_tensors=mesh_tensors, output_size=(args.out_size, args.out_size), bbox2d=bbox2d, use_light=True, extra={})
+
+  color_ref, depth_ref, _ = render(full)
+  print(f"{'level':>5} | {'faces':>8} | {'tex':>9} | {'MB':>8} | {'ms':>8} | {'hypo/s':>8} | {'color err':>9} | {'depth err mm':>12} | {'coverage':>8}")
+  for level, mesh_tensors in [('full', full)]+list(enumerate(lods)):
+    t = run_timed(lambda: render(mesh_tensors), args.n_repeat, device)
+    color, depth, _ = render(mesh_tensors)
+    both = (depth>0) & (depth_ref>0)
+    color_err = (color-color_ref).abs().mean(dim=-1)[both].mean().item()
+    depth_err = (depth-depth_ref).abs()[both].mean().item()*1000
+    coverage = ((depth>0)!=(depth_ref>0)).float().mean().item()
+    tex = 'x'.join(map(str, mesh_tensors['tex'].shape[1:3])) if 'tex' in mesh_tensors else '-'
+    print(f"{level:>5} | {len(mesh_tensors['faces']):>8} | {tex:>9} | {mesh_tensors_bytes(mesh_tensors)/1e6:>8.2f} | {t*1000:>8.2f} | {args.B/t:>8.1f} | {color_err:>9.4f} | {depth_err:>12.4f} | {coverage:>8.4f}")
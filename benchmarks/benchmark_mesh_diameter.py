@@ -0,0 +1,55 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,time,argparse,tracemalloc
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from Utils import *
+
+
+def run_timed(fn):
+  '''Return (output, seconds, peak numpy/python allocation in MB)
+  '''
+  tracemalloc.start()
+  begin = time.perf_counter()
+  out = fn()
+  elapsed = time.perf_counter()-begin
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return out, elapsed, peak/1e6
+
+
+def make_synthetic_pts(n_pts, seed=0):
+  '''Noisy ellipsoid surface, hull size grows with n_pts like a scanned mesh
+  '''
+  rng = np.random.RandomState(seed)
+  pts = rng.randn(n_pts,3)
+  pts /= np.linalg.norm(pts, axis=-1, keepdims=True)
+  pts *= np.array([0.15,0.08,0.05]).reshape(1,3)
+  pts += rng.randn(n_pts,3)*1e-4
+  return pts
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--mesh_file', type=str, default=None, help="benchmark this mesh instead of the synthetic ones")
+  parser.add_argument('--n_pts', type=int, nargs='+', default=[10000, 100000, 1000000])
+  parser.add_argument('--n_sample', type=int, default=10000, help="n_sample of the approximate compute_mesh_diameter")
+  args = parser.parse_args()
+
+  if args.mesh_file is not None:
+    cases = [(os.path.basename(args.mesh_file), trimesh.load(args.mesh_file).vertices)]
+  else:
+    cases = [(f'synthetic_{n}', make_synthetic_pts(n)) for n in args.n_pts]
+
+  print(f"{'case':>20} {'n_pts':>9} | {'approx(m)':>10} {'time(s)':>8} {'peak(MB)':>9} | {'exact(m)':>10} {'time(s)':>8} {'peak(MB)':>9} | {'approx err':>10}")
+  for name, pts in cases:
+    d_approx, t_approx, m_approx = run_timed(lambda: compute_mesh_diameter(model_pts=pts, n_sample=args.n_sample))
+    d_exact, t_exact, m_exact = run_timed(lambda: compute_mesh_diameter_exact(model_pts=pts))
+    print(f"{name:>20} {len(pts):>9} | {d_approx:>10.6f} {t_approx:>8.3f} {m_approx:>9.1f} | {d_exact:>10.6f} {t_exact:>8.3f} {m_exact:>9.1f} | {d_exact-d_approx:>10.2e}")
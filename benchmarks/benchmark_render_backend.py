@@ -0,0 +1,74 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Hypotheses rendered per second by each render backend, with the crop rendering of make_crop_data_batch (bbox2d, lighting)
+'''
+
+import os,sys,time,argparse
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from Utils import *
+
+
+def make_crop_render_fn(mesh, backend, B, H, W, K, out_size, device):
+  mesh_tensors = make_mesh_tensors(mesh, device=device)
+  poses = torch.eye(4, device=device)[None].repeat(B,1,1)
+  poses[:,:3,:3] = so3_exp_map((torch.rand(B,3, device=device)-0.5)*2*np.pi)
+  poses[:,:3,3] = torch.tensor([0,0,0.5], device=device)
+  diameter = float(np.linalg.norm(np.ptp(mesh.vertices, axis=0)))
+  tf_to_crops = compute_crop_window_tf_batch(H=H, W=W, poses=poses, K=K, crop_ratio=1.2, out_size=(out_size, out_size), method='box_3d', mesh_diameter=diameter)
+  bbox2d_crop = torch.as_tensor(np.array([0, 0, out_size-1, out_size-1]).reshape(2,2), device=device, dtype=torch.float)
+  bbox2d = transform_pts(bbox2d_crop, tf_to_crops.inverse()[:,None]).reshape(-1,4)
+  def fn():
+    return nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses, glctx=backend, mesh_tensors=mesh_tensors, output_size=(out_size, out_size), bbox2d=bbox2d, use_light=True, extra={})
+  return fn
+
+
+def run_timed(fn, n_repeat, device):
+  fn()
+  if device=='cuda':
+    torch.cuda.synchronize()
+  begin = time.perf_counter()
+  for _ in range(n_repeat):
+    fn()
+  if device=='cuda':
+    torch.cuda.synchronize()
+  return (time.perf_counter()-begin)/n_repeat
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--H', type=int, default=480)
+  parser.add_argument('--W', type=int, default=640)
+  parser.add_argument('--out_size', type=int, default=160)
+  parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 32, 252])
+  parser.add_argument('--subdivisions', type=int, nargs='+', default=[3, 5, 7], help="icosphere levels, 1280/20480/327680 faces")
+  parser.add_argument('--n_repeat', type=int, default=3)
+  parser.add_argument('--n_threads', type=int, default=None, help="torch cpu threads")
+  args = parser.parse_args()
+
+  if args.n_threads is not None:
+    torch.set_num_threads(args.n_threads)
+  H, W = args.H, args.W
+  K = np.array([[600,0,W/2],[0,600,H/2],[0,0,1]])
+  backends = [('torch', 'cpu', TorchRasterizer())]
+  if torch.cuda.is_available():
+    backends.append(('torch', 'cuda', TorchRasterizer()))
+    if dr is not None:
+      backends.append(('nvdiffrast', 'cuda', NvdiffrastBackend(dr.RasterizeCudaContext())))
+
+  print(f"cpu threads {torch.get_num_threads()}")
+  print(f"{'backend':>10} {'device':>6} | {'faces':>7} | {'B':>4} | {'ms':>9} | {'hypo/s':>9}")
+  for subdivisions in args.subdivisions:
+    mesh = trimesh.creation.icosphere(subdivisions=subdivisions, radius=0.05)
+    for name, device, backend in backends:
+      for B in args.batch_sizes:
+        fn = make_crop_render_fn(mesh, backend, B, H, W, K, args.out_size, device)
+        t = run_timed(fn, args.n_repeat, device)
+        print(f"{name:>10} {device:>6} | {len(mesh.faces):>7} | {B:>4} | {t*1000:>9.2f} | {B/t:>9.1f}")
@@ -0,0 +1,81 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Cold start: import time of Utils/estimater in fresh interpreters with the slowest modules, and time to first pose of run_demo.py, i.e. until it writes the pose of the first frame
+Does not import the repo itself, so it measures nothing of its own start up
+'''
+
+import os,sys,time,argparse,subprocess,tempfile,glob,re
+code_dir = os.path.dirname(os.path.realpath(__file__))
+repo_dir = os.path.realpath(f'{code_dir}/..')
+
+
+def time_import(module, n_repeat):
+  times = []
+  for _ in range(n_repeat):
+    begin = time.perf_counter()
+    subprocess.run([sys.executable, '-c', f'import {module}'], cwd=repo_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    times.append(time.perf_counter()-begin)
+  return min(times), sorted(times)[len(times)//2]
+
+
+def slowest_imports(module, top_k):
+  '''From python -X importtime, self time summed per top level package
+  Return: list of (package, microseconds)
+  '''
+  out = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=repo_dir, check=True, capture_output=True, text=True).stderr
+  totals = {}
+  for line in out.splitlines():
+    m = re.match(r'import time:\s+(\d+) \|\s+\d+ \|\s*(\S+)', line)
+    if m is None:
+      continue
+    top = m.group(2).split('.')[0]
+    totals[top] = totals.get(top, 0)+int(m.group(1))
+  return sorted(totals.items(), key=lambda x: -x[1])[:top_k]
+
+
+def time_to_first_pose(args, timeout):
+  '''Wall time from launching run_demo.py to the first pose file, the process is killed then
+  '''
+  debug_dir = tempfile.mkdtemp()
+  cmd = [sys.executable, f'{repo_dir}/run_demo.py', '--debug', '0', '--debug_dir', debug_dir]+args
+  begin = time.perf_counter()
+  proc = subprocess.Popen(cmd, cwd=repo_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    while time.perf_counter()-begin<timeout:
+      if len(glob.glob(f'{debug_dir}/ob_in_cam/*.txt'))>0:
+        return time.perf_counter()-begin
+      if proc.poll() is not None:
+        raise RuntimeError(f'run_demo.py exited with {proc.returncode} before the first pose')
+      time.sleep(0.01)
+    raise RuntimeError(f'no pose after {timeout}s')
+  finally:
+    proc.kill()
+    proc.wait()
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--modules', type=str, nargs='+', default=['Utils', 'estimater'])
+  parser.add_argument('--n_repeat', type=int, default=5)
+  parser.add_argument('--top_k', type=int, default=15)
+  parser.add_argument('--demo', type=int, default=1, help="also measure the time to first pose of run_demo.py")
+  parser.add_argument('--demo_args', type=str, default='', help="extra run_demo.py arguments")
+  parser.add_argument('--timeout', type=float, default=600)
+  args = parser.parse_args()
+
+  for module in args.modules:
+    t_min, t_median = time_import(module, args.n_repeat)
+    print(f'import {module}: min {t_min:.3f}s median {t_median:.3f}s')
+    for name, us in slowest_imports(module, args.top_k):
+      print(f'  {name:<24} {us/1e6:.3f}s')
+
+  if args.demo:
+    t = time_to_first_pose(args.demo_args.split(), args.timeout)
+    print(f'run_demo.py time to first pose: {t:.2f}s')
@@ -0,0 +1,69 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Per call overhead of a span disabled and enabled, against the logging.info calls it replaces, with logging at INFO and at WARNING. Also checks the exporters
+'''
+
+import os,sys,time,argparse,logging,json,tempfile
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+import torch
+from tracing import *
+
+
+def time_per_call(fn, n):
+  begin = time.perf_counter()
+  for _ in range(n):
+    fn()
+  return (time.perf_counter()-begin)/n
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--n', type=int, default=200000)
+  parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+  args = parser.parse_args()
+
+  logging.basicConfig(stream=open(os.devnull,'w'), format='[%(funcName)s()] %(message)s')
+  scores = torch.rand(252, device=args.device)
+  tracer = get_tracer()
+
+  def run_span():
+    with span('stage', n=252):
+      pass
+
+  def run_log():
+    logging.info("render done")
+
+  def run_log_tensor():
+    logging.info(f'sorted scores:{scores}')
+
+  results = {}
+  tracer.disable()
+  results['span disabled'] = time_per_call(run_span, args.n)
+  tracer.enable(max_events=args.n)
+  results['span enabled'] = time_per_call(run_span, args.n)
+  tracer.disable()
+  for level in [logging.INFO, logging.WARNING]:
+    logging.getLogger().setLevel(level)
+    name = logging.getLevelName(level)
+    results[f'logging.info, level {name}'] = time_per_call(run_log, args.n)
+    results[f'logging.info of a tensor, level {name}'] = time_per_call(run_log_tensor, max(args.n//100,1))
+  for k,v in results.items():
+    print(f'{k:<40} {v*1e9:10.0f}ns')
+
+  stats = tracer.get_stats()['stage']
+  assert stats['n']==args.n and stats['p50']<=stats['p90']<=stats['max']
+  out_dir = tempfile.mkdtemp()
+  tracer.export_json(f'{out_dir}/trace_stats.json')
+  tracer.export_chrome_trace(f'{out_dir}/trace.json')
+  with open(f'{out_dir}/trace.json','r') as ff:
+    events = json.load(ff)['traceEvents']
+  assert len(events)==args.n and events[0]['ph']=='X'
+  print(tracer.summary())
@@ -0,0 +1,81 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Load time and memory of N concurrent workers loading a checkpoint into cpu tensors, with torch.load against the WeightStore
+PSS splits the shared pages between the workers, so its sum is what the host pays for the weights
+'''
+
+import os,sys,time,argparse,tempfile
+import multiprocessing as mp
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+import torch
+from weight_store import *
+
+
+def read_memory_kb():
+  '''Rss and Pss of this process
+  '''
+  out = {}
+  with open('/proc/self/smaps_rollup','r') as ff:
+    for line in ff:
+      k = line.split(':')[0]
+      if k in ['Rss', 'Pss']:
+        out[k] = int(line.split()[1])
+  return out
+
+
+def worker(mode, ckpt_file, store_dir, barrier, queue):
+  mem_begin = read_memory_kb()
+  begin = time.perf_counter()
+  if mode=='torch':
+    state_dict = load_checkpoint_state_dict(ckpt_file)
+  else:
+    state_dict = WeightStore(store_dir).load(ckpt_file)
+  checksum = sum(float(v.float().sum()) for v in state_dict.values())   # Touch every page, as the first forward would
+  t = time.perf_counter()-begin
+  barrier.wait()   # All workers hold their weights while measuring
+  mem = read_memory_kb()
+  queue.put((t, mem['Rss']-mem_begin['Rss'], mem['Pss']-mem_begin['Pss'], checksum))
+  barrier.wait()
+
+
+def run(mode, ckpt_file, store_dir, n_workers):
+  ctx = mp.get_context('spawn')
+  barrier = ctx.Barrier(n_workers)
+  queue = ctx.Queue()
+  procs = [ctx.Process(target=worker, args=(mode, ckpt_file, store_dir, barrier, queue)) for _ in range(n_workers)]
+  for p in procs:
+    p.start()
+  res = [queue.get() for _ in range(n_workers)]
+  for p in procs:
+    p.join()
+  return res
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--ckpt_file', type=str, default=f'{code_dir}/../weights/2024-01-11-20-02-45/model_best.pth')
+  parser.add_argument('--store_dir', type=str, default=None, help="default a temporary dir")
+  parser.add_argument('--n_workers', type=int, nargs='+', default=[1, 4, 8, 16])
+  args = parser.parse_args()
+
+  store_dir = args.store_dir if args.store_dir is not None else tempfile.mkdtemp()
+  begin = time.perf_counter()
+  WeightStore(store_dir).load(args.ckpt_file)
+  print(f'store ready in {time.perf_counter()-begin:.2f}s')
+
+  for n_workers in args.n_workers:
+    checksums = {}
+    for mode in ['torch', 'store']:
+      res = run(mode, args.ckpt_file, store_dir, n_workers)
+      times = sorted(r[0] for r in res)
+      checksums[mode] = res[0][3]
+      print(f'{mode:<6} workers {n_workers:>3}: load median {times[len(times)//2]*1000:.1f}ms max {times[-1]*1000:.1f}ms, rss per worker {sum(r[1] for r in res)/n_workers/1024:.1f}MB, pss total {sum(r[2] for r in res)/1024:.1f}MB')
+    assert abs(checksums['torch']-checksums['store'])<=1e-6*max(1,abs(checksums['torch'])), checksums
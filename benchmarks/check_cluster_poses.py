@@ -0,0 +1,47 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,time,argparse
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from Utils import *
+
+
+if __name__=='__main__':
+  '''Cross check cluster_poses_torch against the mycpp extension and time both. The 30 deg in-plane steps put pairs exactly at the 30 deg threshold
+  '''
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--grids', type=str, default='40x60,40x30,80x30,162x30', help="comma separated min_n_views x inplane_step")
+  parser.add_argument('--allow_missing_ref', type=int, default=0, help="pass without the cross check when mycpp is not built, otherwise that is a failure")
+  args = parser.parse_args()
+
+  cases = {
+    'no_symmetry': np.eye(4)[None],
+    'discrete_z180': symmetry_tfs_from_info({'symmetries_discrete': [euler_matrix(0,0,np.pi).reshape(-1).tolist()]}),
+    'continuous_z': symmetry_tfs_from_info({'symmetries_continuous': [{'axis': [0,0,1], 'offset': [0,0,0]}]}),
+  }
+  ok = True
+  for grid in args.grids.split(','):
+    min_n_views, inplane_step = [int(v) for v in grid.split('x')]
+    rot_grid = make_rotation_grid_candidates(min_n_views, inplane_step)
+    for name, symmetry_tfs in cases.items():
+      begin = time.perf_counter()
+      out_torch = cluster_poses(30, 99999, rot_grid, symmetry_tfs, backend='torch')
+      t_torch = time.perf_counter()-begin
+      if mycpp is None:
+        ok = ok and bool(args.allow_missing_ref)
+        print(f"grid {grid} {name}: torch {len(out_torch)} poses {t_torch:.3f}s, mycpp not built, {'skip cross check' if args.allow_missing_ref else 'FAIL, build mycpp or pass --allow_missing_ref 1'}")
+        continue
+      begin = time.perf_counter()
+      out_cpp = cluster_poses(30, 99999, rot_grid, symmetry_tfs, backend='cpp')
+      t_cpp = time.perf_counter()-begin
+      same = out_cpp.shape==out_torch.shape and np.allclose(out_cpp, out_torch, atol=1e-5)
+      ok = ok and same
+      print(f'grid {grid} ({len(rot_grid)}) {name}: S={len(symmetry_tfs)}, cpp {len(out_cpp)} poses {t_cpp:.3f}s, torch {len(out_torch)} poses {t_torch:.3f}s, same:{same}')
+  sys.exit(0 if ok else 1)
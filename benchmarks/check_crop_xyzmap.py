@@ -0,0 +1,92 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Numerical equivalence of depth2xyzmap_crop_batch with the previous transform_depth_to_xyzmap path, which warped every crop back to full resolution, back-projected it and warped it to the crop again
+'''
+
+import os,sys,time,argparse
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from Utils import *
+
+
+def xyzmap_via_full_res(depths, Ks, tf_to_crops, H_ori, W_ori):
+  '''The previous path, kept here as the reference
+  '''
+  B,H,W = depths.shape
+  crop_to_oris = tf_to_crops.inverse()
+  depths_ori = kornia.geometry.transform.warp_perspective(depths[:,None], crop_to_oris, dsize=(H_ori, W_ori), mode='nearest', align_corners=False)
+  xyz_maps = depth2xyzmap_batch(depths_ori[:,0], Ks.expand(B,-1,-1), zfar=np.inf).permute(0,3,1,2)
+  xyz_maps = kornia.geometry.transform.warp_perspective(xyz_maps, tf_to_crops, dsize=(H,W), mode='nearest', align_corners=False)
+  return xyz_maps.permute(0,2,3,1)
+
+
+def make_scene_depth(H, W, K, smooth, device):
+  '''Slanted plane, plus a box in front of it when not @smooth
+  '''
+  vs,us = torch.meshgrid(torch.arange(H, device=device).float(), torch.arange(W, device=device).float(), indexing='ij')
+  depth = 0.8+0.2*us/W+0.1*vs/H
+  if not smooth:
+    box = (abs(us-W/2)<W/8) & (abs(vs-H/2)<H/8)
+    depth[box] = 0.5
+  return depth
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--H', type=int, default=540)
+  parser.add_argument('--W', type=int, default=720)
+  parser.add_argument('--out_size', type=int, default=160)
+  parser.add_argument('--B', type=int, default=64)
+  parser.add_argument('--crop_ratio', type=float, default=1.2)
+  parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+  args = parser.parse_args()
+
+  torch.manual_seed(0)
+  device = args.device
+  H_ori, W_ori = args.H, args.W
+  K = torch.tensor([[600,0,W_ori/2],[0,600,H_ori/2],[0,0,1]], dtype=torch.float, device=device).reshape(1,3,3)
+  centers = torch.stack([(torch.rand(args.B, device=device)-0.5)*0.3, (torch.rand(args.B, device=device)-0.5)*0.2, 0.6+torch.rand(args.B, device=device)*0.4], dim=-1)
+  poses = torch.eye(4, device=device)[None].repeat(args.B,1,1)
+  poses[:,:3,3] = centers
+  mesh_diameter = 0.05+torch.rand(args.B, device=device)*0.25
+  tf_to_crops = compute_crop_window_tf_batch(H=H_ori, W=W_ori, poses=poses, K=K[0], crop_ratio=args.crop_ratio, out_size=(args.out_size, args.out_size), method='box_3d', mesh_diameter=mesh_diameter)
+
+  for smooth in [True, False]:
+    depth = make_scene_depth(H_ori, W_ori, K[0], smooth=smooth, device=device)
+    depths = crop_shared_images([depth[None]], tf_to_crops, dsize=(args.out_size, args.out_size), mode='nearest', axis_aligned=True)[0][:,0]
+
+    if device=='cuda':
+      torch.cuda.synchronize()
+    begin = time.perf_counter()
+    ref = xyzmap_via_full_res(depths, K, tf_to_crops, H_ori, W_ori)
+    if device=='cuda':
+      torch.cuda.synchronize()
+    t_ref = time.perf_counter()-begin
+    begin = time.perf_counter()
+    out = depth2xyzmap_crop_batch(depths, K, tf_to_crops, zfar=np.inf)
+    if device=='cuda':
+      torch.cuda.synchronize()
+    t_out = time.perf_counter()-begin
+
+    valid_ref = ref[...,2]>=0.001
+    valid_out = out[...,2]>=0.001
+    both = valid_ref & valid_out
+    err = (ref-out)[both].norm(dim=-1)
+    # The previous path snaps every crop pixel to an original pixel, so it is off by up to about one original pixel footprint
+    pixel_footprint = out[both][:,2]/K[0,0,0]
+    ratio = err/pixel_footprint
+    name = 'smooth' if smooth else 'with edges'
+    # The round trip drops crop pixels along the crop border, whose depth is valid
+    only_out = (valid_out & ~valid_ref).float().mean().item()
+    only_ref = (valid_ref & ~valid_out).float().mean().item()
+    print(f"{name}: valid only in crop space {only_out:.2e}, only in full res {only_ref:.2e}, err mm median {err.median().item()*1000:.3f} p99 {err.quantile(0.99).item()*1000:.3f} max {err.max().item()*1000:.3f}, err/pixel footprint p99 {ratio.quantile(0.99).item():.2f}, time full res {t_ref*1000:.1f}ms crop space {t_out*1000:.1f}ms")
+    if smooth:
+      assert ratio.max()<1.5, f'err/pixel footprint {ratio.max()}'
+      assert only_ref==0, f'valid only in full res {only_ref}'
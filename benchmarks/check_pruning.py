@@ -0,0 +1,79 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''The hypotheses kept by refine_with_pruning when the scorer splits them into several network chunks must be the top-k of a full scoring in a single chunk, on synthetic frames.
+Also checks that prune_stats does not outlive an unpruned register
+'''
+
+import os,sys,argparse,tempfile
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from estimater import *
+from synthetic_scene import *
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--chunk_size', type=int, default=32, help="scorer network chunk of the pruned scoring")
+  parser.add_argument('--keep_ratio', type=float, default=0.25)
+  parser.add_argument('--score_tol', type=float, default=1e-3, help="max logit difference between the chunked and the full scoring, cudnn picks other kernels per batch size")
+  parser.add_argument('--n_frames', type=int, default=3)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--device', type=str, default='cuda')
+  parser.add_argument('--weights_dir', type=str, default=None)
+  args = parser.parse_args()
+
+  set_logging_format(logging.WARNING)
+  set_seed(args.seed)
+  device = args.device
+  rng = np.random.default_rng(args.seed)
+  mesh = make_synthetic_mesh()
+  diameter = float(np.linalg.norm(np.ptp(mesh.vertices, axis=0)))
+  scene = SyntheticScene(mesh, seed=args.seed, device=device)
+  poses_gt = make_random_poses(args.n_frames, distance=(diameter*4, diameter*6), K=scene.K, H=scene.H, W=scene.W, rng=rng)
+
+  scorer = ScorePredictor(device=device, weights_dir=args.weights_dir)
+  refiner = PoseRefinePredictor(device=device, weights_dir=args.weights_dir)
+  est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, debug_dir=tempfile.mkdtemp(), debug=0, glctx=scene.glctx, device=device)
+  est.set_mem_budget()
+  full_planner = BatchPlanner(max_chunk_size=len(est.rot_grid), mem_budget=2**40, device=device)
+  chunk_planner = BatchPlanner(max_chunk_size=args.chunk_size, mem_budget=2**40, device=device)
+
+  ok = True
+  for i_frame, pose_gt in enumerate(poses_gt):
+    rgb, depth, mask = scene.render(pose_gt)
+    frame = FrameData(rgb=rgb, depth=depth, K=scene.K, mask=mask, device=device)
+    frame.filter_depth(radius=2)
+    center = frame.guess_translation()
+    poses = est.generate_random_pose_hypo(K=scene.K, rgb=rgb, depth=depth, mask=mask, scene_pts=None, center=center)
+    mesh_tensors = est.get_mesh_tensors(est.get_lod_level('refine', 0))
+    poses, _ = refiner.predict(mesh=mesh, mesh_tensors=mesh_tensors, rgb=frame.rgb, depth=frame.depth, K=scene.K, ob_in_cams=poses, normal_map=None, xyz_map=frame.get_xyz_map(), glctx=est.glctx, mesh_diameter=est.diameter, iteration=1, get_vis=False)
+
+    n_keep = max(4, int(np.ceil(len(poses)*args.keep_ratio)))
+    scores = {}
+    for name, planner in [('full', full_planner), ('chunked', chunk_planner)]:
+      scorer.planner = planner
+      scores[name], _ = scorer.predict(mesh=mesh, rgb=frame.rgb, depth=frame.depth, K=scene.K, ob_in_cams=poses, normal_map=None, mesh_tensors=mesh_tensors, glctx=est.glctx, mesh_diameter=est.diameter, get_vis=False)
+    score_err = (scores['chunked']-scores['full']).abs().max().item()
+    kept = scores['chunked'].argsort(descending=True)[:n_keep]
+    top = scores['full'].argsort(descending=True)[:n_keep]
+    same = set(kept.tolist())==set(top.tolist()) or (scores['full'][top[-1]]-scores['full'][kept].min()).abs().item()<=2*args.score_tol   # Sets may only differ by near ties at the cut
+    cur_ok = score_err<=args.score_tol and kept[0].item()==top[0].item() and same
+    ok &= cur_ok
+    print(f"frame {i_frame}: {len(poses)} hypotheses, chunk {args.chunk_size}, keep {n_keep}, max logit diff {score_err:.2e}, same best {kept[0].item()==top[0].item()}, same top-k {same}, {'OK' if cur_ok else 'FAIL'}")
+
+  est.set_mem_budget()
+  est.register(K=scene.K, rgb=rgb, depth=depth, ob_mask=mask, iteration=3, keep_ratios=[0.5, 0.5])
+  pruned_stats = est.prune_stats
+  est.register(K=scene.K, rgb=rgb, depth=depth, ob_mask=mask, iteration=3)
+  stats_ok = pruned_stats is not None and est.prune_stats is None
+  ok &= stats_ok
+  print(f"prune_stats after a pruned register {pruned_stats}, after an unpruned one {est.prune_stats}, {'OK' if stats_ok else 'FAIL'}")
+  print('OK' if ok else 'FAIL')
+  assert ok
@@ -0,0 +1,214 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Parity of the TorchRasterizer render backend.
+Always checked: analytic references (every rendered xyz lies on its pixel ray and on the rendered surface, silhouette of a sphere).
+Against --raycast_ref_file: depth of a brute force ray caster independent of both rasterizers, committed next to this script, rewritten with --save_raycast_ref.
+Against --ref_file: renders saved by nvdiffrast, written with --save_ref on a GPU machine. When nvdiffrast is usable here, it is also compared directly.
+A missing reference is a failure unless --allow_missing_ref
+'''
+
+import os,sys,argparse,importlib.util
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from Utils import *
+
+
+def make_textured_box(extents=(0.12,0.08,0.05), tex_size=64):
+  mesh = trimesh.creation.box(extents=extents)
+  uv = (mesh.vertices[:,:2]-mesh.vertices[:,:2].min(axis=0))/np.ptp(mesh.vertices[:,:2], axis=0)
+  vs,us = np.meshgrid(np.arange(tex_size), np.arange(tex_size), indexing='ij')
+  tex = np.stack([us*255//tex_size, vs*255//tex_size, ((us//8+vs//8)%2)*255], axis=-1).astype(np.uint8)
+  mesh.visual = trimesh.visual.texture.TextureVisuals(uv=uv, image=Image.fromarray(tex))
+  return mesh
+
+
+def make_meshes():
+  sphere = trimesh.creation.icosphere(subdivisions=4, radius=0.05)
+  sphere.visual.vertex_colors = (np.abs(sphere.vertex_normals)*255).astype(np.uint8)
+  return {'sphere': sphere, 'box': make_textured_box()}
+
+
+def make_poses(n, device, seed=0):
+  rng = np.random.RandomState(seed)
+  poses = []
+  for _ in range(n):
+    pose = np.eye(4)
+    pose[:3,:3] = cv2.Rodrigues(rng.uniform(-np.pi, np.pi, size=3))[0]
+    pose[:3,3] = [rng.uniform(-0.05,0.05), rng.uniform(-0.05,0.05), rng.uniform(0.3,0.8)]
+    poses.append(pose)
+  return torch.as_tensor(np.array(poses), dtype=torch.float, device=device)
+
+
+def render_all(meshes, poses, K, H, W, glctx, out_size, device):
+  '''Full image renders and bbox2d crops, the same calls as make_crop_data_batch
+  '''
+  out = {}
+  for name, mesh in meshes.items():
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
+    extra = {}
+    color, depth, normal = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses, glctx=glctx, mesh_tensors=mesh_tensors, get_normal=True, use_light=True, extra=extra)
+    out[f'{name}_color'] = color
+    out[f'{name}_depth'] = depth
+    out[f'{name}_xyz'] = extra['xyz_map']
+    diameter = float(np.linalg.norm(np.ptp(mesh.vertices, axis=0)))
+    tf_to_crops = compute_crop_window_tf_batch(H=H, W=W, poses=poses, K=K, crop_ratio=1.2, out_size=(out_size, out_size), method='box_3d', mesh_diameter=diameter)
+    bbox2d_crop = torch.as_tensor(np.array([0, 0, out_size-1, out_size-1]).reshape(2,2), device=device, dtype=torch.float)
+    bbox2d = transform_pts(bbox2d_crop, tf_to_crops.inverse()[:,None]).reshape(-1,4)
+    extra = {}
+    color, depth, _ = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses, glctx=glctx, mesh_tensors=mesh_tensors, output_size=(out_size, out_size), bbox2d=bbox2d, use_light=True, extra=extra)
+    out[f'{name}_crop_color'] = color
+    out[f'{name}_crop_depth'] = depth
+  return {k: v.data.cpu().numpy() for k,v in out.items()}
+
+
+def compare(ref, out, depth_tol, max_mismatch=0.002):
+  '''Coverage mismatch ratio, depth error on the pixels covered by both, color error when @ref has colors
+  '''
+  ok = True
+  for k in ref:
+    if not k.endswith('depth'):
+      continue
+    prefix = k[:-len('depth')]
+    valid_ref = ref[k]>0
+    valid_out = out[k]>0
+    both = valid_ref & valid_out
+    mismatch = (valid_ref!=valid_out).mean()
+    depth_err = np.abs(ref[k]-out[k])[both]
+    # Coverage only differs along the silhouette, where the fill rules of the two rasterizers may disagree
+    cur_ok = mismatch<max_mismatch and np.quantile(depth_err, 0.99)<depth_tol
+    msg = f"{prefix[:-1]}: coverage mismatch {mismatch:.2e}, depth err p99 {np.quantile(depth_err,0.99)*1000:.4f}mm max {depth_err.max()*1000:.4f}mm"
+    if f'{prefix}color' in ref:
+      color_err = np.abs(ref[f'{prefix}color']-out[f'{prefix}color'])[both]
+      cur_ok = cur_ok and np.quantile(color_err, 0.99)<0.05
+      msg += f", color err p99 {np.quantile(color_err,0.99):.4f}"
+    ok &= cur_ok
+    print(f"{msg}, {'OK' if cur_ok else 'FAIL'}")
+  return ok
+
+
+def raycast_depth(mesh, poses, K, H, W, chunk=256):
+  '''Camera z of the nearest ray/triangle hit through every pixel center (+0.5, the nvdiffrast convention), brute force Moller-Trumbore in float64. Shares no code with the rasterizers
+  @poses: (N,4,4) np array
+  Return: (N,H,W), 0 where nothing is hit
+  '''
+  vs,us = np.meshgrid(np.arange(H), np.arange(W), indexing='ij')
+  dirs = np.stack([(us+0.5-K[0,2])/K[0,0], (vs+0.5-K[1,2])/K[1,1], np.ones((H,W))], axis=-1).reshape(-1,1,3)   # z=1, so the ray parameter of a hit is its camera z
+  depths = []
+  for pose in poses:
+    tris = (mesh.triangles.reshape(-1,3)@pose[:3,:3].T+pose[:3,3]).reshape(-1,3,3)
+    v0 = tris[None,:,0]
+    e1 = tris[None,:,1]-v0
+    e2 = tris[None,:,2]-v0
+    q = np.cross(-v0, e1)
+    depth = np.zeros(len(dirs))
+    for b in range(0, len(dirs), chunk):
+      d = dirs[b:b+chunk]
+      p = np.cross(d, e2)
+      det = (e1*p).sum(axis=-1)
+      inv_det = 1/np.where(np.abs(det)>1e-15, det, np.nan)
+      u = (-v0*p).sum(axis=-1)*inv_det
+      v = (d*q).sum(axis=-1)*inv_det
+      t = (e2*q).sum(axis=-1)*inv_det
+      t = np.where((u>=0) & (v>=0) & (u+v<=1) & (t>0), t, np.inf).min(axis=1)
+      depth[b:b+chunk] = np.where(np.isfinite(t), t, 0)
+    depths.append(depth.reshape(H,W))
+  return np.stack(depths, axis=0)
+
+
+def make_raycast_ref(meshes, K, H, W, n_poses):
+  poses = make_poses(n_poses, 'cpu').data.cpu().numpy()
+  ref = {f'{name}_depth': raycast_depth(mesh, poses, K, H, W).astype(np.float32) for name, mesh in meshes.items()}
+  return {**ref, 'K': K, 'H': H, 'W': W, 'n_poses': n_poses}
+
+
+def check_analytic(K, H, W, device):
+  '''Rendered points must lie on the ray through their pixel center (nvdiffrast puts pixel centers at +0.5) and on the sphere surface. The silhouette must match the pixels whose ray hits the sphere, up to the tessellation
+  '''
+  radius = 0.05
+  sphere = trimesh.creation.icosphere(subdivisions=6, radius=radius)
+  poses = make_poses(4, device, seed=1)
+  extra = {}
+  _, depth, _ = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses, glctx=TorchRasterizer(), mesh=sphere, extra=extra)
+  xyz = extra['xyz_map'].data.cpu().numpy()
+  depth = depth.data.cpu().numpy()
+  vs,us = np.meshgrid(np.arange(H), np.arange(W), indexing='ij')
+  rays = np.stack([(us+0.5-K[0,2])/K[0,0], (vs+0.5-K[1,2])/K[1,1], np.ones_like(us, dtype=float)], axis=-1)
+  rays /= np.linalg.norm(rays, axis=-1, keepdims=True)
+  ok = True
+  for i in range(len(poses)):
+    valid = depth[i]>0
+    pts = xyz[i][valid]
+    ray_u = K[0,0]*pts[:,0]/pts[:,2]+K[0,2]-0.5
+    ray_v = K[1,1]*pts[:,1]/pts[:,2]+K[1,2]-0.5
+    ray_err = max(np.abs(ray_u-us[valid]).max(), np.abs(ray_v-vs[valid]).max())
+    center = poses[i,:3,3].data.cpu().numpy()
+    surface_err = np.abs(np.linalg.norm(pts-center, axis=-1)-radius).max()
+    hit = np.linalg.norm(np.cross(rays, center.reshape(1,1,3)), axis=-1)<radius
+    mismatch = (hit!=valid).sum()/hit.sum()
+    cur_ok = ray_err<0.01 and surface_err<radius*0.002 and mismatch<0.02
+    ok &= cur_ok
+    print(f"analytic sphere {i}: ray err {ray_err:.2e}px, surface err {surface_err*1000:.4f}mm, silhouette mismatch {mismatch:.4f}, {'OK' if cur_ok else 'FAIL'}")
+  return ok
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--H', type=int, default=240)
+  parser.add_argument('--W', type=int, default=320)
+  parser.add_argument('--out_size', type=int, default=160)
+  parser.add_argument('--n_poses', type=int, default=8)
+  parser.add_argument('--device', type=str, default='cpu', help="device of the TorchRasterizer")
+  parser.add_argument('--ref_file', type=str, default=f'{code_dir}/render_backend_ref.npz')
+  parser.add_argument('--save_ref', type=int, default=0, help="render the references with nvdiffrast and save them to --ref_file")
+  parser.add_argument('--raycast_ref_file', type=str, default=f'{code_dir}/render_backend_raycast_ref.npz')
+  parser.add_argument('--save_raycast_ref', type=int, default=0, help="ray cast the depth references at 80x60 and save them to --raycast_ref_file")
+  parser.add_argument('--allow_missing_ref', type=int, default=0, help="pass without the comparisons whose reference file is missing, otherwise that is a failure")
+  args = parser.parse_args()
+
+  H, W = args.H, args.W
+  K = np.array([[300,0,W/2],[0,300,H/2],[0,0,1]])
+  meshes = make_meshes()
+
+  if args.save_ref:
+    ref = render_all(meshes, make_poses(args.n_poses, 'cuda'), K, H, W, dr.RasterizeCudaContext(), args.out_size, 'cuda')
+    np.savez_compressed(args.ref_file, **ref)
+    print(f'saved {args.ref_file}')
+    sys.exit(0)
+  if args.save_raycast_ref:
+    np.savez_compressed(args.raycast_ref_file, **make_raycast_ref(meshes, K=np.array([[200,0,40],[0,200,30],[0,0,1]]), H=60, W=80, n_poses=4))
+    print(f'saved {args.raycast_ref_file}')
+    sys.exit(0)
+
+  ok = check_analytic(K, H, W, args.device)
+  for ref_file, make_hint in [(args.raycast_ref_file, '--save_raycast_ref'), (args.ref_file, '--save_ref on a GPU machine')]:
+    if not os.path.exists(ref_file):
+      ok &= bool(args.allow_missing_ref)
+      print(f"{ref_file} not found, run with {make_hint} to create it, {'skip' if args.allow_missing_ref else 'FAIL'}")
+      continue
+    print(f'vs {ref_file}')
+    ref = dict(np.load(ref_file))
+    if 'K' in ref:
+      ref_K, ref_H, ref_W = ref.pop('K'), int(ref.pop('H')), int(ref.pop('W'))
+      poses = make_poses(int(ref.pop('n_poses')), args.device)
+      out = {}
+      for name, mesh in meshes.items():
+        _, depth, _ = nvdiffrast_render(K=ref_K, H=ref_H, W=ref_W, ob_in_cams=poses, glctx=TorchRasterizer(), mesh=mesh, extra={})
+        out[f'{name}_depth'] = depth.data.cpu().numpy()
+      ok &= compare(ref, out, depth_tol=1e-5, max_mismatch=0.005)
+    else:
+      out = render_all(meshes, make_poses(args.n_poses, args.device), K, H, W, TorchRasterizer(), args.out_size, args.device)
+      ok &= compare(ref, out, depth_tol=1e-4)
+  if torch.cuda.is_available() and importlib.util.find_spec('nvdiffrast') is not None:
+    print('vs nvdiffrast')
+    out = render_all(meshes, make_poses(args.n_poses, args.device), K, H, W, TorchRasterizer(), args.out_size, args.device)
+    ref = render_all(meshes, make_poses(args.n_poses, 'cuda'), K, H, W, dr.RasterizeCudaContext(), args.out_size, 'cuda')
+    ok &= compare(ref, out, depth_tol=1e-4)
+  print('OK' if ok else 'FAIL')
+  sys.exit(0 if ok else 1)
@@ -0,0 +1,110 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''TemplateBank crops against rendering the same hypotheses, for object centres on and off the optical axis and at other distances than the templates. Also times both.
+The bank hypotheses must be the rotation grid turned by R_c^T, and register from them must be as accurate as from generate_random_pose_hypo on synthetic frames
+'''
+
+import os,sys,time,argparse,tempfile
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from Utils import *
+from template_bank import *
+from benchmark_render_backend import run_timed
+from estimater import *
+from synthetic_scene import *
+
+
+def render_crops(poses, K, H, W, tf_to_crops, mesh_tensors, glctx, crop_size):
+  '''The renders of make_crop_data_batch
+  '''
+  bbox2d_crop = torch.as_tensor(np.array([0, 0, crop_size[0]-1, crop_size[1]-1]).reshape(2,2), device=poses.device, dtype=torch.float)
+  bbox2d = transform_pts(bbox2d_crop, tf_to_crops.inverse()).reshape(-1,4)
+  extra = {}
+  rgb, _, _ = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses, glctx=glctx, mesh_tensors=mesh_tensors, output_size=crop_size, bbox2d=bbox2d, use_light=True, extra=extra)
+  return rgb.permute(0,3,1,2)*255, extra['xyz_map'].permute(0,3,1,2)
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--mesh_file', type=str, default=f'{code_dir}/../demo_data/mustard0/mesh/textured_simple.obj')
+  parser.add_argument('--H', type=int, default=480)
+  parser.add_argument('--W', type=int, default=640)
+  parser.add_argument('--crop_size', type=int, default=160)
+  parser.add_argument('--crop_ratio', type=float, default=1.2)
+  parser.add_argument('--distance_ratio', type=float, default=4)
+  parser.add_argument('--n_repeat', type=int, default=5)
+  parser.add_argument('--n_frames', type=int, default=8, help="synthetic frames of the register accuracy check, 0 to skip it")
+  parser.add_argument('--add_thres', type=float, default=0.1, help="ADD below this ratio of the diameter is a correct register")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--weights_dir', type=str, default=None)
+  parser.add_argument('--device', type=str, default='cuda')
+  args = parser.parse_args()
+
+  device = args.device
+  H, W = args.H, args.W
+  K = np.array([[600,0,W/2],[0,600,H/2],[0,0,1]])
+  crop_size = (args.crop_size, args.crop_size)
+  mesh = trimesh.load(args.mesh_file)
+  mesh.vertices = mesh.vertices-mesh.vertices.mean(axis=0).reshape(1,3)
+  diameter = compute_mesh_diameter_exact(model_pts=mesh.vertices)
+  mesh_tensors = make_mesh_tensors(mesh, device=device)
+  glctx = make_render_backend(device=device)
+  rot_grid = torch.as_tensor(make_rotation_grid_candidates(min_n_views=40, inplane_step=60), dtype=torch.float, device=device)
+
+  begin = time.perf_counter()
+  bank = TemplateBank.build(mesh_tensors, rot_grid, mesh_diameter=diameter, crop_size=crop_size, crop_ratio=args.crop_ratio, glctx=glctx, distance_ratio=args.distance_ratio, device=device)
+  print(f'{len(rot_grid)} templates built in {time.perf_counter()-begin:.2f}s')
+
+  ok = True
+  distance = diameter*args.distance_ratio
+  for center in [[0,0,1], [0.2,-0.15,1], [0.35,0.25,1], [0,0,0.7], [0.1,0.05,1.5]]:
+    center = torch.tensor(center, dtype=torch.float, device=device)*distance
+    poses = bank.make_hypotheses(center)
+    R_c = rotation_to_optical_axis(center)
+    hypo_err = (R_c@poses[:,:3,:3]-rot_grid[:,:3,:3]).abs().max().item()
+    tf_to_crops = compute_crop_window_tf_batch(H=H, W=W, poses=poses, K=K, crop_ratio=args.crop_ratio, out_size=crop_size, method='box_3d', mesh_diameter=diameter)
+    rgb_bank, xyz_bank = bank.make_crops(torch.arange(len(poses), device=device), poses, K, tf_to_crops, dsize=crop_size)
+    rgb_ref, xyz_ref = render_crops(poses, K, H, W, tf_to_crops, mesh_tensors, glctx, crop_size)
+    valid_ref = xyz_ref[:,2]>=0.001
+    valid_bank = xyz_bank[:,2]>=0.001
+    both = valid_ref & valid_bank
+    iou = (both.sum()/(valid_ref|valid_bank).sum()).item()
+    xyz_err = (xyz_ref-xyz_bank).norm(dim=1)[both]/diameter
+    color_err = (rgb_ref-rgb_bank).abs().mean(dim=1)[both]
+    t_bank = run_timed(lambda: bank.make_crops(torch.arange(len(poses), device=device), poses, K, tf_to_crops, dsize=crop_size), args.n_repeat, device)
+    t_render = run_timed(lambda: render_crops(poses, K, H, W, tf_to_crops, mesh_tensors, glctx, crop_size), args.n_repeat, device)
+    cur_ok = iou>0.9 and xyz_err.median()<0.01 and hypo_err<1e-5
+    ok &= cur_ok
+    print(f"center {center.tolist()}: hypotheses R_c@R-rot_grid {hypo_err:.1e}, iou {iou:.3f}, xyz err median {xyz_err.median():.4f} p90 {xyz_err.quantile(0.9):.4f} diameters, color err median {color_err.median():.1f}, bank {t_bank*1000:.1f}ms render {t_render*1000:.1f}ms, {'OK' if cur_ok else 'FAIL'}")
+
+  if args.n_frames>0:
+    set_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    mesh = make_synthetic_mesh()
+    scene = SyntheticScene(mesh, H=H, W=W, K=K, seed=args.seed, glctx=glctx, device=device)
+    est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=ScorePredictor(device=device, weights_dir=args.weights_dir), refiner=PoseRefinePredictor(device=device, weights_dir=args.weights_dir), debug_dir=tempfile.mkdtemp(), debug=0, glctx=glctx, device=device)
+    poses_gt = make_random_poses(args.n_frames, distance=(est.diameter*4, est.diameter*6), K=K, H=H, W=W, rng=rng)
+    frames = scene.render_sequence(poses_gt)
+    model_pts = mesh.vertices
+    errors = {}
+    for name, enabled in [('grid', False), ('bank', True)]:
+      est.set_template_bank_mode(enabled=enabled, distance_ratio=args.distance_ratio)
+      errors[name] = []
+      for (rgb, depth, mask), pose_gt in zip(frames, poses_gt):
+        pose = est.register(K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=5)
+        errors[name].append((add_err(pose, pose_gt, model_pts)/est.diameter, *pose_errors(pose, pose_gt)))
+      errors[name] = np.array(errors[name])   #(n_frames,3) ADD/diameter, degree, meter
+    for name, err in errors.items():
+      print(f"register from {name} hypotheses: ADD<{args.add_thres} diameter {(err[:,0]<args.add_thres).sum()}/{len(err)}, ADD median {np.median(err[:,0]):.4f} diameters, rot err median {np.median(err[:,1]):.2f} deg, trans err median {np.median(err[:,2])*1000:.1f} mm")
+    register_ok = (errors['bank'][:,0]<args.add_thres).sum()>=(errors['grid'][:,0]<args.add_thres).sum()
+    ok &= register_ok
+    print(f"bank register as accurate as the grid one: {register_ok}")
+  print('OK' if ok else 'FAIL')
+  assert ok
@@ -0,0 +1,117 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Synthetic RGB-D frames of a mesh at known poses, rendered with the render backend of the device (TorchRasterizer off cuda), for benchmarks that need no dataset
+'''
+
+import os,sys
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from Utils import *
+from scipy.spatial.transform import Rotation
+
+
+def make_synthetic_mesh(subdivisions=4, extents=(0.12, 0.08, 0.06)):
+  '''Vertex colored, asymmetric deformed ellipsoid, so that every pose is distinguishable
+  @extents: of the undeformed ellipsoid, meter
+  '''
+  mesh = trimesh.creation.icosphere(subdivisions=subdivisions)
+  v = mesh.vertices.copy()
+  v = v+np.stack([0.2*v[:,1]**2, 0.3*v[:,0]*v[:,2], 0.25*np.clip(v[:,0],0,None)], axis=-1)
+  v = v*np.asarray(extents).reshape(1,3)/2
+  pattern = np.stack([np.sin(v[:,0]*90), np.sin(v[:,1]*70+1), np.sin((v[:,0]+v[:,2])*60+2)], axis=-1)
+  colors = (127.5+110*pattern).clip(0,255).astype(np.uint8)
+  return trimesh.Trimesh(vertices=v, faces=mesh.faces, vertex_colors=colors, process=False)
+
+
+def make_random_poses(n, distance, K, H, W, rng):
+  '''
+  @distance: (min, max) of the object depth
+  Return: (n,4,4) np array, random rotations with the object inside the middle half of the image
+  '''
+  poses = np.tile(np.eye(4)[None], (n,1,1))
+  for i in range(n):
+    poses[i,:3,:3] = Rotation.random(random_state=rng).as_matrix()
+    z = rng.uniform(*distance)
+    u = rng.uniform(W*0.25, W*0.75)
+    v = rng.uniform(H*0.25, H*0.75)
+    poses[i,:3,3] = (np.linalg.inv(K)@np.array([u,v,1]))*z
+  return poses
+
+
+def make_trajectory(pose_init, n_frames, rng, max_rot_deg=3, max_trans=0.005, jump_frames=[], jump_rot_deg=30, jump_trans=0.03):
+  '''Smooth motion: a random constant twist with a small random jitter per frame
+  @jump_frames: frames where the object jumps by @jump_rot_deg and @jump_trans in a random direction, e.g. to lose the track
+  Return: (n_frames,4,4) np array, starting at @pose_init
+  '''
+  rot_vel = rng.uniform(-1,1,3)*np.deg2rad(max_rot_deg)*0.7
+  trans_vel = rng.uniform(-1,1,3)*max_trans*0.7
+  poses = [pose_init]
+  for _ in range(n_frames-1):
+    rot = rot_vel+rng.uniform(-1,1,3)*np.deg2rad(max_rot_deg)*0.3
+    trans = trans_vel+rng.uniform(-1,1,3)*max_trans*0.3
+    pose = poses[-1].copy()
+    pose[:3,:3] = Rotation.from_rotvec(rot).as_matrix()@pose[:3,:3]
+    pose[:3,3] += trans
+    if len(poses) in jump_frames:
+      axis = rng.normal(size=3)
+      pose[:3,:3] = Rotation.from_rotvec(axis/np.linalg.norm(axis)*np.deg2rad(jump_rot_deg)).as_matrix()@pose[:3,:3]
+      direction = rng.normal(size=3)
+      pose[:3,3] += direction/np.linalg.norm(direction)*jump_trans
+    poses.append(pose)
+  return np.stack(poses, axis=0)
+
+
+class SyntheticScene:
+  '''Renders frames of one mesh in front of a textured, slanted background plane, with depth noise
+  '''
+  def __init__(self, mesh, H=480, W=640, K=None, depth_noise=0.001, seed=0, glctx=None, device='cuda'):
+    self.mesh = mesh
+    self.H = H
+    self.W = W
+    self.K = K if K is not None else np.array([[600,0,W/2],[0,600,H/2],[0,0,1]], dtype=np.float64)
+    self.depth_noise = depth_noise
+    self.rng = np.random.default_rng(seed)
+    self.device = device
+    self.glctx = glctx if glctx is not None else make_render_backend(device=device)
+    self.mesh_tensors = make_mesh_tensors(mesh, device=device)
+    vs, us = np.meshgrid(np.arange(H), np.arange(W), indexing='ij')
+    self.bg_depth = (1.2+0.3*(vs/H)+0.1*(us/W)).astype(np.float32)
+    self.bg_color = np.stack([90+40*np.sin(us/23.0), 100+40*np.sin(vs/17.0), 110+40*np.sin((us+vs)/31.0)], axis=-1).astype(np.uint8)
+
+
+  def render(self, ob_in_cam):
+    '''
+    @ob_in_cam: (4,4) np array
+    Return: rgb (H,W,3) uint8, depth (H,W) float32 meter, mask (H,W) bool
+    '''
+    pose = torch.as_tensor(ob_in_cam, dtype=torch.float, device=self.device).reshape(1,4,4)
+    color, depth, _ = nvdiffrast_render(K=self.K, H=self.H, W=self.W, ob_in_cams=pose, glctx=self.glctx, mesh_tensors=self.mesh_tensors, use_light=True, extra={})
+    color = (color[0]*255).round().clip(0,255).to(torch.uint8).data.cpu().numpy()
+    depth = depth[0].data.cpu().numpy()
+    mask = depth>=0.001
+    rgb = np.where(mask[...,None], color, self.bg_color)
+    depth = np.where(mask, depth, self.bg_depth)
+    depth = depth+self.rng.normal(0, self.depth_noise, depth.shape).astype(np.float32)
+    return rgb, depth.astype(np.float32), mask
+
+
+  def render_sequence(self, poses):
+    return [self.render(pose) for pose in poses]
+
+
+
+def pose_errors(pose, pose_gt):
+  '''
+  Return: rotation error in degree, translation error in meter
+  '''
+  R = pose[:3,:3].T@pose_gt[:3,:3]
+  rot_err = np.rad2deg(np.arccos(np.clip((np.trace(R)-1)/2, -1, 1)))
+  trans_err = np.linalg.norm(pose[:3,3]-pose_gt[:3,3])
+  return float(rot_err), float(trans_err)
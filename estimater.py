@@ -12,16 +12,124 @@ from datareader import *
 import itertools
 from learning.training.predict_score import *
 from learning.training.predict_pose_refine import *
+from asset_cache import *
+from template_bank import *
 import yaml
 
 
+class FrameData:
+  '''One RGB-D frame kept on the device, shared by the hypothesis generation, the refiner and the scorer so that it is uploaded only once
+  '''
+  def __init__(self, rgb, depth, K, mask=None, device='cuda'):
+    self.device = device
+    self.K = np.asarray(K)
+    self.K_inv = torch.as_tensor(np.linalg.inv(self.K), device=device, dtype=torch.float)
+    self.rgb = torch.as_tensor(rgb, device=device, dtype=torch.float)
+    self.depth = torch.as_tensor(depth, device=device, dtype=torch.float)
+    self.mask = None
+    if mask is not None:
+      self.mask = torch.as_tensor(mask, device=device)>0
+    self.H, self.W = self.depth.shape[:2]
+    self.xyz_map = None
+    self.roi = None
+
+
+  def filter_depth(self, radius=2, roi=None):
+    '''
+    @roi: optional (umin,vmin,umax,vmax), only filter this window and zero the depth outside. The window is padded by the kernel footprint so the result inside matches filtering the full image
+    '''
+    self.roi = roi
+    self.xyz_map = None
+    device = str(self.device)   # Warp device alias
+    if roi is None:
+      self.depth = erode_depth(self.depth, radius=radius, device=device)
+      self.depth = bilateral_filter_depth(self.depth, radius=radius, device=device)
+      return
+    umin, vmin, umax, vmax = roi
+    pad = 2*radius   # Erosion then bilateral, each reads radius neighbors
+    u0 = max(umin-pad, 0)
+    v0 = max(vmin-pad, 0)
+    u1 = min(umax+pad, self.W)
+    v1 = min(vmax+pad, self.H)
+    window = self.depth[v0:v1, u0:u1].contiguous()
+    window = erode_depth(window, radius=radius, device=device)
+    window = bilateral_filter_depth(window, radius=radius, device=device)
+    depth = torch.zeros_like(self.depth)
+    depth[vmin:vmax, umin:umax] = window[vmin-v0:vmax-v0, umin-u0:umax-u0]
+    self.depth = depth
+
+
+  def get_xyz_map(self, zfar=np.inf):
+    '''Back-projected from the filtered window only when filter_depth was given a roi, zeros outside
+    '''
+    if self.xyz_map is None:
+      K = torch.as_tensor(self.K, device=self.device, dtype=torch.float)
+      if self.roi is None:
+        self.xyz_map = depth2xyzmap_batch(self.depth[None], K[None], zfar=zfar)[0]
+      else:
+        umin, vmin, umax, vmax = self.roi
+        K_roi = K.clone()
+        K_roi[0,2] -= umin
+        K_roi[1,2] -= vmin
+        self.xyz_map = torch.zeros((self.H,self.W,3), device=self.device, dtype=torch.float)
+        self.xyz_map[vmin:vmax, umin:umax] = depth2xyzmap_batch(self.depth[None, vmin:vmax, umin:umax].contiguous(), K_roi[None], zfar=zfar)[0]
+    return self.xyz_map
+
+
+  def get_valid(self, mask=None):
+    if mask is None:
+      mask = self.mask
+    return mask & (self.depth>=0.001)
+
+
+  def guess_translation(self, mask=None):
+    '''Same as FoundationPose.guess_translation without leaving the device, zeros when the mask or its valid depth is empty
+    Return: (3,) tensor
+    '''
+    if mask is None:
+      mask = self.mask
+    rows = mask.any(dim=1)
+    cols = mask.any(dim=0)
+    vmin = rows.int().argmax()
+    vmax = self.H-1-rows.flip(0).int().argmax()
+    umin = cols.int().argmax()
+    umax = self.W-1-cols.flip(0).int().argmax()
+    uc = (umin+umax)/2.0
+    vc = (vmin+vmax)/2.0
+    valid = self.get_valid(mask)
+    zc = torch.nanquantile(torch.where(valid, self.depth, torch.full_like(self.depth, float('nan'))).reshape(-1), 0.5)   # Same as np.median
+    center = (self.K_inv@torch.stack([uc, vc, torch.ones_like(uc)]).float().reshape(3,1)).reshape(3)*zc
+    return torch.where(valid.any(), center, torch.zeros_like(center))
+
+
+
 class FoundationPose:
-  def __init__(self, model_pts, model_normals, symmetry_tfs=None, mesh=None, scorer:ScorePredictor=None, refiner:PoseRefinePredictor=None, glctx=None, debug=0, debug_dir='/home/bowen/debug/novel_pose_debug/'):
+  def __init__(self, model_pts, model_normals, symmetry_tfs=None, mesh=None, scorer:ScorePredictor=None, refiner:PoseRefinePredictor=None, glctx=None, debug=0, debug_dir='/home/bowen/debug/novel_pose_debug/', asset_cache_dir=None, cluster_backend='auto', diameter_method='sampled', device='cuda'):
+    '''
+    @device: where the frames, object tensors and hypotheses live, e.g. cuda or cpu. Also used for the default scorer/refiner; given ones are moved there
+    @asset_cache_dir: if set, the per-object assets computed by reset_object are cached on disk, see ObjectAssetCache
+    @cluster_backend: cpp/torch/auto, see Utils.cluster_poses
+    @diameter_method: sampled/exact, see make_object_assets. The diameter sets the crop windows and the network input normalization
+    '''
+    self.cluster_backend = cluster_backend
+    self.diameter_method = diameter_method
+    self.device = device
     self.gt_pose = None
     self.ignore_normal_flip = True
     self.debug = debug
     self.debug_dir = debug_dir
     os.makedirs(debug_dir, exist_ok=True)
+    self.asset_cache = None
+    self.rot_grid_cache = RotationGridCache()
+    self.template_bank_cache = TemplateBankCache()
+    if asset_cache_dir is not None:
+      self.asset_cache = ObjectAssetCache(asset_cache_dir)
+      self.rot_grid_cache = RotationGridCache(f'{asset_cache_dir}/rot_grids')
+      self.template_bank_cache = TemplateBankCache(f'{asset_cache_dir}/template_banks')
+    self.rot_grid_params = None
+    self.lod_params = None
+    self.template_bank_params = None
+    self.prune_stats = None
 
     self.reset_object(model_pts, model_normals, symmetry_tfs=symmetry_tfs, mesh=mesh)
     self.make_rotation_grid(min_n_views=40, inplane_step=60)
@@ -30,62 +138,102 @@ class FoundationPose:
 
     if scorer is not None:
       self.scorer = scorer
+      if str(self.scorer.device)!=str(self.device):
+        self.scorer.to_device(self.device)
     else:
-      self.scorer = ScorePredictor()
+      self.scorer = ScorePredictor(device=self.device)
 
     if refiner is not None:
       self.refiner = refiner
+      if str(self.refiner.device)!=str(self.device):
+        self.refiner.to_device(self.device)
     else:
-      self.refiner = PoseRefinePredictor()
+      self.refiner = PoseRefinePredictor(device=self.device)
 
     self.pose_last = None   # Used for tracking; per the centered mesh
+    self.pose_prev = None   # Pose of the frame before pose_last, for the motion prior
+    self.track_stats = None
+    self.set_tracker_mode()
+    self.set_icp_mode()
+    self.set_track_check_mode()
+    self.set_depth_roi_mode()
+    self.count_transfers = False   # Debug, count host<->device copies and syncs per call into self.transfer_stats
+    self.transfer_stats = None
+    self.objects = {}   # object_id -> per-object state, see add_object
 
 
   def reset_object(self, model_pts, model_normals, symmetry_tfs=None, mesh=None):
-    max_xyz = mesh.vertices.max(axis=0)
-    min_xyz = mesh.vertices.min(axis=0)
-    self.model_center = (min_xyz+max_xyz)/2
-    if mesh is not None:
-      self.mesh_ori = mesh.copy()
+    if self.asset_cache is not None:
+      assets = self.asset_cache.get_or_create(mesh, model_normals, diameter_method=self.diameter_method)
+    else:
+      assets = make_object_assets(mesh, model_normals, diameter_method=self.diameter_method)
+    self.model_center = np.array(assets['model_center'])
+    self.mesh_ori = mesh.copy()
+    if self.asset_cache is not None:
+      mesh = mesh_from_assets(assets)
+    else:
       mesh = mesh.copy()
       mesh.vertices = mesh.vertices - self.model_center.reshape(1,3)
 
-    model_pts = mesh.vertices
-    self.diameter = compute_mesh_diameter(model_pts=mesh.vertices, n_sample=10000)
-    self.vox_size = max(self.diameter/20.0, 0.003)
+    self.diameter = assets['diameter']
+    self.vox_size = assets['vox_size']
     logging.info(f'self.diameter:{self.diameter}, vox_size:{self.vox_size}')
     self.dist_bin = self.vox_size/2
     self.angle_bin = 20  # Deg
-    pcd = toOpen3dCloud(model_pts, normals=model_normals)
-    pcd = pcd.voxel_down_sample(self.vox_size)
-    self.max_xyz = np.asarray(pcd.points).max(axis=0)
-    self.min_xyz = np.asarray(pcd.points).min(axis=0)
-    self.pts = torch.tensor(np.asarray(pcd.points), dtype=torch.float32, device='cuda')
-    self.normals = F.normalize(torch.tensor(np.asarray(pcd.normals), dtype=torch.float32, device='cuda'), dim=-1)
+    self.min_xyz = np.array(assets['bounds'][0])
+    self.max_xyz = np.array(assets['bounds'][1])
+    self.pts = torch.tensor(np.array(assets['pts']), dtype=torch.float32, device=self.device)
+    self.normals = F.normalize(torch.tensor(np.array(assets['normals']), dtype=torch.float32, device=self.device), dim=-1)
     logging.info(f'self.pts:{self.pts.shape}')
-    self.mesh_path = None
     self.mesh = mesh
-    if self.mesh is not None:
+    if self.asset_cache is not None:
+      self.mesh_path = assets['mesh_path']
+    else:
       self.mesh_path = f'/tmp/{uuid.uuid4()}.obj'
       self.mesh.export(self.mesh_path)
-    self.mesh_tensors = make_mesh_tensors(self.mesh)
+    self.mesh_tensors = make_mesh_tensors(self.mesh, device=self.device)
+    self.mesh_lods = self.make_mesh_lods(self.mesh)
+    self.template_bank = None   # Made by the first register, see set_template_bank_mode
 
     if symmetry_tfs is None:
-      self.symmetry_tfs = torch.eye(4).float().cuda()[None]
+      self.symmetry_tfs = torch.eye(4, dtype=torch.float, device=self.device)[None]
     else:
-      self.symmetry_tfs = torch.as_tensor(symmetry_tfs, device='cuda', dtype=torch.float)
+      self.symmetry_tfs = torch.as_tensor(symmetry_tfs, device=self.device, dtype=torch.float)
+
+    if self.rot_grid_params is not None:   # Swap in the grid of this object's symmetry set
+      self.make_rotation_grid(**self.rot_grid_params)
 
     logging.info("reset done")
 
 
 
-  def get_tf_to_centered_mesh(self):
-    tf_to_center = torch.eye(4, dtype=torch.float, device='cuda')
-    tf_to_center[:3,3] = -torch.as_tensor(self.model_center, device='cuda', dtype=torch.float)
+  OBJECT_STATE_KEYS = ['model_center', 'mesh_ori', 'diameter', 'vox_size', 'dist_bin', 'angle_bin', 'max_xyz', 'min_xyz', 'pts', 'normals', 'mesh_path', 'mesh', 'mesh_tensors', 'mesh_lods', 'symmetry_tfs', 'rot_grid', 'template_bank']
+
+  def add_object(self, object_id, model_pts, model_normals, symmetry_tfs=None, mesh=None):
+    '''Register an object for register_many. Also makes it the current object for register/track_one
+    '''
+    self.reset_object(model_pts, model_normals, symmetry_tfs=symmetry_tfs, mesh=mesh)
+    self.objects[object_id] = {k: getattr(self, k) for k in self.OBJECT_STATE_KEYS if hasattr(self, k)}
+    logging.info(f'added object {object_id}, num objects:{len(self.objects)}')
+
+
+  def set_object(self, object_id):
+    '''Make a previously added object the current one for register/track_one
+    '''
+    for k,v in self.objects[object_id].items():
+      setattr(self, k, v)
+
+
+  def get_tf_to_centered_mesh(self, model_center=None):
+    if model_center is None:
+      model_center = self.model_center
+    tf_to_center = torch.eye(4, dtype=torch.float, device=self.device)
+    tf_to_center[:3,3] = -torch.as_tensor(model_center, device=self.device, dtype=torch.float)
     return tf_to_center
 
 
   def to_device(self, s='cuda:0'):
+    self.device = s
     for k in self.__dict__:
       self.__dict__[k] = self.__dict__[k]
       if torch.is_tensor(self.__dict__[k]) or isinstance(self.__dict__[k], nn.Module):
@@ -94,43 +242,53 @@ class FoundationPose:
     for k in self.mesh_tensors:
       logging.info(f"Moving {k} to device {s}")
       self.mesh_tensors[k] = self.mesh_tensors[k].to(s)
+    if self.mesh_lods is not None:
+      self.mesh_lods = [{k: v.to(s) for k,v in lod.items()} for lod in self.mesh_lods]
+    if self.template_bank is not None:
+      self.template_bank.to(s)
+    for object_id in self.objects:
+      for k,v in self.objects[object_id].items():
+        if torch.is_tensor(v):
+          self.objects[object_id][k] = v.to(s)
+      self.objects[object_id]['mesh_tensors'] = {k: v.to(s) for k,v in self.objects[object_id]['mesh_tensors'].items()}
+      if self.objects[object_id]['mesh_lods'] is not None:
+        self.objects[object_id]['mesh_lods'] = [{k: v.to(s) for k,v in lod.items()} for lod in self.objects[object_id]['mesh_lods']]
+      if self.objects[object_id]['template_bank'] is not None:
+        self.objects[object_id]['template_bank'].to(s)
     if self.refiner is not None:
-      self.refiner.model.to(s)
+      self.refiner.to_device(s)
     if self.scorer is not None:
-      self.scorer.model.to(s)
+      self.scorer.to_device(s)
     if self.glctx is not None:
-      self.glctx = dr.RasterizeCudaContext(s)
+      self.glctx = self.make_glctx()
+
 
 
+  def make_glctx(self):
+    '''nvdiffrast context on cuda, the TorchRasterizer render backend otherwise
+    '''
+    return make_render_backend(context='cuda', device=self.device)
+
 
   def make_rotation_grid(self, min_n_views=40, inplane_step=60):
-    cam_in_obs = sample_views_icosphere(n_views=min_n_views)
-    logging.info(f'cam_in_obs:{cam_in_obs.shape}')
-    rot_grid = []
-    for i in range(len(cam_in_obs)):
-      for inplane_rot in np.deg2rad(np.arange(0, 360, inplane_step)):
-        cam_in_ob = cam_in_obs[i]
-        R_inplane = euler_matrix(0,0,inplane_rot)
-        cam_in_ob = cam_in_ob@R_inplane
-        ob_in_cam = np.linalg.inv(cam_in_ob)
-        rot_grid.append(ob_in_cam)
-
-    rot_grid = np.asarray(rot_grid)
-    logging.info(f"rot_grid:{rot_grid.shape}")
-    rot_grid = mycpp.cluster_poses(30, 99999, rot_grid, self.symmetry_tfs.data.cpu().numpy())
-    rot_grid = np.asarray(rot_grid)
-    logging.info(f"after cluster, rot_grid:{rot_grid.shape}")
-    self.rot_grid = torch.as_tensor(rot_grid, device='cuda', dtype=torch.float)
+    '''Clustered under the current symmetry_tfs. Cached per symmetry set, see RotationGridCache
+    '''
+    self.rot_grid_params = {'min_n_views': min_n_views, 'inplane_step': inplane_step}
+    rot_grid = self.rot_grid_cache.get_or_create(min_n_views=min_n_views, inplane_step=inplane_step, symmetry_tfs=self.symmetry_tfs.data.cpu().numpy(), angle_diff=30, dist_diff=99999, cluster_backend=self.cluster_backend)
+    self.rot_grid = torch.as_tensor(rot_grid, device=self.device, dtype=torch.float)
+    self.template_bank = None
     logging.info(f"self.rot_grid: {self.rot_grid.shape}")
 
 
-  def generate_random_pose_hypo(self, K, rgb, depth, mask, scene_pts=None):
+  def generate_random_pose_hypo(self, K, rgb, depth, mask, scene_pts=None, center=None):
     '''
     @scene_pts: torch tensor (N,3)
+    @center: (3,) translation of all hypotheses, guessed from the mask if None
     '''
     ob_in_cams = self.rot_grid.clone()
-    center = self.guess_translation(depth=depth, mask=mask, K=K)
-    ob_in_cams[:,:3,3] = torch.tensor(center, device='cuda', dtype=torch.float).reshape(1,3)
+    if center is None:
+      center = self.guess_translation(depth=depth, mask=mask, K=K)
+    ob_in_cams[:,:3,3] = torch.as_tensor(center, device=self.device, dtype=torch.float).reshape(1,3)
     return ob_in_cams
 
 
@@ -156,24 +314,33 @@ class FoundationPose:
     return center.reshape(3)
 
 
-  def register(self, K, rgb, depth, ob_mask, ob_id=None, glctx=None, iteration=5):
+  @traced('register')
+  @count_device_transfers
+  def register(self, K, rgb, depth, ob_mask, ob_id=None, glctx=None, iteration=5, keep_ratios=None, min_keep=4):
     '''Copmute pose from given pts to self.pcd
     @pts: (N,3) np array, downsampled scene points
+    @keep_ratios: successive halving schedule. After refinement pass i (except the last), the survivors are scored and the top keep_ratios[i] fraction is kept. None to refine all hypotheses for all iterations
+    @min_keep: never prune below this number of hypotheses
     '''
     set_seed(0)
-    logging.info('Welcome')
+    self.prune_stats = None
 
     if self.glctx is None:
       if glctx is None:
-        self.glctx = dr.RasterizeCudaContext()
+        self.glctx = self.make_glctx()
         # self.glctx = dr.RasterizeGLContext()
       else:
         self.glctx = glctx
 
-    depth = erode_depth(depth, radius=2, device='cuda')
-    depth = bilateral_filter_depth(depth, radius=2, device='cuda')
+    with span('depth_filter'):
+      frame = FrameData(rgb=rgb, depth=depth, K=K, mask=ob_mask, device=self.device)
+      roi = None
+      if self.depth_roi:
+        roi = compute_crop_roi(K, frame.guess_translation()[None], radius=self.diameter*self.refiner.cfg['crop_ratio']/2, H=frame.H, W=frame.W, margin=self.depth_roi_margin)   # Translation from the unfiltered depth, the margin covers the difference
+      frame.filter_depth(radius=2, roi=roi)
 
     if self.debug>=2:
+      depth = frame.depth.data.cpu().numpy()
       xyz_map = depth2xyzmap(depth, K)
       valid = xyz_map[...,2]>=0.001
       pcd = toOpen3dCloud(xyz_map[valid], rgb[valid])
@@ -181,11 +348,11 @@ class FoundationPose:
       cv2.imwrite(f'{self.debug_dir}/ob_mask.png', (ob_mask*255.0).clip(0,255))
 
     normal_map = None
-    valid = (depth>=0.001) & (ob_mask>0)
-    if valid.sum()<4:
+    center = frame.guess_translation()
+    if frame.get_valid().sum().item()<4:
       logging.info(f'valid too small, return')
       pose = np.eye(4)
-      pose[:3,3] = self.guess_translation(depth=depth, mask=ob_mask, K=K)
+      pose[:3,3] = center.data.cpu().numpy()
       return pose
 
     if self.debug>=2:
@@ -194,44 +361,55 @@ class FoundationPose:
       valid = xyz_map[...,2]>=0.001
       pcd = toOpen3dCloud(xyz_map[valid], rgb[valid])
       o3d.io.write_point_cloud(f'{self.debug_dir}/scene_complete.ply',pcd)
+      pcd = toOpen3dCloud(center.data.cpu().numpy().reshape(1,3))
+      o3d.io.write_point_cloud(f'{self.debug_dir}/init_center.ply', pcd)
 
-    self.H, self.W = depth.shape[:2]
+    self.H, self.W = frame.H, frame.W
     self.K = K
     self.ob_id = ob_id
     self.ob_mask = ob_mask
 
-    poses = self.generate_random_pose_hypo(K=K, rgb=rgb, depth=depth, mask=ob_mask, scene_pts=None)
-    poses = poses.data.cpu().numpy()
-    logging.info(f'poses:{poses.shape}')
-    center = self.guess_translation(depth=depth, mask=ob_mask, K=K)
-
-    poses = torch.as_tensor(poses, device='cuda', dtype=torch.float)
-    poses[:,:3,3] = torch.as_tensor(center.reshape(1,3), device='cuda')
-
-    add_errs = self.compute_add_err_to_gt_pose(poses)
-    logging.info(f"after viewpoint, add_errs min:{add_errs.min()}")
+    with span('hypotheses'):
+      template_bank = self.get_template_bank()
+      if template_bank is not None:
+        poses = template_bank.make_hypotheses(center)
+      else:
+        poses = self.generate_random_pose_hypo(K=K, rgb=rgb, depth=depth, mask=ob_mask, scene_pts=None, center=center)
+    logging.debug('poses:%s', poses.shape)
 
-    xyz_map = depth2xyzmap(depth, K)
-    poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, get_vis=self.debug>=2)
-    if vis is not None:
-      imageio.imwrite(f'{self.debug_dir}/vis_refiner.png', vis)
+    if self.debug>=2:
+      add_errs = self.compute_add_err_to_gt_pose(poses)
+      logging.debug('after viewpoint, add_errs min:%s', add_errs.min())
+
+    xyz_map = frame.get_xyz_map()
+    if keep_ratios is None:
+      vis = None
+      for i_group, (level, n_iter) in enumerate(self.get_lod_schedule(iteration)):
+        cur_template_bank = template_bank if i_group==0 else None
+        poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.get_mesh_tensors(level), rgb=frame.rgb, depth=frame.depth, K=K, ob_in_cams=poses, normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=n_iter, get_vis=self.debug>=2, template_bank=cur_template_bank, template_ids=torch.arange(len(poses), device=self.device))
+      if vis is not None:
+        imageio.imwrite(f'{self.debug_dir}/vis_refiner.png', vis)
+    else:
+      poses = self.refine_with_pruning(poses, rgb=frame.rgb, depth=frame.depth, K=K, xyz_map=xyz_map, normal_map=normal_map, iteration=iteration, keep_ratios=keep_ratios, min_keep=min_keep, template_bank=template_bank)
 
-    scores, vis = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, get_vis=self.debug>=2)
+    scores, vis = self.scorer.predict(mesh=self.mesh, rgb=frame.rgb, depth=frame.depth, K=K, ob_in_cams=poses, normal_map=normal_map, mesh_tensors=self.get_mesh_tensors(self.get_lod_level('score')), glctx=self.glctx, mesh_diameter=self.diameter, get_vis=self.debug>=2)
     if vis is not None:
       imageio.imwrite(f'{self.debug_dir}/vis_score.png', vis)
 
-    add_errs = self.compute_add_err_to_gt_pose(poses)
-    logging.info(f"final, add_errs min:{add_errs.min()}")
-
     ids = torch.as_tensor(scores).argsort(descending=True)
-    logging.info(f'sort ids:{ids}')
     scores = scores[ids]
     poses = poses[ids]
 
-    logging.info(f'sorted scores:{scores}')
+    if self.debug>=2:
+      add_errs = self.compute_add_err_to_gt_pose(poses)
+      logging.debug('final, add_errs min:%s', add_errs.min())
+      logging.debug('sort ids:%s', ids)
+      logging.debug('sorted scores:%s', scores)
 
     best_pose = poses[0]@self.get_tf_to_centered_mesh()
     self.pose_last = poses[0]
+    self.pose_prev = None
+    self.n_icp_frames = 0
     self.best_id = ids[0]
 
     self.poses = poses
@@ -240,30 +418,457 @@ class FoundationPose:
     return best_pose.data.cpu().numpy()
 
 
+  @traced('register_many')
+  @count_device_transfers
+  def register_many(self, K, rgb, depth, instances, glctx=None, iteration=5):
+    '''Register several object instances in the same frame. The frame is preprocessed once and the hypotheses of all instances share the refiner and scorer batches
+    @instances: list of (object_id, ob_mask), object_id added by add_object. The same object_id can appear multiple times
+    Return: list of (4,4) np array, one pose per instance
+    '''
+    set_seed(0)
+    self.prune_stats = None
+
+    if self.glctx is None:
+      if glctx is None:
+        self.glctx = self.make_glctx()
+      else:
+        self.glctx = glctx
+
+    with span('depth_filter'):
+      frame = FrameData(rgb=rgb, depth=depth, K=K, device=self.device)
+      masks = [torch.as_tensor(ob_mask, device=self.device)>0 for _, ob_mask in instances]
+      roi = None
+      if self.depth_roi:
+        roi_centers = torch.stack([frame.guess_translation(mask) for mask in masks], dim=0)
+        roi_diameters = torch.as_tensor([self.objects[object_id]['diameter'] for object_id, _ in instances], device=self.device, dtype=torch.float)
+        roi = compute_crop_roi(K, roi_centers, radius=roi_diameters*self.refiner.cfg['crop_ratio']/2, H=frame.H, W=frame.W, margin=self.depth_roi_margin)
+      frame.filter_depth(radius=2, roi=roi)
+    xyz_map = frame.get_xyz_map()
+
+    object_ids = []
+    for object_id, _ in instances:
+      if object_id not in object_ids:
+        object_ids.append(object_id)
+
+    centers = torch.stack([frame.guess_translation(mask) for mask in masks], dim=0)
+    n_valids = torch.stack([frame.get_valid(mask).sum() for mask in masks], dim=0).tolist()   # One sync for all instances
+
+    out_poses = [None]*len(instances)
+    poses = []
+    mesh_ids = []
+    diameters = []
+    group_sizes = []
+    valid_instances = []
+    for i_inst, (object_id, _) in enumerate(instances):
+      state = self.objects[object_id]
+      if n_valids[i_inst]<4:
+        logging.info(f'instance {i_inst} valid too small, skip')
+        pose = np.eye(4)
+        pose[:3,3] = centers[i_inst].data.cpu().numpy()
+        out_poses[i_inst] = pose
+        continue
+      cur_poses = state['rot_grid'].clone()
+      cur_poses[:,:3,3] = centers[i_inst].reshape(1,3)
+      poses.append(cur_poses)
+      mesh_ids.append(torch.full((len(cur_poses),), object_ids.index(object_id), device=self.device, dtype=torch.long))
+      diameters.append(torch.full((len(cur_poses),), state['diameter'], device=self.device, dtype=torch.float))
+      group_sizes.append(len(cur_poses))
+      valid_instances.append(i_inst)
+
+    if len(valid_instances)==0:
+      return out_poses
+
+    poses = torch.cat(poses, dim=0)
+    mesh_ids = torch.cat(mesh_ids, dim=0)
+    diameters = torch.cat(diameters, dim=0)
+    logging.debug('poses:%s, instances:%d', poses.shape, len(valid_instances))
+
+    for level, n_iter in self.get_lod_schedule(iteration):
+      mesh_tensors = [self.get_mesh_tensors(level, self.objects[object_id]) for object_id in object_ids]
+      poses, _ = self.refiner.predict(mesh=None, mesh_tensors=mesh_tensors, mesh_ids=mesh_ids, rgb=frame.rgb, depth=frame.depth, K=K, ob_in_cams=poses, normal_map=None, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=diameters, iteration=n_iter, get_vis=False)
+    mesh_tensors = [self.get_mesh_tensors(self.get_lod_level('score'), self.objects[object_id]) for object_id in object_ids]
+    scores, _ = self.scorer.predict(mesh=None, mesh_tensors=mesh_tensors, mesh_ids=mesh_ids, group_sizes=group_sizes, rgb=frame.rgb, depth=frame.depth, K=K, ob_in_cams=poses, normal_map=None, glctx=self.glctx, mesh_diameter=diameters, get_vis=False)
+
+    best_poses = []
+    start = 0
+    for i_inst, group_size in zip(valid_instances, group_sizes):
+      best_id = scores[start:start+group_size].argmax()+start
+      model_center = self.objects[instances[i_inst][0]]['model_center']
+      best_poses.append(poses[best_id]@self.get_tf_to_centered_mesh(model_center))
+      start += group_size
+    best_poses = torch.stack(best_poses, dim=0).data.cpu().numpy()
+    for i, i_inst in enumerate(valid_instances):
+      out_poses[i_inst] = best_poses[i]
+
+    return out_poses
+
+
+  def refine_with_pruning(self, poses, rgb, depth, K, xyz_map, normal_map, iteration, keep_ratios, min_keep=4, template_bank=None):
+    '''Successive halving: refine one pass at a time and only keep the best scored hypotheses for the next pass
+    @poses: (N,4,4) tensor
+    @template_bank: for the first pass, @poses from its make_hypotheses
+    Saves the render/network counts to self.prune_stats, which register resets to None when it does not prune
+    '''
+    n_init = len(poses)
+    n_refine = 0
+    n_score = 0
+    for i in range(iteration):
+      mesh_tensors = self.get_mesh_tensors(self.get_lod_level('refine', i))
+      poses, _ = self.refiner.predict(mesh=self.mesh, mesh_tensors=mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=1, get_vis=False, template_bank=template_bank if i==0 else None, template_ids=torch.arange(len(poses), device=self.device))
+      n_refine += len(poses)
+      if i==iteration-1 or i>=len(keep_ratios) or keep_ratios[i]>=1:
+        continue
+      n_keep = max(min_keep, int(np.ceil(len(poses)*keep_ratios[i])))
+      if n_keep>=len(poses):
+        continue
+      scores, _ = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=normal_map, mesh_tensors=mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, get_vis=False)
+      n_score += len(poses)
+      ids = scores.argsort(descending=True)[:n_keep]
+      poses = poses[ids]
+      logging.debug('iter %d, kept %d hypotheses', i, n_keep)
+
+    n_score += len(poses)   # The final scoring done by the caller
+    self.prune_stats = {
+      'n_hypotheses': n_init,
+      'n_survivors': len(poses),
+      'n_refine_renders': n_refine,
+      'n_score_renders': n_score,
+      'n_refine_renders_saved': n_init*iteration-n_refine,
+      'n_renders_saved': n_init*(iteration+1)-n_refine-n_score,
+    }
+    logging.debug('prune_stats:%s', self.prune_stats)
+    return poses
+
+
   def compute_add_err_to_gt_pose(self, poses):
     '''
     @poses: wrt. the centered mesh
     '''
-    return -torch.ones(len(poses), device='cuda', dtype=torch.float)
+    return -torch.ones(len(poses), device=self.device, dtype=torch.float)
 
 
-  def track_one(self, rgb, depth, K, iteration, extra={}):
-    if self.pose_last is None:
-      logging.info("Please init pose by register first")
-      raise RuntimeError
-    logging.info("Welcome")
+  def set_mem_budget(self, mem_budget=None, mem_fraction=0.5):
+    '''Share one BatchPlanner between the refiner and the scorer
+    @mem_budget: bytes for rendering and inference chunks, None for @mem_fraction of the free device memory
+    '''
+    planner = BatchPlanner(mem_budget=mem_budget, mem_fraction=mem_fraction, device=self.device)
+    self.refiner.planner = planner
+    self.scorer.planner = planner
+
 
-    depth = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-    depth = erode_depth(depth, radius=2, device='cuda')
-    depth = bilateral_filter_depth(depth, radius=2, device='cuda')
-    logging.info("depth processing done")
+  def get_workspace_stats(self):
+    return {'refiner': self.refiner.arena.get_stats(), 'scorer': self.scorer.arena.get_stats()}
 
-    xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(K, dtype=torch.float, device='cuda')[None], zfar=np.inf)[0]
 
-    pose, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=self.pose_last.reshape(1,4,4).data.cpu().numpy(), normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=iteration, get_vis=self.debug>=2)
-    logging.info("pose done")
+  def release_workspace(self):
+    '''Free the refiner/scorer workspaces and the allocator cache, e.g. between videos. Per call release is set by the predictors' release_policy
+    '''
+    self.refiner.arena.release()
+    self.scorer.arena.release()
+    if torch.device(self.device).type=='cuda':
+      torch.cuda.empty_cache()
+
+
+  def get_batch_plans(self):
+    '''Chunk sizes and per hypothesis memory estimates of the last refiner/scorer calls
+    '''
+    return {**self.refiner.planner.plans, **self.scorer.planner.plans}
+
+
+  def set_depth_roi_mode(self, enabled=False, margin=0.5):
+    '''Filter the depth only inside a window around the object: the refiner/scorer crop window around the guessed translation in register, around the predicted pose in track_one. Depth and xyz map are zero outside
+    @margin: ratio of the window half size added on each side
+    '''
+    self.depth_roi = enabled
+    self.depth_roi_margin = margin
+
+
+  def set_template_bank_mode(self, enabled=False, distance_ratio=4):
+    '''Make the crops of the first refiner pass of register from a TemplateBank of the rotation grid instead of rendering them. The bank is built by the first register of each object, cached on disk with the assets.
+    Register then starts from TemplateBank.make_hypotheses, the rotation grid turned towards the object centre, instead of generate_random_pose_hypo. See benchmarks/check_template_bank.py for the accuracy of both
+    @distance_ratio: canonical distance of the templates in object diameters
+    '''
+    self.template_bank_params = None
+    if enabled:
+      self.template_bank_params = {'distance_ratio': distance_ratio}
+    self.template_bank = None
+    for object_id in self.objects:
+      self.objects[object_id]['template_bank'] = None
+
+
+  def get_template_bank(self):
+    '''TemplateBank of the current object and rotation grid, None when disabled
+    '''
+    if self.template_bank_params is None:
+      return None
+    if self.template_bank is None:
+      self.template_bank = self.template_bank_cache.get_or_create(self.mesh, self.mesh_tensors, self.rot_grid, mesh_diameter=self.diameter, crop_size=self.refiner.cfg['input_resize'], crop_ratio=self.refiner.cfg['crop_ratio'], glctx=self.glctx, distance_ratio=self.template_bank_params['distance_ratio'], device=self.device)
+      for object_id in self.objects:
+        if self.objects[object_id]['mesh'] is self.mesh:
+          self.objects[object_id]['template_bank'] = self.template_bank
+    return self.template_bank
+
+
+  def set_lod_mode(self, enabled=False, pixels_per_face=[4,1], max_tex_sizes=[256,512], refine_levels=[0,0,1], track_level=1, score_level=None):
+    '''Render decimated meshes with downsampled uint8 textures, see make_mesh_lods. Built for the current and the added objects, and by reset_object while enabled
+    Levels index the LODs from coarse to fine, None is the full mesh
+    @pixels_per_face: per LOD, crop pixels per face of the triangle budget at the refiner input size, see lod_face_budget
+    @max_tex_sizes: per LOD
+    @refine_levels: LOD of each refiner iteration of register/register_many, the last one is used for the remaining iterations
+    @track_level: LOD of track_one
+    @score_level: LOD of the final scoring
+    '''
+    self.lod_params = None
+    if enabled:
+      self.lod_params = {'pixels_per_face': pixels_per_face, 'max_tex_sizes': max_tex_sizes, 'refine_levels': refine_levels, 'track_level': track_level, 'score_level': score_level}
+    mesh_lods = self.make_mesh_lods(self.mesh)
+    for object_id in self.objects:
+      state = self.objects[object_id]
+      state['mesh_lods'] = mesh_lods if state['mesh'] is self.mesh else self.make_mesh_lods(state['mesh'])
+    self.mesh_lods = mesh_lods
+
+
+  def make_mesh_lods(self, mesh):
+    if self.lod_params is None:
+      return None
+    return make_mesh_lods(mesh, render_size=self.refiner.cfg['input_resize'], pixels_per_face=self.lod_params['pixels_per_face'], max_tex_sizes=self.lod_params['max_tex_sizes'], device=self.device)
+
+
+  def get_lod_level(self, stage, i=0):
+    '''
+    @stage: refine (of refiner iteration @i), track or score
+    Return: LOD index, None for the full mesh
+    '''
+    if self.lod_params is None:
+      return None
+    if stage=='refine':
+      levels = self.lod_params['refine_levels']
+      return levels[min(i, len(levels)-1)]
+    return self.lod_params[f'{stage}_level']
+
+
+  def get_lod_schedule(self, iteration):
+    '''Consecutive refiner iterations at the same LOD, so that each run is one refiner call
+    Return: list of (level, n_iterations)
+    '''
+    levels = [self.get_lod_level('refine', i) for i in range(iteration)]
+    return [(level, len(list(group))) for level, group in itertools.groupby(levels)]
+
+
+  def get_mesh_tensors(self, level, state=None):
+    '''
+    @state: per-object state of add_object, None for the current object
+    '''
+    if state is None:
+      state = {'mesh_tensors': self.mesh_tensors, 'mesh_lods': self.mesh_lods}
+    if level is None or state['mesh_lods'] is None:
+      return state['mesh_tensors']
+    return state['mesh_lods'][level]
+
+
+  def set_tracker_mode(self, motion_prior=False, trans_thres=None, rot_thres=None):
+    '''Optional behaviour of track_one, off by default
+    @motion_prior: start the refiner from a constant velocity prediction of the last two poses instead of pose_last
+    @trans_thres: meter, stop refining once the translation update of an iteration falls below it. Both thresholds must be met when both are given
+    @rot_thres: degree, same for the rotation update
+    '''
+    self.motion_prior = motion_prior
+    self.track_trans_thres = trans_thres
+    self.track_rot_thres = rot_thres
+
+
+  def set_icp_mode(self, enabled=False, n_iter=10, max_dist_ratio=0.1, min_inlier_ratio=0.7, max_rms_ratio=0.02, refine_every=10):
+    '''Track with point-to-plane ICP of the downsampled model points against the depth, from the track_one start pose, see icp_point_to_plane. The refiner runs instead when the fit is poor, and every @refine_every frames
+    @max_dist_ratio: max correspondence distance, ratio of the diameter
+    @min_inlier_ratio: of the model points facing the camera
+    @max_rms_ratio: point-to-plane rms of the inliers, ratio of the diameter
+    @refine_every: frames tracked by ICP before the refiner runs once, None to only run it when ICP fails
+    '''
+    self.icp_params = None
+    if enabled:
+      self.icp_params = {'n_iter': n_iter, 'max_dist_ratio': max_dist_ratio, 'min_inlier_ratio': min_inlier_ratio, 'max_rms_ratio': max_rms_ratio, 'refine_every': refine_every}
+    self.n_icp_frames = 0   # Since the last refiner run
+
+
+  def track_icp(self, pose, frame, K):
+    '''
+    @pose: (1,4,4) start pose
+    Return: ICP pose (1,4,4), None when the refiner should run instead, and the decision for track_stats
+    '''
+    params = self.icp_params
+    if params['refine_every'] is not None and self.n_icp_frames>=params['refine_every']:
+      return None, {'mode': 'refiner', 'reason': 'periodic'}
+    with span('icp'):
+      pose_icp, inlier_ratio, rms = icp_point_to_plane(self.pts, self.normals, pose, frame.depth, K, max_dist=self.diameter*params['max_dist_ratio'], n_iter=params['n_iter'])
+      inlier_ratio, rms = torch.stack([inlier_ratio, rms]).tolist()   # One sync for the decision
+    decision = {'icp_inlier_ratio': inlier_ratio, 'icp_rms': rms}
+    if inlier_ratio<params['min_inlier_ratio']:
+      decision.update({'mode': 'refiner', 'reason': 'low_inliers'})
+      return None, decision
+    if rms>self.diameter*params['max_rms_ratio']:
+      decision.update({'mode': 'refiner', 'reason': 'high_residual'})
+      return None, decision
+    decision.update({'mode': 'icp', 'reason': 'ok'})
+    return pose_icp.reshape(1,4,4), decision
+
+
+  def set_track_check_mode(self, enabled=False, crop_size=64, depth_thres_ratio=0.1, min_confidence=0.6, min_visible_ratio=0.2, relocalize=True, max_rot_deg=60, trans_radius_ratio=0.25, iteration=2):
+    '''Check every track_one pose by rendering its depth in a small crop window and comparing with the observed depth, see check_track. When the track is lost, relocalize around pose_last instead of a full register
+    @depth_thres_ratio: rendered and observed depth agree within this ratio of the diameter
+    @min_confidence: of the agreeing pixels among the rendered ones not occluded in the observation
+    @min_visible_ratio: of the rendered pixels not occluded, below it the pose can not be verified and counts as lost
+    @max_rot_deg: relocalization rotations, the rotation grid within this angle applied to the rotation of pose_last
+    @trans_radius_ratio: relocalization translations, pose_last and 4 offsets of this ratio of the diameter in the image plane
+    @iteration: refiner iterations of the relocalization
+    '''
+    self.track_check_params = None
+    if enabled:
+      self.track_check_params = {'crop_size': crop_size, 'depth_thres_ratio': depth_thres_ratio, 'min_confidence': min_confidence, 'min_visible_ratio': min_visible_ratio, 'relocalize': relocalize, 'max_rot_deg': max_rot_deg, 'trans_radius_ratio': trans_radius_ratio, 'iteration': iteration}
+
+
+  def check_track(self, pose, frame, K):
+    '''Depth of @pose rendered in its crop window against the observed depth. Observed depth in front of the rendering is an occluder and not counted, behind it the object is missing
+    @pose: (1,4,4)
+    Return: dict of confidence, visible_ratio and lost
+    '''
+    params = self.track_check_params
+    S = params['crop_size']
+    tf_to_crops = compute_crop_window_tf_batch(H=frame.H, W=frame.W, poses=pose, K=K, crop_ratio=self.refiner.cfg['crop_ratio'], out_size=(S,S), method='box_3d', mesh_diameter=self.diameter)
+    bbox2d_crop = torch.as_tensor(np.array([0, 0, S-1, S-1]).reshape(2,2), device=self.device, dtype=torch.float)
+    bbox2d = transform_pts(bbox2d_crop, tf_to_crops.inverse()).reshape(-1,4)
+    _, depth_r, _ = nvdiffrast_render(K=K, H=frame.H, W=frame.W, ob_in_cams=pose, glctx=self.glctx, mesh_tensors=self.get_mesh_tensors(self.get_lod_level('track')), output_size=(S,S), bbox2d=bbox2d, extra={})
+    depth_o = crop_shared_images([frame.depth[None]], tf_to_crops, dsize=(S,S), mode='nearest', axis_aligned=True)[0]
+    depth_r = depth_r.reshape(S,S)
+    depth_o = depth_o.reshape(S,S)
+    thres = self.diameter*params['depth_thres_ratio']
+    rendered = depth_r>=0.001
+    observed = rendered & (depth_o>=0.001)
+    match = observed & ((depth_o-depth_r).abs()<thres)
+    behind = observed & (depth_o-depth_r>=thres)
+    n_visible = match.sum()+behind.sum()
+    confidence, visible_ratio = torch.stack([match.sum()/n_visible.clip(min=1), n_visible/rendered.sum().clip(min=1)]).tolist()   # One sync
+    lost = confidence<params['min_confidence'] or visible_ratio<params['min_visible_ratio']
+    return {'confidence': confidence, 'visible_ratio': visible_ratio, 'lost': lost}
+
+
+  def make_local_hypotheses(self, pose):
+    '''Rotations of the grid within max_rot_deg of the identity (and the identity) applied to the rotation of @pose, times the translation of @pose and 4 offsets around it in the image plane
+    @pose: (4,4) tensor
+    Return: (N,4,4) tensor
+    '''
+    params = self.track_check_params
+    cos = ((self.rot_grid[:,:3,:3].diagonal(dim1=-2, dim2=-1).sum(dim=-1)-1)/2).clip(-1,1)
+    near = self.rot_grid[cos>=np.cos(np.deg2rad(params['max_rot_deg'])), :3, :3]
+    rots = torch.cat([torch.eye(3, device=self.device, dtype=torch.float)[None], near], dim=0)@pose[:3,:3]
+    r = self.diameter*params['trans_radius_ratio']
+    offsets = torch.tensor([[0,0,0], [r,0,0], [-r,0,0], [0,r,0], [0,-r,0]], device=self.device, dtype=torch.float)
+    poses = torch.eye(4, device=self.device, dtype=torch.float)[None].repeat(len(rots)*len(offsets),1,1)
+    poses[:,:3,:3] = rots.repeat_interleave(len(offsets), dim=0)
+    poses[:,:3,3] = (pose[:3,3][None]+offsets).repeat(len(rots),1)
+    return poses
+
+
+  def relocalize(self, frame, K):
+    '''Register from make_local_hypotheses of pose_last, a fraction of the full rotation grid with fewer refiner iterations
+    Return: best pose (1,4,4), number of hypotheses
+    '''
+    poses = self.make_local_hypotheses(self.pose_last.reshape(4,4))
+    xyz_map = frame.get_xyz_map()
+    poses, _ = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.get_mesh_tensors(self.get_lod_level('track')), rgb=frame.rgb, depth=frame.depth, K=K, ob_in_cams=poses, normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=self.track_check_params['iteration'], get_vis=False)
+    scores, _ = self.scorer.predict(mesh=self.mesh, mesh_tensors=self.get_mesh_tensors(self.get_lod_level('score')), rgb=frame.rgb, depth=frame.depth, K=K, ob_in_cams=poses, normal_map=None, glctx=self.glctx, mesh_diameter=self.diameter, get_vis=False)
+    return poses[scores.argmax()].reshape(1,4,4), len(poses)
+
+
+  def predict_track_init(self):
+    '''Constant velocity SE(3) motion model in the camera frame: repeat the motion from pose_prev to pose_last
+    '''
+    if not self.motion_prior or self.pose_prev is None:
+      return self.pose_last.reshape(1,4,4)
+    motion = self.pose_last.reshape(4,4)@torch.linalg.inv(self.pose_prev.reshape(4,4))
+    return (motion@self.pose_last.reshape(4,4)).reshape(1,4,4)
+
+
+  def is_track_converged(self):
+    '''Whether the last refiner update is below the tracker thresholds. Costs one sync
+    '''
+    if self.track_trans_thres is None and self.track_rot_thres is None:
+      return False
+    converged = torch.ones((), dtype=torch.bool, device=self.device)
+    if self.track_trans_thres is not None:
+      trans_update = self.refiner.last_trans_update.reshape(-1,3).norm(dim=-1).max()
+      converged &= trans_update<self.track_trans_thres
+    if self.track_rot_thres is not None:
+      rot_mat_delta = self.refiner.last_rot_update.reshape(-1,3,3)
+      cos = ((rot_mat_delta.diagonal(dim1=-2, dim2=-1).sum(dim=-1)-1)/2).clip(-1,1)
+      rot_update = torch.rad2deg(torch.arccos(cos)).max()
+      converged &= rot_update<self.track_rot_thres
+    return bool(converged.item())
+
+
+  @traced('track_one')
+  @count_device_transfers
+  def track_one(self, rgb, depth, K, iteration, extra=None):
+    '''
+    @iteration: max number of refiner iterations, fewer are run when the early exit of set_tracker_mode is enabled, none for the frames tracked by ICP, see set_icp_mode
+    @extra: optional dict, gets track_stats and with debug>=2 the refiner vis
+    With set_track_check_mode, track_stats tell whether the track is lost, after relocalizing if enabled. register again with a mask when it still is
+    '''
+    if self.pose_last is None:
+      logging.info("Please init pose by register first")
+      raise RuntimeError
+    if extra is None:
+      extra = {}
+
+    pose = self.predict_track_init()
+
+    with span('depth_filter'):
+      frame = FrameData(rgb=rgb, depth=depth, K=K, device=self.device)
+      roi = None
+      if self.depth_roi:
+        roi = compute_crop_roi(K, pose[:,:3,3], radius=self.diameter*self.refiner.cfg['crop_ratio']/2, H=frame.H, W=frame.W, margin=self.depth_roi_margin)
+      frame.filter_depth(radius=2, roi=roi)
+
+    pose_icp = None
+    decision = {'mode': 'refiner', 'reason': 'icp_disabled'}
+    if self.icp_params is not None:
+      pose_icp, decision = self.track_icp(pose, frame, K)
+    if pose_icp is not None:
+      pose = pose_icp
+      n_iter = 0
+      vis = None
+      self.n_icp_frames += 1
+    else:
+      xyz_map = frame.get_xyz_map()
+      early_exit = self.track_trans_thres is not None or self.track_rot_thres is not None
+      mesh_tensors = self.get_mesh_tensors(self.get_lod_level('track'))
+      if not early_exit:
+        pose, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=mesh_tensors, rgb=frame.rgb, depth=frame.depth, K=K, ob_in_cams=pose, normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=iteration, get_vis=self.debug>=2)
+        n_iter = iteration
+      else:
+        for n_iter in range(1, iteration+1):
+          pose, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=mesh_tensors, rgb=frame.rgb, depth=frame.depth, K=K, ob_in_cams=pose, normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=1, get_vis=self.debug>=2)
+          if self.is_track_converged():
+            break
+      self.n_icp_frames = 0
+
+    relocalized = False
+    if self.track_check_params is not None:
+      with span('track_check'):
+        decision.update(self.check_track(pose, frame, K))
+      if decision['lost'] and self.track_check_params['relocalize']:
+        with span('relocalize'):
+          pose, decision['n_local_hypotheses'] = self.relocalize(frame, K)
+          decision['confidence_before'] = decision['confidence']
+          decision.update(self.check_track(pose, frame, K))
+        relocalized = True
+        self.n_icp_frames = 0
+      decision['relocalized'] = relocalized
+    logging.debug('pose done, iterations:%d', n_iter)
+    self.track_stats = {'n_iterations': n_iter, 'max_iterations': iteration, 'motion_prior': self.motion_prior and self.pose_prev is not None, **decision}
+    extra['track_stats'] = self.track_stats
     if self.debug>=2:
       extra['vis'] = vis
+    self.pose_prev = self.pose_last if not relocalized else None   # No motion prior across a relocalization
     self.pose_last = pose
     return (pose@self.get_tf_to_centered_mesh()).data.cpu().numpy().reshape(4,4)
 
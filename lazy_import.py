@@ -0,0 +1,43 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import importlib
+
+
+class LazyModule:
+  '''Stands in for a module that is only imported on the first attribute access, for the heavy dependencies that the pose estimation and tracking path does not need
+  '''
+  def __init__(self, name):
+    self._name = name
+    self._module = None
+
+
+  def _load(self):
+    if self._module is None:
+      self._module = importlib.import_module(self._name)
+    return self._module
+
+
+  def __getattr__(self, k):
+    return getattr(self._load(), k)
+
+
+  def __repr__(self):
+    state = 'loaded' if self._module is not None else 'not loaded'
+    return f'<lazy module {self._name}, {state}>'
+
+
+
+def lazy_callable(module_name, name):
+  '''Function or class @name of @module_name, imported on the first call
+  '''
+  def fn(*args, **kwargs):
+    return getattr(importlib.import_module(module_name), name)(*args, **kwargs)
+  fn.__name__ = name
+  return fn
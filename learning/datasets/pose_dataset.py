@@ -117,15 +117,18 @@ class BatchPoseData:
                 pass
         return self
 
-    def cuda(self):
+    def to(self, device):
         for k in self.__dict__:
             if self.__dict__[k] is not None:
               try:
-                self.__dict__[k] = self.__dict__[k].cuda()
+                self.__dict__[k] = self.__dict__[k].to(device)
               except:
                 pass
         return self
 
+    def cuda(self):
+        return self.to('cuda')
+
     def select_by_indices(self, ids):
       out = BatchPoseData()
       for k in self.__dict__:
@@ -79,9 +79,16 @@ class ScoreNetMultiPair(nn.Module):
     @A: (B*L,C,H,W) L is num of pairs
     @L: num of pairs
     """
-    output = {}
-    bs = A.shape[0]//L
     feats = self.extract_feat(A, B)   #(B*L, C)
+    return self.score_feats(feats, L)
+
+
+  def score_feats(self, feats, L):
+    """Cross attention among the L pairs of each group and the score logits. extract_feat is per pair, so the features can be computed in chunks and scored together
+    @feats: (B*L,C) from extract_feat
+    """
+    output = {}
+    bs = feats.shape[0]//L
     x = feats.reshape(bs,L,-1)
     x, _ = self.att_cross(x, x, x)
 
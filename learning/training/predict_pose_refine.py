@@ -8,7 +8,7 @@
 
 
 import functools
-import os,sys,kornia
+import os,sys
 import time
 code_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(f'{code_dir}/../../')
@@ -19,87 +19,117 @@ from learning.models.refine_network import RefineNet
 from learning.datasets.h5_dataset import *
 from Utils import *
 from datareader import *
+from weight_store import *
 
 
 
 @torch.inference_mode()
-def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, xyz_map, normal_map=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, dataset:PoseRefinePairH5Dataset=None):
-  logging.info("Welcome make_crop_data_batch")
+def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, xyz_map, normal_map=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, dataset:PoseRefinePairH5Dataset=None, mesh_ids=None, render_bs=512, device='cuda', template_bank=None, template_ids=None, arena=None, arena_slot=0):
+  '''
+  @mesh_tensors: dict, or list of dict when hypotheses of several objects are batched together
+  @mesh_ids: (B,) index into @mesh_tensors of each hypothesis
+  @mesh_diameter: float, or (B,) tensor of per-hypothesis diameters
+  @render_bs: hypotheses rasterized at once, see BatchPlanner
+  @device: where the crops are made, the inputs are moved there if needed
+  @template_bank: TemplateBank, warp its templates @template_ids instead of rendering, without normals. The hypotheses must come from its make_hypotheses
+  @arena: WorkspaceArena the crops of the real image are written to, @arena_slot picks the buffers so that the chunks alive at once do not share them
+  '''
   H,W = depth.shape[:2]
   args = []
   method = 'box_3d'
-  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=ob_in_cams, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
-
-  logging.info("make tf_to_crops done")
+  poseA = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
+  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices if mesh is not None else None, H=H, W=W, poses=poseA, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
 
   B = len(ob_in_cams)
-  poseA = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
 
-  bs = 512
+  bs = render_bs
   rgb_rs = []
   depth_rs = []
   normal_rs = []
   xyz_map_rs = []
 
-  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device='cuda', dtype=torch.float)
+  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device=device, dtype=torch.float)
   bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()).reshape(-1,4)
 
-  for b in range(0,len(poseA),bs):
-    extra = {}
-    rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseA[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
-    rgb_rs.append(rgb_r)
-    depth_rs.append(depth_r[...,None])
-    normal_rs.append(normal_r)
-    xyz_map_rs.append(extra['xyz_map'])
-  rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
-  depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)  #(B,1,H,W)
-  xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
-  Ks = torch.as_tensor(K, device='cuda', dtype=torch.float).reshape(1,3,3)
-  if cfg['use_normal']:
-    normal_rs = torch.cat(normal_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
-
-  logging.info("render done")
-
-  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-  if rgb_rs.shape[-2:]!=cfg['input_resize']:
-    rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-  else:
-    rgbAs = rgb_rs
-  if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
-    xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  else:
-    xyz_mapAs = xyz_map_rs
-  xyz_mapBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(xyz_map, device='cuda', dtype=torch.float).permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)  #(B,3,H,W)
-
-  if cfg['use_normal']:
-    normalAs = kornia.geometry.transform.warp_perspective(normal_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-    normalBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(normal_map, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  else:
-    normalAs = None
-    normalBs = None
-
-  logging.info("warp done")
-
-  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device='cuda')*mesh_diameter
-  pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=None, depthBs=None, normalAs=normalAs, normalBs=normalBs, poseA=poseA, poseB=None, xyz_mapAs=xyz_mapAs, xyz_mapBs=xyz_mapBs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
-  pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1)
-
-  logging.info("pose batch data done")
+  Ks = torch.as_tensor(K, device=device, dtype=torch.float).reshape(1,3,3)
+  with span('template_crops' if template_bank is not None else 'render', n=B):
+    if template_bank is not None:
+      rgbAs, xyz_mapAs = template_bank.make_crops(template_ids, poseA, K, tf_to_crops, dsize=render_size)
+    else:
+      render_ids = []
+      for ids, cur_mesh_tensors in make_render_groups(B, mesh_tensors, mesh_ids=mesh_ids, device=device):
+        for b in range(0,len(ids),bs):
+          cur_ids = ids[b:b+bs]
+          extra = {}
+          rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseA[cur_ids], get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=cur_mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[cur_ids], use_light=True, extra=extra)
+          rgb_rs.append(rgb_r)
+          depth_rs.append(depth_r[...,None])
+          normal_rs.append(normal_r)
+          xyz_map_rs.append(extra['xyz_map'])
+          render_ids.append(cur_ids)
+      render_ids = torch.cat(render_ids, dim=0)
+      order = torch.empty_like(render_ids)
+      order[render_ids] = torch.arange(len(render_ids), device=render_ids.device)   # Back to the hypotheses order
+      rgb_rs = torch.cat(rgb_rs, dim=0)[order].permute(0,3,1,2) * 255
+      depth_rs = torch.cat(depth_rs, dim=0)[order].permute(0,3,1,2)  #(B,1,H,W)
+      xyz_map_rs = torch.cat(xyz_map_rs, dim=0)[order].permute(0,3,1,2)  #(B,3,H,W)
+      if cfg['use_normal']:
+        normal_rs = torch.cat(normal_rs, dim=0)[order].permute(0,3,1,2)  #(B,3,H,W)
+      if rgb_rs.shape[-2:]!=cfg['input_resize']:
+        rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
+      else:
+        rgbAs = rgb_rs
+      if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
+        xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+      else:
+        xyz_mapAs = xyz_map_rs
+
+  def get_crop_buffer(name, C):
+    if arena is None:
+      return None
+    return arena.get(f'{name}{arena_slot}', (B,C,*render_size), dtype=torch.float, device=device)
+
+  with span('warp', n=B):
+    axis_aligned = method=='box_3d'
+    rgbBs = crop_shared_images([torch.as_tensor(rgb, dtype=torch.float, device=device).permute(2,0,1)], tf_to_crops, dsize=render_size, mode='bilinear', axis_aligned=axis_aligned, out=get_crop_buffer('rgbB', 3))[0]
+
+    if cfg['use_normal']:
+      normalAs = kornia.geometry.transform.warp_perspective(normal_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+      xyz_mapBs, normalBs = crop_shared_images([torch.as_tensor(xyz_map, device=device, dtype=torch.float).permute(2,0,1), torch.as_tensor(normal_map, dtype=torch.float, device=device).permute(2,0,1)], tf_to_crops, dsize=render_size, mode='nearest', axis_aligned=axis_aligned, out=get_crop_buffer('xyz_normalB', 6))
+    else:
+      xyz_mapBs = crop_shared_images([torch.as_tensor(xyz_map, device=device, dtype=torch.float).permute(2,0,1)], tf_to_crops, dsize=render_size, mode='nearest', axis_aligned=axis_aligned, out=get_crop_buffer('xyzB', 3))[0]  #(B,3,H,W)
+      normalAs = None
+      normalBs = None
+
+  with span('transform', n=B):
+    mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device=device)*mesh_diameter
+    pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=None, depthBs=None, normalAs=normalAs, normalBs=normalBs, poseA=poseA, poseB=None, xyz_mapAs=xyz_mapAs, xyz_mapBs=xyz_mapBs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
+    pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1, device=device)
 
   return pose_data
 
 
 
 class PoseRefinePredictor:
-  def __init__(self,):
+  ACTIVATION_CHANNELS = 48   # Peak RefineNet activations per hypothesis, in channels of the input resolution
+
+  def __init__(self, device='cuda', run_name='2023-10-28-18-33-37', weights_dir=None, weight_store_dir=None):
+    '''
+    @device: where the crops are made and the network runs, e.g. cuda or cpu. AMP is only used on cuda
+    @run_name: the checkpoint is @weights_dir/@run_name/model_best.pth, with its config.yml
+    @weights_dir: None for the weights dir of the repo
+    @weight_store_dir: load the checkpoint through a WeightStore there, memory mapped and shared between processes. None to torch.load it
+    '''
     logging.info("welcome")
+    self.device = device
     self.amp = True
-    self.run_name = "2023-10-28-18-33-37"
+    self.run_name = run_name
     model_name = 'model_best.pth'
-    code_dir = os.path.dirname(os.path.realpath(__file__))
-    ckpt_dir = f'{code_dir}/../../weights/{self.run_name}/{model_name}'
+    if weights_dir is None:
+      weights_dir = f'{os.path.dirname(os.path.realpath(__file__))}/../../weights'
+    ckpt_dir = f'{weights_dir}/{self.run_name}/{model_name}'
 
-    self.cfg = OmegaConf.load(f'{code_dir}/../../weights/{self.run_name}/config.yml')
+    self.cfg = OmegaConf.load(f'{weights_dir}/{self.run_name}/config.yml')
 
     self.cfg['ckpt_dir'] = ckpt_dir
     self.cfg['enable_amp'] = True
@@ -132,66 +162,116 @@ class PoseRefinePredictor:
     logging.info(f"self.cfg: \n {OmegaConf.to_yaml(self.cfg)}")
 
     self.dataset = PoseRefinePairH5Dataset(cfg=self.cfg, h5_file='', mode='test')
-    self.model = RefineNet(cfg=self.cfg, c_in=self.cfg['c_in']).cuda()
+    self.model = RefineNet(cfg=self.cfg, c_in=self.cfg['c_in']).to(self.device)
 
     logging.info(f"Using pretrained model from {ckpt_dir}")
-    ckpt = torch.load(ckpt_dir)
-    if 'model' in ckpt:
-      ckpt = ckpt['model']
-    self.model.load_state_dict(ckpt)
-
-    self.model.cuda().eval()
+    if weight_store_dir is not None:
+      assign_state_dict(self.model, WeightStore(weight_store_dir).load(ckpt_dir))
+    else:
+      ckpt = torch.load(ckpt_dir, map_location=self.device)
+      if 'model' in ckpt:
+        ckpt = ckpt['model']
+      self.model.load_state_dict(ckpt)
+
+    self.model.to(self.device).eval()
     logging.info("init done")
     self.last_trans_update = None
     self.last_rot_update = None
+    self.trans_normalizer = None
+    self.chunk_size = None   # Hypotheses per render/network chunk, None to plan it with self.planner
+    self.planner = BatchPlanner(device=self.device)
+    self.arena = WorkspaceArena()
+    self.release_policy = 'never'   # never: keep the workspace and the allocator cache across calls. always: free both after every predict
 
 
+  def to_device(self, device):
+    self.device = device
+    self.model.to(device)
+    self.trans_normalizer = None
+    self.planner.device = device
+    self.arena.release()
+
+
+  def plan_batches(self, n, mesh_tensors):
+    '''Two chunks are alive at a time, the one being rendered and the one in the network
+    '''
+    plan = self.planner.plan('refiner', n, self.cfg['input_resize'], n_vertices=get_mesh_tensors_n_vertices(mesh_tensors), use_normal=self.cfg['use_normal'], net_activation_channels=self.ACTIVATION_CHANNELS, amp=self.amp, n_alive=2)
+    if self.chunk_size is not None:
+      plan['network'] = self.chunk_size
+      plan['render'] = min(plan['render'], self.chunk_size)
+    return plan
+
+
+  def release_workspace_by_policy(self):
+    if self.release_policy=='always':
+      self.arena.release()
+      if torch.device(self.device).type=='cuda':
+        torch.cuda.empty_cache()
+    elif self.release_policy!='never':
+      raise RuntimeError(f'unknown release_policy {self.release_policy}')
+
+
+  def get_trans_normalizer(self):
+    '''Uploaded once and reused, instead of a host to device copy per predict call
+    '''
+    if self.trans_normalizer is None:
+      trans_normalizer = self.cfg['trans_normalizer']
+      if not isinstance(trans_normalizer, float):
+        trans_normalizer = torch.as_tensor(list(trans_normalizer), device=self.device, dtype=torch.float).reshape(1,3)
+      self.trans_normalizer = trans_normalizer
+    return self.trans_normalizer
+
+
+  @traced('refine')
   @torch.inference_mode()
-  def predict(self, rgb, depth, K, ob_in_cams, xyz_map, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, iteration=5):
+  def predict(self, rgb, depth, K, ob_in_cams, xyz_map, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, iteration=5, mesh_ids=None, template_bank=None, template_ids=None):
     '''
-    @rgb: np array (H,W,3)
-    @ob_in_cams: np array (N,4,4)
+    @rgb: np array or tensor (H,W,3), @depth and @xyz_map likewise. Tensors already on self.device are used without a copy
+    @ob_in_cams: np array or tensor (N,4,4)
+    @mesh_ids: (N,) when @mesh_tensors is a list of several objects' mesh_tensors, see make_crop_data_batch
+    @template_bank: TemplateBank of the hypotheses, used for the crops of the first iteration. @template_ids (N,) template of each hypothesis
     '''
-    torch.set_default_tensor_type('torch.cuda.FloatTensor')
-    logging.info(f'ob_in_cams:{ob_in_cams.shape}')
-    tf_to_center = np.eye(4)
+    logging.debug('ob_in_cams:%s', ob_in_cams.shape)
     ob_centered_in_cams = ob_in_cams
     mesh_centered = mesh
 
-    logging.info(f'self.cfg.use_normal:{self.cfg.use_normal}')
     if not self.cfg.use_normal:
       normal_map = None
 
     crop_ratio = self.cfg['crop_ratio']
-    logging.info(f"trans_normalizer:{self.cfg['trans_normalizer']}, rot_normalizer:{self.cfg['rot_normalizer']}")
-    bs = 1024
-
-    B_in_cams = torch.as_tensor(ob_centered_in_cams, device='cuda', dtype=torch.float)
+    B_in_cams = torch.as_tensor(ob_centered_in_cams, device=self.device, dtype=torch.float)
 
 
     if mesh_tensors is None:
-      mesh_tensors = make_mesh_tensors(mesh_centered)
-
-    rgb_tensor = torch.as_tensor(rgb, device='cuda', dtype=torch.float)
-    depth_tensor = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-    xyz_map_tensor = torch.as_tensor(xyz_map, device='cuda', dtype=torch.float)
-    trans_normalizer = self.cfg['trans_normalizer']
-    if not isinstance(trans_normalizer, float):
-      trans_normalizer = torch.as_tensor(list(trans_normalizer), device='cuda', dtype=torch.float).reshape(1,3)
-
-    for _ in range(iteration):
-      logging.info("making cropped data")
-      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
+      mesh_tensors = make_mesh_tensors(mesh_centered, device=self.device)
+
+    rgb_tensor = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    depth_tensor = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    xyz_map_tensor = torch.as_tensor(xyz_map, device=self.device, dtype=torch.float)
+    trans_normalizer = self.get_trans_normalizer()
+
+    n = len(B_in_cams)
+    plan = self.plan_batches(n, mesh_tensors)
+    logging.debug('batch plan: %s', self.planner)
+    mesh_diameter_is_batched = torch.is_tensor(mesh_diameter) and mesh_diameter.ndim>0
+    device_type = torch.device(self.device).type
+    if self.cfg['use_normal']:
+      template_bank = None
+    for i_iter in range(iteration):
+      def prepare_chunk(start, end, B_in_cams=B_in_cams, template_bank=template_bank if i_iter==0 else None):
+        return make_crop_data_batch(self.cfg.input_resize, B_in_cams[start:end], mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter[start:end] if mesh_diameter_is_batched else mesh_diameter, mesh_ids=mesh_ids[start:end] if mesh_ids is not None else None, render_bs=plan['render'], device=self.device, template_bank=template_bank, template_ids=template_ids[start:end] if template_bank is not None else None, arena=self.arena, arena_slot=(start//plan['network'])%2)
+
       B_in_cams = []
-      for b in range(0, pose_data.rgbAs.shape[0], bs):
-        A = torch.cat([pose_data.rgbAs[b:b+bs].cuda(), pose_data.xyz_mapAs[b:b+bs].cuda()], dim=1).float()
-        B = torch.cat([pose_data.rgbBs[b:b+bs].cuda(), pose_data.xyz_mapBs[b:b+bs].cuda()], dim=1).float()
-        logging.info("forward start")
-        with torch.cuda.amp.autocast(enabled=self.amp):
-          output = self.model(A,B)
-        for k in output:
-          output[k] = output[k].float()
-        logging.info("forward done")
+      trans_deltas = []
+      rot_mat_deltas = []
+      for start, end, pose_data in iter_chunks_overlapped(n, plan['network'], prepare_chunk, device=self.device):   # Renders chunk k+1 while the network runs on chunk k
+        A = cat_into(self.arena, 'A', [pose_data.rgbAs.float(), pose_data.xyz_mapAs.float()], dim=1)
+        B = cat_into(self.arena, 'B', [pose_data.rgbBs.float(), pose_data.xyz_mapBs.float()], dim=1)
+        with span('network', n=len(A)):
+          with torch.autocast(device_type=device_type, enabled=self.amp and device_type=='cuda'):
+            output = self.model(A,B)
+          for k in output:
+            output[k] = output[k].float()
         if self.cfg['trans_rep']=='tracknet':
           if not self.cfg['normalize_xyz']:
             trans_delta = torch.tanh(output["trans"])*trans_normalizer
@@ -200,19 +280,19 @@ class PoseRefinePredictor:
 
         elif self.cfg['trans_rep']=='deepim':
           def project_and_transform_to_crop(centers):
-            uvs = (pose_data.Ks[b:b+bs]@centers.reshape(-1,3,1)).reshape(-1,3)
+            uvs = (pose_data.Ks@centers.reshape(-1,3,1)).reshape(-1,3)
             uvs = uvs/uvs[:,2:3]
-            uvs = (pose_data.tf_to_crops[b:b+bs]@uvs.reshape(-1,3,1)).reshape(-1,3)
+            uvs = (pose_data.tf_to_crops@uvs.reshape(-1,3,1)).reshape(-1,3)
             return uvs[:,:2]
 
           rot_delta = output["rot"]
-          z_pred = output['trans'][:,2]*pose_data.poseA[b:b+bs][...,2,3]
-          uvA_crop = project_and_transform_to_crop(pose_data.poseA[b:b+bs][...,:3,3])
+          z_pred = output['trans'][:,2]*pose_data.poseA[...,2,3]
+          uvA_crop = project_and_transform_to_crop(pose_data.poseA[...,:3,3])
           uv_pred_crop = uvA_crop + output['trans'][:,:2]*self.cfg['input_resize'][0]
-          uv_pred = transform_pts(uv_pred_crop, pose_data.tf_to_crops[b:b+bs].inverse().cuda())
-          center_pred = torch.cat([uv_pred, torch.ones((len(rot_delta),1), dtype=torch.float, device='cuda')], dim=-1)
-          center_pred = (pose_data.Ks[b:b+bs].inverse().cuda()@center_pred.reshape(len(rot_delta),3,1)).reshape(len(rot_delta),3) * z_pred.reshape(len(rot_delta),1)
-          trans_delta = center_pred-pose_data.poseA[b:b+bs][...,:3,3]
+          uv_pred = transform_pts(uv_pred_crop, pose_data.tf_to_crops.inverse())
+          center_pred = torch.cat([uv_pred, torch.ones((len(rot_delta),1), dtype=torch.float, device=self.device)], dim=-1)
+          center_pred = (pose_data.Ks.inverse()@center_pred.reshape(len(rot_delta),3,1)).reshape(len(rot_delta),3) * z_pred.reshape(len(rot_delta),1)
+          trans_delta = center_pred-pose_data.poseA[...,:3,3]
 
         else:
           trans_delta = output["trans"]
@@ -226,23 +306,24 @@ class PoseRefinePredictor:
           raise RuntimeError
 
         if self.cfg['normalize_xyz']:
-          trans_delta *= (mesh_diameter/2)
+          trans_delta *= (pose_data.mesh_diameters.reshape(-1,1)/2)
 
-        B_in_cam = egocentric_delta_pose_to_pose(pose_data.poseA[b:b+bs], trans_delta=trans_delta, rot_mat_delta=rot_mat_delta)
+        B_in_cam = egocentric_delta_pose_to_pose(pose_data.poseA, trans_delta=trans_delta, rot_mat_delta=rot_mat_delta)
         B_in_cams.append(B_in_cam)
+        trans_deltas.append(trans_delta)
+        rot_mat_deltas.append(rot_mat_delta)
 
       B_in_cams = torch.cat(B_in_cams, dim=0).reshape(len(ob_in_cams),4,4)
 
-    B_in_cams_out = B_in_cams@torch.tensor(tf_to_center[None], device='cuda', dtype=torch.float)
-    torch.cuda.empty_cache()
-    self.last_trans_update = trans_delta
-    self.last_rot_update = rot_mat_delta
+    B_in_cams_out = B_in_cams
+    self.release_workspace_by_policy()
+    self.last_trans_update = torch.cat(trans_deltas, dim=0)   # Of the last iteration, all chunks
+    self.last_rot_update = torch.cat(rot_mat_deltas, dim=0)
 
     if get_vis:
-      logging.info("get_vis...")
       canvas = []
       padding = 2
-      pose_data = make_crop_data_batch(self.cfg.input_resize, torch.as_tensor(ob_centered_in_cams), mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
+      pose_data = make_crop_data_batch(self.cfg.input_resize, torch.as_tensor(ob_centered_in_cams, device=self.device, dtype=torch.float), mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, mesh_ids=mesh_ids, device=self.device)
       for id in range(0, len(B_in_cams)):
         rgbA_vis = (pose_data.rgbAs[id]*255).permute(1,2,0).data.cpu().numpy()
         rgbB_vis = (pose_data.rgbBs[id]*255).permute(1,2,0).data.cpu().numpy()
@@ -266,7 +347,7 @@ class PoseRefinePredictor:
         canvas.append(row)
       canvas = make_grid_image(canvas, nrow=1, padding=padding, pad_value=255)
 
-      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
+      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, mesh_ids=mesh_ids, device=self.device)
       canvas_refined = []
       for id in range(0, len(B_in_cams)):
         rgbA_vis = (pose_data.rgbAs[id]*255).permute(1,2,0).data.cpu().numpy()
@@ -289,7 +370,6 @@ class PoseRefinePredictor:
 
       canvas_refined = make_grid_image(canvas_refined, nrow=1, padding=padding, pad_value=255)
       canvas = make_grid_image([canvas, canvas_refined], nrow=2, padding=padding, pad_value=255)
-      torch.cuda.empty_cache()
       return B_in_cams_out, canvas
 
     return B_in_cams_out, None
@@ -8,7 +8,7 @@
 
 
 import functools
-import os,sys,kornia
+import os,sys
 import time
 import numpy as np
 import torch
@@ -22,6 +22,7 @@ from learning.models.score_network import *
 from learning.datasets.pose_dataset import *
 from Utils import *
 from datareader import *
+from weight_store import *
 
 
 def vis_batch_data_scores(pose_data, ids, scores, pad_margin=5):
@@ -54,76 +55,105 @@ def vis_batch_data_scores(pose_data, ids, scores, pad_margin=5):
 
 
 @torch.no_grad()
-def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, normal_map=None, mesh_diameter=None, glctx=None, mesh_tensors=None, dataset:TripletH5Dataset=None, cfg=None):
-  logging.info("Welcome make_crop_data_batch")
+def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, normal_map=None, mesh_diameter=None, glctx=None, mesh_tensors=None, dataset:TripletH5Dataset=None, cfg=None, mesh_ids=None, render_bs=512, device='cuda', arena=None):
+  '''
+  @mesh_tensors: dict, or list of dict when hypotheses of several objects are batched together
+  @mesh_ids: (B,) index into @mesh_tensors of each hypothesis
+  @mesh_diameter: float, or (B,) tensor of per-hypothesis diameters
+  @render_bs: hypotheses rasterized at once, see BatchPlanner
+  @device: where the crops are made, the inputs are moved there if needed
+  @arena: WorkspaceArena the crops of the real image are written to
+  '''
   H,W = depth.shape[:2]
 
   args = []
   method = 'box_3d'
-  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=ob_in_cams, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
-  logging.info("make tf_to_crops done")
+  poseAs = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
+  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices if mesh is not None else None, H=H, W=W, poses=poseAs, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
 
   B = len(ob_in_cams)
-  poseAs = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
 
-  bs = 512
+  bs = render_bs
   rgb_rs = []
   depth_rs = []
   xyz_map_rs = []
 
-  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device='cuda', dtype=torch.float)
-  bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()[:,None]).reshape(-1,4)
-
-  for b in range(0,len(ob_in_cams),bs):
-    extra = {}
-    rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseAs[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
-    rgb_rs.append(rgb_r)
-    depth_rs.append(depth_r[...,None])
-    xyz_map_rs.append(extra['xyz_map'])
-
-  rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
-  depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)
-  xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
-  logging.info("render done")
-
-  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-  depthBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(depth, dtype=torch.float, device='cuda')[None,None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  if rgb_rs.shape[-2:]!=cfg['input_resize']:
-    rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-    depthAs = kornia.geometry.transform.warp_perspective(depth_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  else:
-    rgbAs = rgb_rs
-    depthAs = depth_rs
-
-  if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
-    xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-  else:
-    xyz_mapAs = xyz_map_rs
+  with span('render', n=B):
+    bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device=device, dtype=torch.float)
+    bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()[:,None]).reshape(-1,4)
+
+    render_ids = []
+    for ids, cur_mesh_tensors in make_render_groups(B, mesh_tensors, mesh_ids=mesh_ids, device=device):
+      for b in range(0,len(ids),bs):
+        cur_ids = ids[b:b+bs]
+        extra = {}
+        rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseAs[cur_ids], get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=cur_mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[cur_ids], use_light=True, extra=extra)
+        rgb_rs.append(rgb_r)
+        depth_rs.append(depth_r[...,None])
+        xyz_map_rs.append(extra['xyz_map'])
+        render_ids.append(cur_ids)
+    render_ids = torch.cat(render_ids, dim=0)
+    order = torch.empty_like(render_ids)
+    order[render_ids] = torch.arange(len(render_ids), device=render_ids.device)   # Back to the hypotheses order
+
+    rgb_rs = torch.cat(rgb_rs, dim=0)[order].permute(0,3,1,2) * 255
+    depth_rs = torch.cat(depth_rs, dim=0)[order].permute(0,3,1,2)
+    xyz_map_rs = torch.cat(xyz_map_rs, dim=0)[order].permute(0,3,1,2)  #(B,3,H,W)
+
+  def get_crop_buffer(name, C):
+    if arena is None:
+      return None
+    return arena.get(name, (B,C,*render_size), dtype=torch.float, device=device)
+
+  with span('warp', n=B):
+    axis_aligned = method=='box_3d'
+    rgbBs = crop_shared_images([torch.as_tensor(rgb, dtype=torch.float, device=device).permute(2,0,1)], tf_to_crops, dsize=render_size, mode='bilinear', axis_aligned=axis_aligned, out=get_crop_buffer('rgbB', 3))[0]
+    depthBs = crop_shared_images([torch.as_tensor(depth, dtype=torch.float, device=device)[None]], tf_to_crops, dsize=render_size, mode='nearest', axis_aligned=axis_aligned, out=get_crop_buffer('depthB', 1))[0]
+    if rgb_rs.shape[-2:]!=cfg['input_resize']:
+      rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
+      depthAs = kornia.geometry.transform.warp_perspective(depth_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+    else:
+      rgbAs = rgb_rs
+      depthAs = depth_rs
+
+    if xyz_map_rs.shape[-2:]!=cfg['input_resize']:
+      xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+    else:
+      xyz_mapAs = xyz_map_rs
 
   normalAs = None
   normalBs = None
 
-  Ks = torch.as_tensor(K, dtype=torch.float).reshape(1,3,3).expand(len(rgbAs),3,3)
-  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device='cuda')*mesh_diameter
+  with span('transform', n=B):
+    Ks = torch.as_tensor(K, dtype=torch.float, device=device).reshape(1,3,3).expand(len(rgbAs),3,3)
+    mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device=device)*mesh_diameter
 
-  pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=depthAs, depthBs=depthBs, normalAs=normalAs, normalBs=normalBs, poseA=poseAs, xyz_mapAs=xyz_mapAs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
-  pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1)
-
-  logging.info("pose batch data done")
+    pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=depthAs, depthBs=depthBs, normalAs=normalAs, normalBs=normalBs, poseA=poseAs, xyz_mapAs=xyz_mapAs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
+    pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1, device=device)
 
   return pose_data
 
 
 class ScorePredictor:
-  def __init__(self, amp=True):
+  ACTIVATION_CHANNELS = 48   # Peak ScoreNetMultiPair activations per hypothesis, in channels of the input resolution
+
+  def __init__(self, amp=True, device='cuda', run_name='2024-01-11-20-02-45', weights_dir=None, weight_store_dir=None):
+    '''
+    @device: where the crops are made and the network runs, e.g. cuda or cpu. AMP is only used on cuda
+    @run_name: the checkpoint is @weights_dir/@run_name/model_best.pth, with its config.yml
+    @weights_dir: None for the weights dir of the repo
+    @weight_store_dir: load the checkpoint through a WeightStore there, memory mapped and shared between processes. None to torch.load it
+    '''
+    self.device = device
     self.amp = amp
-    self.run_name = "2024-01-11-20-02-45"
+    self.run_name = run_name
 
     model_name = 'model_best.pth'
-    code_dir = os.path.dirname(os.path.realpath(__file__))
-    ckpt_dir = f'{code_dir}/../../weights/{self.run_name}/{model_name}'
+    if weights_dir is None:
+      weights_dir = f'{os.path.dirname(os.path.realpath(__file__))}/../../weights'
+    ckpt_dir = f'{weights_dir}/{self.run_name}/{model_name}'
 
-    self.cfg = OmegaConf.load(f'{code_dir}/../../weights/{self.run_name}/config.yml')
+    self.cfg = OmegaConf.load(f'{weights_dir}/{self.run_name}/config.yml')
 
     self.cfg['ckpt_dir'] = ckpt_dir
     self.cfg['enable_amp'] = True
@@ -145,79 +175,106 @@ class ScorePredictor:
     logging.info(f"self.cfg: \n {OmegaConf.to_yaml(self.cfg)}")
 
     self.dataset = ScoreMultiPairH5Dataset(cfg=self.cfg, mode='test', h5_file=None, max_num_key=1)
-    self.model = ScoreNetMultiPair(cfg=self.cfg, c_in=self.cfg['c_in']).cuda()
+    self.model = ScoreNetMultiPair(cfg=self.cfg, c_in=self.cfg['c_in']).to(self.device)
 
     logging.info(f"Using pretrained model from {ckpt_dir}")
-    ckpt = torch.load(ckpt_dir)
-    if 'model' in ckpt:
-      ckpt = ckpt['model']
-    self.model.load_state_dict(ckpt)
-
-    self.model.cuda().eval()
+    if weight_store_dir is not None:
+      assign_state_dict(self.model, WeightStore(weight_store_dir).load(ckpt_dir))
+    else:
+      ckpt = torch.load(ckpt_dir, map_location=self.device)
+      if 'model' in ckpt:
+        ckpt = ckpt['model']
+      self.model.load_state_dict(ckpt)
+
+    self.model.to(self.device).eval()
+    self.planner = BatchPlanner(device=self.device)
+    self.arena = WorkspaceArena()
+    self.release_policy = 'never'   # never: keep the workspace and the allocator cache across calls. always: free both after every predict
     logging.info("init done")
 
 
+  def to_device(self, device):
+    self.device = device
+    self.model.to(device)
+    self.planner.device = device
+    self.arena.release()
+
+
+  def release_workspace_by_policy(self):
+    if self.release_policy=='always':
+      self.arena.release()
+      if torch.device(self.device).type=='cuda':
+        torch.cuda.empty_cache()
+    elif self.release_policy!='never':
+      raise RuntimeError(f'unknown release_policy {self.release_policy}')
+
+
+  @traced('score')
   @torch.inference_mode()
-  def predict(self, rgb, depth, K, ob_in_cams, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None):
+  def predict(self, rgb, depth, K, ob_in_cams, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, mesh_ids=None, group_sizes=None):
     '''
     @rgb: np array (H,W,3)
+    @mesh_ids: (N,) when @mesh_tensors is a list of several objects' mesh_tensors, see make_crop_data_batch
+    @group_sizes: list of the number of consecutive hypotheses of each instance. The hypotheses of one instance are only compared among themselves
     '''
-    logging.info(f"ob_in_cams:{ob_in_cams.shape}")
-    ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
+    logging.debug('ob_in_cams:%s', ob_in_cams.shape)
+    ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device=self.device)
 
-    logging.info(f'self.cfg.use_normal:{self.cfg.use_normal}')
     if not self.cfg.use_normal:
       normal_map = None
 
-    logging.info("making cropped data")
-
     if mesh_tensors is None:
-      mesh_tensors = make_mesh_tensors(mesh)
-
-    rgb = torch.as_tensor(rgb, device='cuda', dtype=torch.float)
-    depth = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-
-    pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams, mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter)
-
-    def find_best_among_pairs(pose_data:BatchPoseData):
-      logging.info(f'pose_data.rgbAs.shape[0]: {pose_data.rgbAs.shape[0]}')
-      ids = []
+      mesh_tensors = make_mesh_tensors(mesh, device=self.device)
+
+    rgb = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+
+    ############ The crops of all hypotheses are kept for the ranking, the network chunks come on top
+    plan = self.planner.plan('scorer', len(ob_in_cams), self.cfg['input_resize'], n_vertices=get_mesh_tensors_n_vertices(mesh_tensors), use_normal=self.cfg['use_normal'], net_activation_channels=self.ACTIVATION_CHANNELS, amp=self.amp)
+    logging.debug('batch plan: %s', self.planner)
+
+    pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams, mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter, mesh_ids=mesh_ids, render_bs=plan['render'], device=self.device, arena=self.arena)
+
+    device_type = torch.device(self.device).type
+
+    def extract_feats(start, end):
+      '''Per pair features of the hypotheses [start,end), independent of the other hypotheses
+      '''
+      As = [pose_data.rgbAs[start:end].float(), pose_data.xyz_mapAs[start:end].float()]
+      Bs = [pose_data.rgbBs[start:end].float(), pose_data.xyz_mapBs[start:end].float()]
+      if pose_data.normalAs is not None:
+        As.append(pose_data.normalAs[start:end].float())
+        Bs.append(pose_data.normalBs[start:end].float())
+      A = cat_into(self.arena, 'A', As, dim=1)
+      B = cat_into(self.arena, 'B', Bs, dim=1)
+      with span('network', n=len(A)):
+        with torch.autocast(device_type=device_type, enabled=self.amp and device_type=='cuda'):
+          return self.model.extract_feat(A, B)
+
+    ############ The encoders run in network chunks, the cross attention that ranks the hypotheses against each other runs once over all of them, so the ranking does not depend on the chunk size
+    bs = plan['network']
+    feats = torch.cat([extract_feats(b, b+bs) for b in range(0, len(ob_in_cams), bs)], dim=0)
+
+    def score_groups(feats, L):
+      with torch.autocast(device_type=device_type, enabled=self.amp and device_type=='cuda'):
+        return self.model.score_feats(feats, L=L)["score_logit"].float().reshape(-1)
+
+    if group_sizes is None:
+      scores = score_groups(feats, L=len(feats)) + 100
+    elif len(set(group_sizes))==1:
+      ############ Each instance is ranked among its own hypotheses
+      scores = score_groups(feats, L=group_sizes[0]) + 100
+    else:
       scores = []
-      bs = pose_data.rgbAs.shape[0]
-      for b in range(0, pose_data.rgbAs.shape[0], bs):
-        A = torch.cat([pose_data.rgbAs[b:b+bs].cuda(), pose_data.xyz_mapAs[b:b+bs].cuda()], dim=1).float()
-        B = torch.cat([pose_data.rgbBs[b:b+bs].cuda(), pose_data.xyz_mapBs[b:b+bs].cuda()], dim=1).float()
-        if pose_data.normalAs is not None:
-          A = torch.cat([A, pose_data.normalAs.cuda().float()], dim=1)
-          B = torch.cat([B, pose_data.normalBs.cuda().float()], dim=1)
-        with torch.cuda.amp.autocast(enabled=self.amp):
-          output = self.model(A, B, L=len(A))
-        scores_cur = output["score_logit"].float().reshape(-1)
-        ids.append(scores_cur.argmax()+b)
-        scores.append(scores_cur)
-      ids = torch.stack(ids, dim=0).reshape(-1)
-      scores = torch.cat(scores, dim=0).reshape(-1)
-      return ids, scores
-
-    pose_data_iter = pose_data
-    global_ids = torch.arange(len(ob_in_cams), device='cuda', dtype=torch.long)
-    scores_global = torch.zeros((len(ob_in_cams)), dtype=torch.float, device='cuda')
-
-    while 1:
-      ids, scores = find_best_among_pairs(pose_data_iter)
-      if len(ids)==1:
-        scores_global[global_ids] = scores + 100
-        break
-      global_ids = global_ids[ids]
-      pose_data_iter = pose_data.select_by_indices(global_ids)
-
-    scores = scores_global
-
-    logging.info(f'forward done')
-    torch.cuda.empty_cache()
+      start = 0
+      for group_size in group_sizes:
+        scores.append(score_groups(feats[start:start+group_size], L=group_size) + 100)
+        start += group_size
+      scores = torch.cat(scores, dim=0)
+
+    self.release_workspace_by_policy()
 
     if get_vis:
-      logging.info("get_vis...")
       canvas = []
       ids = scores.argsort(descending=True)
       canvas = vis_batch_data_scores(pose_data, ids=ids, scores=scores)
@@ -0,0 +1,197 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import threading,queue,time,logging
+
+
+_STOP = object()
+
+
+class StageTimer:
+  '''Thread safe accumulated time and count per pipeline stage
+  '''
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.stats = {}
+
+
+  def add(self, stage, elapsed):
+    with self.lock:
+      if stage not in self.stats:
+        self.stats[stage] = {'n': 0, 'total': 0.0, 'max': 0.0}
+      self.stats[stage]['n'] += 1
+      self.stats[stage]['total'] += elapsed
+      self.stats[stage]['max'] = max(self.stats[stage]['max'], elapsed)
+
+
+  def summary(self):
+    lines = []
+    with self.lock:
+      for stage, stat in self.stats.items():
+        mean = stat['total']/max(stat['n'],1)
+        lines.append(f"{stage}: n={stat['n']}, total={stat['total']:.3f}s, mean={mean*1000:.1f}ms, max={stat['max']*1000:.1f}ms")
+    return '\n'.join(lines)
+
+
+
+class DisplayQueue:
+  '''Images put by sink threads and shown by the main thread, since HighGUI (cv2.imshow/waitKey) is not thread safe and must run on the main thread on macOS. Pass show as a main sink of PipelineRunner
+  '''
+  def __init__(self, window='1'):
+    self.window = window
+    self.queue = queue.Queue()
+
+
+  def put(self, img):
+    self.queue.put(img)
+
+
+  def show(self):
+    '''Shows the pending images in order, returns right away when there are none
+    '''
+    import cv2
+    while True:
+      try:
+        img = self.queue.get_nowait()
+      except queue.Empty:
+        return
+      cv2.imshow(self.window, img)
+      cv2.waitKey(1)
+
+
+
+class PipelineRunner:
+  '''Overlaps frame decoding, inference and output writing of an offline video.
+  Decoding runs in a pool of worker threads, inference runs in order on the calling thread (it is stateful for tracking, and keeps the CUDA work on one thread), each sink runs in its own thread and receives the frames in order.
+  At most @max_in_flight frames are decoded ahead of the inference, and each sink queue holds at most @max_in_flight frames, so a slow stage blocks the ones feeding it instead of growing memory.
+  @decode_fn: fn(frame_id) -> data
+  @infer_fn: fn(frame_id, data) -> result
+  @sinks: dict name -> fn(frame_id, data, result), e.g. saving poses or visualization
+  @main_sinks: dict name -> fn(), called on the calling thread after every inference and once after the sinks are done, e.g. DisplayQueue.show for the images of a sink
+  '''
+  def __init__(self, decode_fn, infer_fn, sinks={}, main_sinks={}, n_decode_workers=2, max_in_flight=8):
+    self.decode_fn = decode_fn
+    self.infer_fn = infer_fn
+    self.sinks = sinks
+    self.main_sinks = main_sinks
+    self.n_decode_workers = n_decode_workers
+    self.max_in_flight = max_in_flight
+    self.timer = StageTimer()
+
+
+  def decode_worker(self, id_queue, in_flight, decoded, cond, stop):
+    while not stop.is_set():
+      in_flight.acquire()    # Take a slot before the next id, so the frames are decoded in increasing order and the oldest one always has a slot
+      item = id_queue.get()
+      if item is _STOP:
+        in_flight.release()
+        return
+      pos, frame_id = item
+      begin = time.perf_counter()
+      try:
+        out = (self.decode_fn(frame_id), None)
+      except BaseException as e:
+        out = (None, e)
+      self.timer.add('decode', time.perf_counter()-begin)
+      with cond:
+        decoded[pos] = out
+        cond.notify_all()
+
+
+  def sink_worker(self, name, fn, sink_queue, errors):
+    while True:
+      item = sink_queue.get()
+      if item is _STOP:
+        return
+      if len(errors)>0:
+        continue
+      frame_id, data, result = item
+      begin = time.perf_counter()
+      try:
+        fn(frame_id, data, result)
+      except BaseException as e:
+        errors.append(e)
+      self.timer.add(f'sink_{name}', time.perf_counter()-begin)
+
+
+  def run_main_sinks(self):
+    for name, fn in self.main_sinks.items():
+      begin = time.perf_counter()
+      fn()
+      self.timer.add(f'main_sink_{name}', time.perf_counter()-begin)
+
+
+  def run(self, frame_ids):
+    '''
+    Return: list of infer_fn results, in the order of @frame_ids
+    '''
+    frame_ids = list(frame_ids)
+    self.timer = StageTimer()
+    stop = threading.Event()
+    in_flight = threading.Semaphore(self.max_in_flight)
+    id_queue = queue.Queue()
+    for pos, frame_id in enumerate(frame_ids):
+      id_queue.put((pos, frame_id))
+    for _ in range(self.n_decode_workers):
+      id_queue.put(_STOP)
+    decoded = {}
+    cond = threading.Condition()
+    decode_threads = [threading.Thread(target=self.decode_worker, args=(id_queue, in_flight, decoded, cond, stop), daemon=True) for _ in range(self.n_decode_workers)]
+
+    sink_errors = []
+    sink_queues = {}
+    sink_threads = []
+    for name, fn in self.sinks.items():
+      sink_queues[name] = queue.Queue(maxsize=self.max_in_flight)
+      sink_threads.append(threading.Thread(target=self.sink_worker, args=(name, fn, sink_queues[name], sink_errors), daemon=True))
+
+    for t in decode_threads+sink_threads:
+      t.start()
+
+    results = []
+    wall_begin = time.perf_counter()
+    try:
+      for pos, frame_id in enumerate(frame_ids):
+        begin = time.perf_counter()
+        with cond:
+          while pos not in decoded:
+            cond.wait()
+          data, error = decoded.pop(pos)
+        self.timer.add('wait_input', time.perf_counter()-begin)
+        in_flight.release()
+        if error is not None:
+          raise error
+        if len(sink_errors)>0:
+          raise sink_errors[0]
+
+        begin = time.perf_counter()
+        result = self.infer_fn(frame_id, data)
+        self.timer.add('infer', time.perf_counter()-begin)
+        results.append(result)
+
+        begin = time.perf_counter()
+        for name in self.sinks:
+          sink_queues[name].put((frame_id, data, result))
+        self.timer.add('wait_output', time.perf_counter()-begin)
+        self.run_main_sinks()
+    finally:
+      stop.set()
+      for _ in range(self.n_decode_workers):
+        in_flight.release()    # Unblock workers waiting for a slot
+      for name in self.sinks:
+        sink_queues[name].put(_STOP)
+      for t in sink_threads:
+        t.join()
+
+    if len(sink_errors)>0:
+      raise sink_errors[0]
+    self.run_main_sinks()
+    self.timer.add('wall', time.perf_counter()-wall_begin)
+    logging.info(f"pipeline stages:\n{self.timer.summary()}")
+    return results
@@ -0,0 +1,212 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import threading
+import torch
+import torch.nn.functional as F
+import numpy as np
+from lazy_import import *
+dr = LazyModule('nvdiffrast.torch')   # Only needed once an nvdiffrast context is made, CPU-only nodes render with TorchRasterizer
+
+
+class RenderBackend:
+  '''The rasterization primitives used by Utils.nvdiffrast_render, with the nvdiffrast conventions:
+  rasterize: @pos_clip (N,V,4) clip space, @tri (F,3) int, @resolution (H,W). Returns (N,H,W,4) (u,v,z/w,triangle_id+1), 0 for background, row 0 at the bottom (y_ndc=-1). Barycentrics are perspective correct, attr = u*a0+v*a1+(1-u-v)*a2
+  interpolate: @attr (V,C) or (N,V,C). Returns (N,H,W,C), zeros for background
+  texture: @tex (1,Ht,Wt,C), @uv (N,H,W,2) in [0,1], row 0 at uv[...,1]=0. Returns (N,H,W,C)
+  '''
+  def rasterize(self, pos_clip, tri, resolution):
+    raise NotImplementedError
+
+  def interpolate(self, attr, rast, tri):
+    raise NotImplementedError
+
+  def texture(self, tex, uv, filter_mode='linear'):
+    raise NotImplementedError
+
+  def release(self):
+    '''Drop what is kept from the last rasterization, called at the end of every Utils.nvdiffrast_render
+    '''
+    pass
+
+
+
+class NvdiffrastBackend(RenderBackend):
+  def __init__(self, glctx=None, device='cuda'):
+    if glctx is None:
+      glctx = dr.RasterizeCudaContext(device)
+    self.glctx = glctx
+
+  def rasterize(self, pos_clip, tri, resolution):
+    return dr.rasterize(self.glctx, pos_clip, tri, resolution=np.asarray(resolution))[0]
+
+  def interpolate(self, attr, rast, tri):
+    return dr.interpolate(attr, rast, tri)[0]
+
+  def texture(self, tex, uv, filter_mode='linear'):
+    return dr.texture(tex, uv, filter_mode=filter_mode)
+
+
+
+class TorchRasterizer(RenderBackend):
+  '''Batched z-buffer rasterizer in plain torch, for machines without a GPU (it runs on any device).
+  Every triangle is expanded to the pixel centers of its screen bounding box, the fragments inside the triangle are depth tested with one scatter min over (depth, triangle id) keys, and the barycentrics of the winners are recomputed.
+  Triangles with a vertex behind the camera are dropped instead of clipped, fragments outside the depth range are discarded
+  '''
+  def __init__(self, max_fragments=2**22, max_triangles=2**21):
+    '''
+    @max_fragments: bounding box pixels expanded at once
+    @max_triangles: poses*faces set up at once, the poses are rasterized in chunks below it
+    '''
+    self.max_fragments = max_fragments
+    self.max_triangles = max_triangles
+    self.local = threading.local()   # cache: faces of the covered pixels of the last rast of this thread, shared by the interpolate calls on it until release. Per thread since overlapped chunks render on a worker thread with the same backend
+
+
+  def release(self):
+    self.local.cache = None
+
+
+  def setup_triangles(self, pos_clip, tri, H, W):
+    '''Screen barycentrics b0,b1 are linear in the offset (px-x2,py-y2) of the pixel center from the third vertex, z/w is affine in b0,b1. Pixel centers at integers
+    Return: coefs (T,9) of (b0 dx,b0 dy,b1 dx,b1 dy,x2,y2,z0-z2,z1-z2,z2); inv_ws (T,3); bbox (T,4) inclusive xmin,ymin,xmax,ymax; valid (T,), T=N*F
+    '''
+    v = pos_clip[:,tri.long()].reshape(-1,3,4)
+    ws = v[...,3]
+    inv_ws = 1/ws.clip(min=1e-12)
+    xs = (v[...,0]*inv_ws+1)*W/2-0.5
+    ys = (v[...,1]*inv_ws+1)*H/2-0.5
+    zs = v[...,2]*inv_ws
+    x0,x1,x2 = xs.unbind(dim=1)
+    y0,y1,y2 = ys.unbind(dim=1)
+    area = (x1-x0)*(y2-y0) - (x2-x0)*(y1-y0)
+    inv_area = 1/torch.where(area!=0, area, torch.ones_like(area))
+    coefs = torch.stack([(y1-y2)*inv_area, (x2-x1)*inv_area, (y2-y0)*inv_area, (x0-x2)*inv_area, x2, y2, zs[:,0]-zs[:,2], zs[:,1]-zs[:,2], zs[:,2]], dim=-1)
+    bbox = torch.stack([xs.min(dim=1)[0].ceil().clip(0, W), ys.min(dim=1)[0].ceil().clip(0, H), xs.max(dim=1)[0].floor().clip(-1, W-1), ys.max(dim=1)[0].floor().clip(-1, H-1)], dim=-1)
+    valid = (ws>0).all(dim=1) & (area!=0) & (bbox[:,2]>=bbox[:,0]) & (bbox[:,3]>=bbox[:,1])
+    inv_ws = torch.where(ws>0, inv_ws, torch.zeros_like(inv_ws))
+    return coefs, inv_ws, bbox, valid
+
+
+  @staticmethod
+  def eval_coefs(coefs, px, py):
+    dx = px-coefs[:,4]
+    dy = py-coefs[:,5]
+    b0 = coefs[:,0]*dx+coefs[:,1]*dy
+    b1 = coefs[:,2]*dx+coefs[:,3]*dy
+    z = coefs[:,8]+b0*coefs[:,6]+b1*coefs[:,7]
+    return b0, b1, 1-b0-b1, z
+
+
+  def rasterize(self, pos_clip, tri, resolution):
+    H, W = int(resolution[0]), int(resolution[1])
+    N = pos_clip.shape[0]
+    self.local.cache = None
+    chunk = max(1, self.max_triangles//max(len(tri),1))
+    rast = torch.cat([self.rasterize_chunk(pos_clip[b:b+chunk].float(), tri, H, W) for b in range(0, N, chunk)], dim=0)
+    return rast.reshape(N,H,W,4)
+
+
+  def rasterize_chunk(self, pos_clip, tri, H, W):
+    device = pos_clip.device
+    N = pos_clip.shape[0]
+    n_tri = tri.shape[0]
+    coefs, inv_ws, bbox, valid = self.setup_triangles(pos_clip, tri, H, W)
+    ids = torch.where(valid)[0]   # Into the (N*F) triangles
+    xmin = bbox[ids,0]
+    ymin = bbox[ids,1]
+    bw = (bbox[ids,2]-xmin+1).long()
+    counts = bw*(bbox[ids,3]-ymin+1).long()
+    ends = counts.cumsum(0)
+
+    MAX_KEY = torch.iinfo(torch.int64).max
+    zbuf = torch.full((N*H*W,), MAX_KEY, dtype=torch.int64, device=device)
+    start = 0
+    while start<len(ids):
+      ############ As many triangles as fit in max_fragments, at least one
+      offset = int(ends[start-1]) if start>0 else 0
+      end = max(int(torch.searchsorted(ends, offset+self.max_fragments, right=True)), start+1)
+      cur_counts = counts[start:end]
+      cur = torch.repeat_interleave(torch.arange(start, end, device=device), cur_counts)
+      local = torch.arange(len(cur), device=device)-(ends[start:end]-cur_counts-offset)[cur-start]
+      cur_bw = bw[cur]
+      px = xmin[cur]+local%cur_bw
+      py = ymin[cur]+torch.div(local, cur_bw, rounding_mode='floor')
+      tri_ids = ids[cur]
+      b0, b1, b2, z = self.eval_coefs(coefs[tri_ids], px, py)
+      inside = (b0>=0) & (b1>=0) & (b2>=0) & (z>=-1) & (z<=1)
+      tri_ids = tri_ids[inside]
+      pix = (tri_ids//n_tri)*H*W + py[inside].long()*W + px[inside].long()
+      zq = ((z[inside].double().clip(-1, 1)+1)*2**29).long()   # Monotonic in depth, at most 2**30 so the key stays below 2**63 at the far plane
+      zbuf.scatter_reduce_(0, pix, zq*2**32 + tri_ids%n_tri, reduce='amin')
+      start = end
+
+    ############ Winners
+    rast = torch.zeros((N*H*W,4), dtype=torch.float, device=device)
+    pix = torch.where(zbuf!=MAX_KEY)[0]
+    face = zbuf[pix]%2**32
+    tri_ids = (pix//(H*W))*n_tri+face
+    b0, b1, b2, z = self.eval_coefs(coefs[tri_ids], (pix%W).float(), ((pix//W)%H).float())
+    p = torch.stack([b0, b1, b2], dim=-1)*inv_ws[tri_ids]   # Perspective correction
+    p = p/p.sum(dim=-1, keepdim=True)
+    rast[pix,:2] = p[:,:2]
+    rast[pix,2] = z
+    rast[pix,3] = (face+1).float()
+    return rast
+
+
+  def interpolate(self, attr, rast, tri):
+    N,H,W = rast.shape[:3]
+    attr = attr.float()
+    C = attr.shape[-1]
+    cache = getattr(self.local, 'cache', None)
+    if cache is not None and cache[0] is rast and cache[1] is tri:
+      pix, faces = cache[2:]
+    else:
+      pix = torch.where(rast.reshape(-1,4)[:,3]>0)[0]
+      faces = tri.long()[rast.reshape(-1,4)[pix,3].long()-1]  #(M,3)
+      self.local.cache = (rast, tri, pix, faces)
+    if attr.ndim==3:   # Per pose attributes
+      faces = faces+(pix//(H*W)).reshape(-1,1)*attr.shape[1]
+      attr = attr.reshape(-1,C)
+    vals = attr[faces]  #(M,3,C)
+    uv = rast.reshape(-1,4)[pix,:2]
+    out = torch.zeros((N*H*W,C), dtype=torch.float, device=rast.device)
+    out[pix] = vals[:,2]+uv[:,0:1]*(vals[:,0]-vals[:,2])+uv[:,1:2]*(vals[:,1]-vals[:,2])
+    return out.reshape(N,H,W,C)
+
+
+  def texture(self, tex, uv, filter_mode='linear'):
+    '''Wrapped uv, clamped at the texture border instead of wrapping across it
+    '''
+    N,H,W = uv.shape[:3]
+    uv = uv-uv.floor()
+    grid = (uv*2-1).reshape(1,N*H,W,2)   # All the poses sample one texture, stacked along the height
+    mode = 'bilinear' if filter_mode=='linear' else 'nearest'
+    out = F.grid_sample(tex.float().permute(0,3,1,2), grid, mode=mode, padding_mode='border', align_corners=False)  #(1,C,N*H,W)
+    return out[0].permute(1,2,0).reshape(N,H,W,-1)
+
+
+
+def make_render_backend(glctx=None, context='cuda', device='cuda'):
+  '''
+  @glctx: RenderBackend, nvdiffrast context, or None to make one for @context and @device
+  @context: cuda/gl for nvdiffrast, torch for TorchRasterizer. TorchRasterizer is always used off cuda
+  '''
+  if isinstance(glctx, RenderBackend):
+    return glctx
+  if glctx is not None:
+    return NvdiffrastBackend(glctx)
+  if context=='torch' or torch.device(device).type!='cuda':
+    return TorchRasterizer()
+  if context=='gl':
+    return NvdiffrastBackend(dr.RasterizeGLContext())
+  if context=='cuda':
+    return NvdiffrastBackend(dr.RasterizeCudaContext(device))
+  raise NotImplementedError
@@ -9,6 +9,7 @@
 
 from estimater import *
 from datareader import *
+from pipeline import *
 import argparse
 
 
@@ -21,6 +22,22 @@ if __name__=='__main__':
   # parser.add_argument('--test_scene_dir', type=str, default=f'{code_dir}/demo_data/test')
   parser.add_argument('--est_refine_iter', type=int, default=5)
   parser.add_argument('--track_refine_iter', type=int, default=2)
+  parser.add_argument('--device', type=str, default='cuda', help="cuda or cpu")
+  parser.add_argument('--mem_budget_gb', type=float, default=None, help="device memory for rendering and inference chunks, default half of the free memory")
+  parser.add_argument('--depth_roi', type=int, default=0, help="filter the depth only around the object")
+  parser.add_argument('--motion_prior', type=int, default=0, help="start tracking from a constant velocity prediction")
+  parser.add_argument('--track_trans_thres', type=float, default=None, help="meter, stop tracking refinement once the update is below it")
+  parser.add_argument('--track_rot_thres', type=float, default=None, help="degree, stop tracking refinement once the update is below it")
+  parser.add_argument('--icp', type=int, default=0, help="track with ICP of the model points against the depth, the refiner only runs when the fit is poor or periodically")
+  parser.add_argument('--track_check', type=int, default=0, help="check every tracked pose against the depth, relocalize around the last pose when lost")
+  parser.add_argument('--lod', type=int, default=0, help="render decimated meshes and downsampled textures in the early refiner iterations and tracking")
+  parser.add_argument('--template_bank', type=int, default=0, help="first registration refiner pass from pre-rendered templates of the rotation grid")
+  parser.add_argument('--weights_dir', type=str, default=None, help="dir of the <run_name>/model_best.pth checkpoints, default weights of the repo")
+  parser.add_argument('--weight_store_dir', type=str, default=None, help="convert the checkpoints once to memory mapped weights there, shared by the processes on the host")
+  parser.add_argument('--n_decode_workers', type=int, default=2)
+  parser.add_argument('--max_in_flight', type=int, default=8, help="max frames decoded ahead of the inference, and queued per output sink")
+  parser.add_argument('--trace', type=int, default=0, help="time the stages with tracing spans, written to debug_dir as trace_stats.json and Chrome trace trace.json")
+  parser.add_argument('--trace_sync', type=int, default=0, help="synchronize the device at the span boundaries, for device time per stage")
   parser.add_argument('--debug', type=int, default=1)
   parser.add_argument('--debug_dir', type=str, default=f'{code_dir}/debug')
   args = parser.parse_args()
@@ -37,21 +54,35 @@ if __name__=='__main__':
   to_origin, extents = trimesh.bounds.oriented_bounds(mesh)
   bbox = np.stack([-extents/2, extents/2], axis=0).reshape(2,3)
 
-  scorer = ScorePredictor()
-  refiner = PoseRefinePredictor()
-  glctx = dr.RasterizeCudaContext()
-  est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, debug_dir=debug_dir, debug=debug, glctx=glctx)
+  scorer = ScorePredictor(device=args.device, weights_dir=args.weights_dir, weight_store_dir=args.weight_store_dir)
+  refiner = PoseRefinePredictor(device=args.device, weights_dir=args.weights_dir, weight_store_dir=args.weight_store_dir)
+  glctx = dr.RasterizeCudaContext() if args.device=='cuda' else None
+  est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, debug_dir=debug_dir, debug=debug, glctx=glctx, device=args.device)
+  est.set_mem_budget(mem_budget=args.mem_budget_gb*1e9 if args.mem_budget_gb is not None else None)
+  est.set_depth_roi_mode(enabled=args.depth_roi)
+  est.set_lod_mode(enabled=args.lod)
+  est.set_template_bank_mode(enabled=args.template_bank)
+  est.set_tracker_mode(motion_prior=args.motion_prior, trans_thres=args.track_trans_thres, rot_thres=args.track_rot_thres)
+  est.set_icp_mode(enabled=args.icp)
+  est.set_track_check_mode(enabled=args.track_check)
   logging.info("estimator initialization done")
+  if args.trace:
+    get_tracer().enable(sync_cuda=args.trace_sync)
 
   reader = YcbineoatReader(video_dir=args.test_scene_dir, shorter_side=None, zfar=np.inf)
 
-  for i in range(len(reader.color_files)):
-    logging.info(f'i:{i}')
-    color = reader.get_color(i)
-    depth = reader.get_depth(i)
+  def decode(i):
+    data = {'color': reader.get_color(i), 'depth': reader.get_depth(i)}
     if i==0:
-      mask = reader.get_mask(0).astype(bool)
-      pose = est.register(K=reader.K, rgb=color, depth=depth, ob_mask=mask, iteration=args.est_refine_iter)
+      data['mask'] = reader.get_mask(0).astype(bool)
+    return data
+
+  def infer(i, data):
+    logging.debug('i:%d', i)
+    color = data['color']
+    depth = data['depth']
+    if i==0:
+      pose = est.register(K=reader.K, rgb=color, depth=depth, ob_mask=data['mask'], iteration=args.est_refine_iter)
 
       if debug>=3:
         m = mesh.copy()
@@ -63,19 +94,35 @@ if __name__=='__main__':
         o3d.io.write_point_cloud(f'{debug_dir}/scene_complete.ply', pcd)
     else:
       pose = est.track_one(rgb=color, depth=depth, K=reader.K, iteration=args.track_refine_iter)
+      logging.debug('track_stats:%s', est.track_stats)
+      if est.track_stats.get('lost', False):
+        logging.warning(f"frame {i}: track lost, confidence {est.track_stats['confidence']:.2f}")
+    return pose
 
-    os.makedirs(f'{debug_dir}/ob_in_cam', exist_ok=True)
+  def save_pose(i, data, pose):
     np.savetxt(f'{debug_dir}/ob_in_cam/{reader.id_strs[i]}.txt', pose.reshape(4,4))
 
-    if debug>=1:
-      center_pose = pose@np.linalg.inv(to_origin)
-      vis = draw_posed_3d_box(reader.K, img=color, ob_in_cam=center_pose, bbox=bbox)
-      vis = draw_xyz_axis(color, ob_in_cam=center_pose, scale=0.1, K=reader.K, thickness=3, transparency=0, is_input_rgb=True)
-      cv2.imshow('1', vis[...,::-1])
-      cv2.waitKey(1)
-
+  def save_vis(i, data, pose):
+    color = data['color']
+    center_pose = pose@np.linalg.inv(to_origin)
+    vis = draw_posed_3d_box(reader.K, img=color, ob_in_cam=center_pose, bbox=bbox)
+    vis = draw_xyz_axis(color, ob_in_cam=center_pose, scale=0.1, K=reader.K, thickness=3, transparency=0, is_input_rgb=True)
+    display.put(vis[...,::-1])
 
     if debug>=2:
-      os.makedirs(f'{debug_dir}/track_vis', exist_ok=True)
       imageio.imwrite(f'{debug_dir}/track_vis/{reader.id_strs[i]}.png', vis)
 
+  display = DisplayQueue()
+  sinks = {'pose': save_pose}
+  main_sinks = {}
+  if debug>=1:
+    sinks['vis'] = save_vis
+    main_sinks['display'] = display.show
+  runner = PipelineRunner(decode_fn=decode, infer_fn=infer, sinks=sinks, main_sinks=main_sinks, n_decode_workers=args.n_decode_workers, max_in_flight=args.max_in_flight)
+  runner.run(range(len(reader.color_files)))
+
+  if args.trace:
+    tracer = get_tracer()
+    logging.info(f"spans:\n{tracer.summary()}")
+    tracer.export_json(f'{debug_dir}/trace_stats.json')
+    tracer.export_chrome_trace(f'{debug_dir}/trace.json')
@@ -88,6 +88,7 @@ def run_pose_estimation_worker(reader, i_frames, est:FoundationPose=None, debug=
 
 
 def run_pose_estimation():
+  init_warp()
   wp.force_load(device='cuda')
   reader_tmp = LinemodReader(f'{opt.linemod_dir}/lm_test_all/test/000002', split=None)
 
@@ -98,7 +99,7 @@ def run_pose_estimation():
   res = NestDict()
   glctx = dr.RasterizeCudaContext()
   mesh_tmp = trimesh.primitives.Box(extents=np.ones((3)), transform=np.eye(4)).to_mesh()
-  est = FoundationPose(model_pts=mesh_tmp.vertices.copy(), model_normals=mesh_tmp.vertex_normals.copy(), symmetry_tfs=None, mesh=mesh_tmp, scorer=None, refiner=None, glctx=glctx, debug_dir=debug_dir, debug=debug)
+  est = FoundationPose(model_pts=mesh_tmp.vertices.copy(), model_normals=mesh_tmp.vertex_normals.copy(), symmetry_tfs=None, mesh=mesh_tmp, scorer=None, refiner=None, glctx=glctx, debug_dir=debug_dir, debug=debug, asset_cache_dir=opt.asset_cache_dir)
 
   for ob_id in reader_tmp.ob_ids:
     ob_id = int(ob_id)
@@ -141,6 +142,7 @@ if __name__=='__main__':
   parser.add_argument('--ref_view_dir', type=str, default="/mnt/9a72c439-d0a7-45e8-8d20-d7a235d02763/DATASET/YCB_Video/bowen_addon/ref_views_16")
   parser.add_argument('--debug', type=int, default=0)
   parser.add_argument('--debug_dir', type=str, default=f'{code_dir}/debug')
+  parser.add_argument('--asset_cache_dir', type=str, default=None, help="cache the per-object assets across runs")
   opt = parser.parse_args()
   set_seed(0)
 
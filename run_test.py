@@ -9,6 +9,7 @@
 
 from estimater import *
 from datareader import *
+from pipeline import *
 import argparse
 
 
@@ -22,6 +23,8 @@ if __name__=='__main__':
   # parser.add_argument('--test_scene_dir', type=str, default=f'{code_dir}/demo_data/test')
   parser.add_argument('--est_refine_iter', type=int, default=5)
   parser.add_argument('--track_refine_iter', type=int, default=2)
+  parser.add_argument('--n_decode_workers', type=int, default=2)
+  parser.add_argument('--max_in_flight', type=int, default=8, help="max frames decoded ahead of the inference, and queued per output sink")
   parser.add_argument('--debug', type=int, default=1)
   parser.add_argument('--debug_dir', type=str, default=f'{code_dir}/debug')
   args = parser.parse_args()
@@ -46,13 +49,18 @@ if __name__=='__main__':
 
   reader = YcbineoatReader(video_dir=args.test_scene_dir, shorter_side=None, zfar=np.inf)
 
-  for i in range(len(reader.color_files)):
+  def decode(i):
+    data = {'color': reader.get_color(i), 'depth': reader.get_depth(i)}
+    if i==0:
+      data['mask'] = reader.get_mask(0).astype(bool)
+    return data
+
+  def infer(i, data):
     logging.info(f'i:{i}')
-    color = reader.get_color(i)
-    depth = reader.get_depth(i)
+    color = data['color']
+    depth = data['depth']
     if i==0:
-      mask = reader.get_mask(0).astype(bool)
-      pose = est.register(K=reader.K, rgb=color, depth=depth, ob_mask=mask, iteration=args.est_refine_iter)
+      pose = est.register(K=reader.K, rgb=color, depth=depth, ob_mask=data['mask'], iteration=args.est_refine_iter)
       print(f"Predicted 6D pose for frame {i}:")
       print(pose)
 
@@ -68,19 +76,26 @@ if __name__=='__main__':
       pose = est.track_one(rgb=color, depth=depth, K=reader.K, iteration=args.track_refine_iter)
       print(f"Predicted 6D pose for frame {i}:")
       print(pose)
+    return pose
 
-    os.makedirs(f'{debug_dir}/ob_in_cam', exist_ok=True)
+  def save_pose(i, data, pose):
     np.savetxt(f'{debug_dir}/ob_in_cam/{reader.id_strs[i]}.txt', pose.reshape(4,4))
 
-    if debug>=1:
-      center_pose = pose@np.linalg.inv(to_origin)
-      vis = draw_posed_3d_box(reader.K, img=color, ob_in_cam=center_pose, bbox=bbox)
-      vis = draw_xyz_axis(color, ob_in_cam=center_pose, scale=0.1, K=reader.K, thickness=3, transparency=0, is_input_rgb=True)
-      cv2.imshow('1', vis[...,::-1])
-      cv2.waitKey(1)
-
+  def save_vis(i, data, pose):
+    color = data['color']
+    center_pose = pose@np.linalg.inv(to_origin)
+    vis = draw_posed_3d_box(reader.K, img=color, ob_in_cam=center_pose, bbox=bbox)
+    vis = draw_xyz_axis(color, ob_in_cam=center_pose, scale=0.1, K=reader.K, thickness=3, transparency=0, is_input_rgb=True)
+    display.put(vis[...,::-1])
 
     if debug>=2:
-      os.makedirs(f'{debug_dir}/track_vis', exist_ok=True)
       imageio.imwrite(f'{debug_dir}/track_vis/{reader.id_strs[i]}.png', vis)
 
+  display = DisplayQueue()
+  sinks = {'pose': save_pose}
+  main_sinks = {}
+  if debug>=1:
+    sinks['vis'] = save_vis
+    main_sinks['display'] = display.show
+  runner = PipelineRunner(decode_fn=decode, infer_fn=infer, sinks=sinks, main_sinks=main_sinks, n_decode_workers=args.n_decode_workers, max_in_flight=args.max_in_flight)
+  runner.run(range(len(reader.color_files)))
@@ -80,6 +80,7 @@ def run_pose_estimation_worker(reader, i_frames, est:FoundationPose, debug=False
 
 
 def run_pose_estimation():
+  init_warp()
   wp.force_load(device='cuda')
   video_dirs = sorted(glob.glob(f'{opt.ycbv_dir}/test/*'))
   res = NestDict()
@@ -91,7 +92,7 @@ def run_pose_estimation():
   reader_tmp = YcbVideoReader(video_dirs[0])
   glctx = dr.RasterizeCudaContext()
   mesh_tmp = trimesh.primitives.Box(extents=np.ones((3)), transform=np.eye(4))
-  est = FoundationPose(model_pts=mesh_tmp.vertices.copy(), model_normals=mesh_tmp.vertex_normals.copy(), symmetry_tfs=None, mesh=mesh_tmp, scorer=None, refiner=None, glctx=glctx, debug_dir=debug_dir, debug=debug)
+  est = FoundationPose(model_pts=mesh_tmp.vertices.copy(), model_normals=mesh_tmp.vertex_normals.copy(), symmetry_tfs=None, mesh=mesh_tmp, scorer=None, refiner=None, glctx=glctx, debug_dir=debug_dir, debug=debug, asset_cache_dir=opt.asset_cache_dir)
 
   ob_ids = reader_tmp.ob_ids
 
@@ -139,6 +140,7 @@ if __name__=='__main__':
   parser.add_argument('--ref_view_dir', type=str, default="/mnt/9a72c439-d0a7-45e8-8d20-d7a235d02763/DATASET/YCB_Video/bowen_addon/ref_views_16")
   parser.add_argument('--debug', type=int, default=0)
   parser.add_argument('--debug_dir', type=str, default=f'{code_dir}/debug')
+  parser.add_argument('--asset_cache_dir', type=str, default=None, help="cache the per-object assets across runs")
   opt = parser.parse_args()
   os.environ["YCB_VIDEO_DIR"] = opt.ycbv_dir
 
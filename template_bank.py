@@ -0,0 +1,186 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,hashlib,uuid,logging
+import numpy as np
+import torch
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(code_dir)
+from Utils import *
+from asset_cache import mesh_content_hash
+
+
+def rotation_to_optical_axis(t):
+  '''
+  @t: (3,) tensor, in front of the camera
+  Return: (3,3) smallest rotation taking the direction of @t to the optical axis
+  '''
+  u = t/t.norm().clip(min=1e-8)
+  z = torch.tensor([0,0,1], dtype=t.dtype, device=t.device)
+  v = torch.cross(u, z, dim=0)
+  c = (u*z).sum()
+  vx = torch.zeros((3,3), dtype=t.dtype, device=t.device)
+  vx[0,1], vx[0,2], vx[1,2] = -v[2], v[1], -v[0]
+  vx = vx-vx.T
+  return torch.eye(3, dtype=t.dtype, device=t.device)+vx+vx@vx/(1+c).clip(min=1e-8)
+
+
+class TemplateBank:
+  '''Refiner crops of the rotation grid, rendered once with the object centre on the optical axis at a canonical distance.
+  The hypotheses of a frame share one translation t. Rotating the camera to look at t makes each one an on-axis view, so with hypotheses R_c^T@R_i (R_c from rotation_to_optical_axis(t)) the crop of hypothesis i is template i under one homography: the camera rotation and the distance rescale, weak perspective about the centre.
+  R_c^T@R_i is the rotation grid turned with the viewing direction, the same set as generate_random_pose_hypo only for an object on the optical axis. A homography can not turn template i into the crop of R_i itself off axis, that is an out of plane rotation of the object, so the bank is opt-in and benchmarks/check_template_bank.py compares the register accuracy of both hypothesis sets
+  '''
+  def __init__(self, rot_grid, rgbs, xyz_maps, masks, K, tf_to_crop, distance):
+    '''
+    @rot_grid: (N,4,4) tensor, rotations of the templates
+    @rgbs: (N,3,S,S) uint8
+    @xyz_maps: (N,3,S,S) float16, relative to the object centre in the template camera
+    @masks: (N,1,S,S) bool
+    @K: (3,3) template camera
+    @tf_to_crop: (3,3) template image to crop
+    @distance: of the object centre in the template camera
+    '''
+    self.rot_grid = rot_grid
+    self.rgbs = rgbs
+    self.xyz_maps = xyz_maps
+    self.masks = masks
+    self.K = K
+    self.tf_to_crop = tf_to_crop
+    self.distance = distance
+
+
+  @classmethod
+  @torch.inference_mode()
+  def build(cls, mesh_tensors, rot_grid, mesh_diameter, crop_size, crop_ratio, glctx=None, distance_ratio=4, render_bs=64, device='cuda'):
+    '''Same renders as make_crop_data_batch, in a template camera whose crop window fills the image
+    @crop_size: (H,W) of the refiner input
+    @distance_ratio: canonical distance in object diameters
+    '''
+    distance = float(mesh_diameter*distance_ratio)
+    S = int(max(crop_size))
+    f = S*distance/(mesh_diameter*crop_ratio)
+    K = np.array([[f,0,S/2],[0,f,S/2],[0,0,1]])
+    poses = torch.as_tensor(rot_grid, dtype=torch.float, device=device).clone()
+    poses[:,:3,3] = torch.tensor([0,0,distance], dtype=torch.float, device=device)
+    tf_to_crop = compute_crop_window_tf_batch(H=S, W=S, poses=poses[:1], K=K, crop_ratio=crop_ratio, out_size=(crop_size[1], crop_size[0]), method='box_3d', mesh_diameter=mesh_diameter)
+    bbox2d_crop = torch.as_tensor(np.array([0, 0, crop_size[0]-1, crop_size[1]-1]).reshape(2,2), device=device, dtype=torch.float)
+    bbox2d = transform_pts(bbox2d_crop, tf_to_crop.inverse()).reshape(-1,4)
+    rgbs = []
+    xyz_maps = []
+    for b in range(0, len(poses), render_bs):
+      cur_poses = poses[b:b+render_bs]
+      extra = {}
+      rgb_r, depth_r, _ = nvdiffrast_render(K=K, H=S, W=S, ob_in_cams=cur_poses, glctx=glctx, mesh_tensors=mesh_tensors, output_size=crop_size, bbox2d=bbox2d.expand(len(cur_poses),-1), use_light=True, extra=extra)
+      rgbs.append((rgb_r*255).round().clip(0,255).to(torch.uint8).permute(0,3,1,2))
+      xyz_maps.append(extra['xyz_map'].permute(0,3,1,2))
+    xyz_maps = torch.cat(xyz_maps, dim=0)
+    masks = xyz_maps[:,2:3]>=0.001
+    xyz_maps = torch.where(masks, xyz_maps-poses[:,:3,3].reshape(-1,3,1,1), torch.zeros_like(xyz_maps))
+    logging.info(f'template bank built, templates:{len(poses)}, size:{crop_size}')
+    return cls(rot_grid=poses, rgbs=torch.cat(rgbs, dim=0), xyz_maps=xyz_maps.half(), masks=masks, K=torch.as_tensor(K, dtype=torch.float, device=device), tf_to_crop=tf_to_crop[0], distance=distance)
+
+
+  def make_hypotheses(self, center):
+    '''
+    @center: (3,) tensor, translation of all hypotheses
+    Return: (N,4,4) hypotheses matching the templates, rot_grid itself when @center is on the optical axis
+    '''
+    center = torch.as_tensor(center, dtype=torch.float, device=self.rot_grid.device).reshape(3)
+    R_c = rotation_to_optical_axis(center)
+    poses = self.rot_grid.clone()
+    poses[:,:3,:3] = R_c.T@poses[:,:3,:3]
+    poses[:,:3,3] = center
+    return poses
+
+
+  def make_crops(self, ids, poses, K, tf_to_crops, dsize):
+    '''Instead of rendering, rgbAs and xyz_mapAs of make_crop_data_batch
+    @ids: (B,) template of each hypothesis
+    @poses: (B,4,4) from make_hypotheses
+    @tf_to_crops: (B,3,3) crop windows of @poses
+    Return: rgbAs (B,3,H,W) in [0,255], xyz_mapAs (B,3,H,W) camera frame, zeros for background
+    '''
+    device = poses.device
+    B = len(poses)
+    t = poses[0,:3,3]
+    R_c = rotation_to_optical_axis(t)
+    scale = (t.norm()/self.distance).item()
+    S_inv = torch.diag(torch.tensor([1/scale, 1/scale, 1], dtype=torch.float, device=device))
+    K = torch.as_tensor(K, dtype=torch.float, device=device)
+    template_to_image = K@R_c.T@S_inv@torch.linalg.inv(self.K)@torch.linalg.inv(self.tf_to_crop)
+    tfs = tf_to_crops@template_to_image[None]   #(B,3,3)
+    ids = torch.as_tensor(ids, device=self.rgbs.device).long()
+    rgbAs = kornia.geometry.transform.warp_perspective(self.rgbs[ids].float(), tfs, dsize=dsize, mode='bilinear', align_corners=False)
+    xyz_mask = torch.cat([self.xyz_maps[ids].float(), self.masks[ids].float()], dim=1)
+    xyz_mask = kornia.geometry.transform.warp_perspective(xyz_mask, tfs, dsize=dsize, mode='nearest', align_corners=False)
+    xyz_mapAs = (R_c.T@xyz_mask[:,:3].reshape(B,3,-1)).reshape(B,3,*dsize)+t.reshape(1,3,1,1)
+    xyz_mapAs = torch.where(xyz_mask[:,3:4]>0.5, xyz_mapAs, torch.zeros_like(xyz_mapAs))
+    return rgbAs, xyz_mapAs
+
+
+  def to(self, device):
+    for k,v in self.__dict__.items():
+      if torch.is_tensor(v):
+        self.__dict__[k] = v.to(device)
+    return self
+
+
+  def save(self, path):
+    arrays = {k: v.data.cpu().numpy() for k,v in self.__dict__.items() if torch.is_tensor(v)}
+    tmp_file = f'{path}.tmp-{uuid.uuid4()}.npz'
+    np.savez(tmp_file, distance=self.distance, **arrays)
+    os.replace(tmp_file, path)
+
+
+  @classmethod
+  def load(cls, path, device='cuda'):
+    with np.load(path) as data:
+      kwargs = {k: torch.as_tensor(data[k], device=device) for k in ['rot_grid', 'rgbs', 'xyz_maps', 'masks', 'K', 'tf_to_crop']}
+      kwargs['distance'] = float(data['distance'])
+    return cls(**kwargs)
+
+
+
+class TemplateBankCache:
+  '''Template banks keyed by the mesh, the rotation grid and the settings. Kept in memory, and on disk if @cache_dir is given
+  '''
+  def __init__(self, cache_dir=None):
+    self.cache_dir = cache_dir
+    if self.cache_dir is not None:
+      os.makedirs(self.cache_dir, exist_ok=True)
+    self.banks = {}
+    self.n_hit = 0
+    self.n_miss = 0
+
+
+  def get_or_create(self, mesh, mesh_tensors, rot_grid, mesh_diameter, crop_size, crop_ratio, glctx=None, distance_ratio=4, device='cuda'):
+    '''
+    @mesh: centered trimesh, for the key
+    @rot_grid: (N,4,4) tensor
+    '''
+    settings = {'rot_grid': hashlib.sha1(np.ascontiguousarray(rot_grid.data.cpu().numpy(), dtype=np.float32).tobytes()).hexdigest(), 'crop_size': list(map(int, crop_size)), 'crop_ratio': float(crop_ratio), 'distance_ratio': float(distance_ratio)}
+    key = mesh_content_hash(mesh, extra=settings)
+    if key in self.banks:
+      self.n_hit += 1
+      return self.banks[key].to(device)
+    bank_file = None
+    if self.cache_dir is not None:
+      bank_file = f'{self.cache_dir}/{key}.npz'
+      if os.path.exists(bank_file):
+        self.n_hit += 1
+        self.banks[key] = TemplateBank.load(bank_file, device=device)
+        logging.info(f'template bank loaded from {bank_file}')
+        return self.banks[key]
+
+    self.n_miss += 1
+    bank = TemplateBank.build(mesh_tensors, rot_grid, mesh_diameter=mesh_diameter, crop_size=crop_size, crop_ratio=crop_ratio, glctx=glctx, distance_ratio=distance_ratio, device=device)
+    self.banks[key] = bank
+    if bank_file is not None:
+      bank.save(bank_file)
+    return bank
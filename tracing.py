@@ -0,0 +1,214 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,time,json,math,threading,logging
+from functools import wraps
+import torch
+
+
+class _NullSpan:
+  '''Returned by span() while tracing is disabled, nothing is timed or recorded
+  '''
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+_NULL_SPAN = _NullSpan()
+
+
+
+class SpanHistogram:
+  '''Durations of one span name in log2 spaced buckets, bucket i holds [2^i, 2^(i+1)) microseconds
+  '''
+  N_BUCKETS = 32
+
+  def __init__(self):
+    self.counts = [0]*self.N_BUCKETS
+    self.n = 0
+    self.total = 0.0
+    self.min = math.inf
+    self.max = 0.0
+
+
+  def add(self, elapsed):
+    us = elapsed*1e6
+    i = min(int(math.log2(us)) if us>=1 else 0, self.N_BUCKETS-1)
+    self.counts[i] += 1
+    self.n += 1
+    self.total += elapsed
+    self.min = min(self.min, elapsed)
+    self.max = max(self.max, elapsed)
+
+
+  def quantile(self, q):
+    '''Upper edge of the bucket holding the @q quantile, in seconds, clipped to the observed range
+    '''
+    if self.n==0:
+      return 0.0
+    rank = q*self.n
+    cum = 0
+    for i, count in enumerate(self.counts):
+      cum += count
+      if cum>=rank and count>0:
+        return min(max(2.0**(i+1)*1e-6, self.min), self.max)
+    return self.max
+
+
+  def to_dict(self):
+    return {'n': self.n, 'total': self.total, 'mean': self.total/max(self.n,1), 'min': self.min if self.n>0 else 0.0, 'max': self.max, 'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99), 'bucket_us': [2**i for i in range(self.N_BUCKETS)], 'counts': list(self.counts)}
+
+
+
+class Span:
+  __slots__ = ('tracer', 'name', 'args', 'begin')
+
+  def __init__(self, tracer, name, args):
+    self.tracer = tracer
+    self.name = name
+    self.args = args
+
+
+  def __enter__(self):
+    if self.tracer.sync_cuda:
+      torch.cuda.synchronize()
+    self.begin = time.perf_counter()
+    return self
+
+
+  def __exit__(self, *exc):
+    if self.tracer.sync_cuda:
+      torch.cuda.synchronize()
+    self.tracer.record(self.name, self.begin, time.perf_counter(), self.args)
+    return False
+
+
+
+class Tracer:
+  '''Named spans aggregated into per name histograms, and kept as events for the Chrome trace up to @max_events.
+  Disabled by default, span() then returns a shared no-op context manager.
+  Without @sync_cuda the spans time the host side, i.e. kernel launches and whatever syncs happen inside them. With it the device is synchronized at both ends of every span, which gives the device time per stage but serializes the overlapped render and network chunks
+  '''
+  def __init__(self):
+    self.enabled = False
+    self.sync_cuda = False
+    self.max_events = 0
+    self.lock = threading.Lock()
+    self.reset()
+
+
+  def enable(self, sync_cuda=False, max_events=1000000):
+    '''
+    @max_events: spans kept for export_chrome_trace, later ones only go to the histograms. 0 for histograms only
+    '''
+    self.sync_cuda = sync_cuda and torch.cuda.is_available()
+    self.max_events = max_events
+    self.enabled = True
+
+
+  def disable(self):
+    self.enabled = False
+
+
+  def reset(self):
+    with self.lock:
+      self.histograms = {}
+      self.events = []
+      self.n_dropped = 0
+      self.t0 = time.perf_counter()
+
+
+  def span(self, name, **args):
+    '''
+    @args: python scalars attached to the Chrome trace event, never tensors
+    '''
+    if not self.enabled:
+      return _NULL_SPAN
+    return Span(self, name, args)
+
+
+  def record(self, name, begin, end, args=None):
+    with self.lock:
+      if name not in self.histograms:
+        self.histograms[name] = SpanHistogram()
+      self.histograms[name].add(end-begin)
+      if len(self.events)<self.max_events:
+        self.events.append((name, begin, end, threading.get_ident(), args))
+      else:
+        self.n_dropped += 1
+
+
+  def get_stats(self):
+    with self.lock:
+      return {name: hist.to_dict() for name, hist in self.histograms.items()}
+
+
+  def summary(self):
+    lines = []
+    for name, stat in self.get_stats().items():
+      lines.append(f"{name}: n={stat['n']}, total={stat['total']:.3f}s, mean={stat['mean']*1000:.2f}ms, p50={stat['p50']*1000:.2f}ms, p90={stat['p90']*1000:.2f}ms, max={stat['max']*1000:.2f}ms")
+    return '\n'.join(lines)
+
+
+  def export_json(self, out_file):
+    '''Per span name histograms and summary stats, in seconds
+    '''
+    with open(out_file,'w') as ff:
+      json.dump({'sync_cuda': self.sync_cuda, 'n_dropped_events': self.n_dropped, 'spans': self.get_stats()}, ff, indent=2)
+
+
+  def export_chrome_trace(self, out_file):
+    '''Complete events for chrome://tracing or Perfetto, spans nest by time per thread
+    '''
+    pid = os.getpid()
+    with self.lock:
+      events = list(self.events)
+    trace = []
+    for name, begin, end, tid, args in events:
+      event = {'name': name, 'ph': 'X', 'ts': (begin-self.t0)*1e6, 'dur': (end-begin)*1e6, 'pid': pid, 'tid': tid}
+      if args:
+        event['args'] = args
+      trace.append(event)
+    with open(out_file,'w') as ff:
+      json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, ff)
+    logging.info(f'{len(trace)} spans written to {out_file}')
+
+
+
+_TRACER = Tracer()
+
+
+def get_tracer():
+  return _TRACER
+
+
+def span(name, **args):
+  '''Context manager timing the block as @name on the global tracer, see Tracer.span
+  '''
+  if not _TRACER.enabled:
+    return _NULL_SPAN
+  return Span(_TRACER, name, args)
+
+
+def traced(name=None):
+  '''Function decorator, a span named @name (default the qualified function name) around every call
+  '''
+  def decorator(func):
+    span_name = func.__qualname__ if name is None else name
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+      if not _TRACER.enabled:
+        return func(*args, **kwargs)
+      with Span(_TRACER, span_name, {}):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
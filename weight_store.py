@@ -0,0 +1,116 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys,json,hashlib,uuid,shutil,logging,warnings
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+WEIGHT_STORE_VERSION = 1
+
+
+def load_checkpoint_state_dict(ckpt_file):
+  ckpt = torch.load(ckpt_file, map_location='cpu')
+  if 'model' in ckpt:
+    ckpt = ckpt['model']
+  return ckpt
+
+
+def assign_state_dict(model, state_dict):
+  '''Strict load_state_dict that takes over the tensors of @state_dict when they already have the device and dtype of the model, instead of copying them
+  '''
+  model_state = model.state_dict(keep_vars=True)
+  missing = [k for k in model_state if k not in state_dict]
+  unexpected = [k for k in state_dict if k not in model_state]
+  if len(missing)>0 or len(unexpected)>0:
+    raise RuntimeError(f'state_dict mismatch, missing:{missing}, unexpected:{unexpected}')
+  with torch.no_grad():
+    for k,v in model_state.items():
+      src = state_dict[k]
+      if src.shape!=v.shape:
+        raise RuntimeError(f'state_dict mismatch, {k} has shape {tuple(src.shape)}, expected {tuple(v.shape)}')
+      if src.device==v.device and src.dtype==v.dtype:
+        v.data = src
+      else:
+        v.data.copy_(src)
+
+
+class WeightStore:
+  '''Checkpoints converted once to a directory of .npy per tensor, memory mapped read only on load. Processes loading the same store share its pages, the model parameters on cpu point into them directly
+  Stores are keyed by the checkpoint path, size and modification time, so they are rebuilt when the checkpoint changes
+  '''
+  def __init__(self, store_dir):
+    self.store_dir = store_dir
+    os.makedirs(self.store_dir, exist_ok=True)
+
+
+  def get_key(self, ckpt_file):
+    stat = os.stat(ckpt_file)
+    h = hashlib.sha1(f'v{WEIGHT_STORE_VERSION}_{os.path.realpath(ckpt_file)}_{stat.st_size}_{stat.st_mtime_ns}'.encode())
+    name = os.path.basename(os.path.dirname(os.path.realpath(ckpt_file)))
+    return f'{name}-{h.hexdigest()[:16]}'
+
+
+  def convert(self, ckpt_file, store_path):
+    '''Write to a temporary dir first and rename, so that concurrent workers never see a partial store
+    '''
+    state_dict = load_checkpoint_state_dict(ckpt_file)
+    tmp_dir = f'{store_path}.tmp-{uuid.uuid4()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    meta = {'version': WEIGHT_STORE_VERSION, 'ckpt_file': os.path.realpath(ckpt_file), 'tensors': []}
+    for i, (k,v) in enumerate(state_dict.items()):
+      v = v.detach().cpu().contiguous()
+      dtype = str(v.dtype).replace('torch.', '')
+      if v.dtype==torch.bfloat16:   # No numpy equivalent, stored as its bits
+        v = v.view(torch.int16)
+      np.save(f'{tmp_dir}/{i}.npy', v.numpy())
+      meta['tensors'].append({'name': k, 'file': f'{i}.npy', 'dtype': dtype})
+    with open(f'{tmp_dir}/meta.json','w') as ff:
+      json.dump(meta, ff)
+    try:
+      os.rename(tmp_dir, store_path)
+    except OSError:   # Another worker finished first
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+    logging.info(f'converted {ckpt_file} to {store_path}')
+
+
+  def load_store(self, store_path):
+    '''
+    Return: state_dict of cpu tensors on the read only memory maps, None if there is no valid store
+    '''
+    meta_file = f'{store_path}/meta.json'
+    if not os.path.exists(meta_file):
+      return None
+    with open(meta_file,'r') as ff:
+      meta = json.load(ff)
+    if meta.get('version')!=WEIGHT_STORE_VERSION:
+      return None
+    state_dict = OrderedDict()
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore')   # The arrays are not writable, nothing writes to the weights at inference
+      for entry in meta['tensors']:
+        array = np.load(f'{store_path}/{entry["file"]}', mmap_mode='r')
+        tensor = torch.from_numpy(array)
+        if entry['dtype']=='bfloat16':
+          tensor = tensor.view(torch.bfloat16)
+        state_dict[entry['name']] = tensor
+    return state_dict
+
+
+  def load(self, ckpt_file):
+    '''state_dict of @ckpt_file, converted on the first call
+    '''
+    store_path = f'{self.store_dir}/{self.get_key(ckpt_file)}'
+    state_dict = self.load_store(store_path)
+    if state_dict is None:
+      self.convert(ckpt_file, store_path)
+      state_dict = self.load_store(store_path)
+    logging.info(f'weights memory mapped from {store_path}')
+    return state_dict